@@ -1,23 +1,35 @@
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 import json
 import os
 import sys
 from pathlib import Path
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError
 import urllib.parse
 import requests
 from datetime import datetime, timezone, timedelta
 import logging
 import asyncio
 import tempfile
-from pydub import AudioSegment
 from PIL import Image, ImageDraw, ImageFont
 import random
 import re
 import io
 import aiohttp
+try:
+    import tiktoken  # 任意：入力トークン数を正確に数える
+except ImportError:
+    tiktoken = None
+import sqlite3
+import hashlib
+import base64
+import math
+import time
+import threading
+import contextvars
+import functools
+from collections import OrderedDict, Counter, deque
 
 # スクリプトのディレクトリを基準に.envファイルを読み込む
 script_dir = Path(__file__).parent
@@ -93,6 +105,57 @@ logger.info("✅ すべての必要な環境変数が設定されています")
 # モデル設定をログに記録
 logger.info(f"使用モデル設定: FREE={FREE_USER_MODEL}, PREMIUM={PREMIUM_USER_MODEL}")
 
+# パフォーマンス関連の設定（環境変数で調整可能）
+USER_DATA_FLUSH_INTERVAL = float(os.getenv('USER_DATA_FLUSH_INTERVAL', '10'))  # ユーザーデータの書き戻し間隔（秒）
+USER_DATA_CACHE_SIZE = int(os.getenv('USER_DATA_CACHE_SIZE', '10000'))  # メモリに保持するユーザーデータの最大件数
+STATS_FLUSH_INTERVAL = float(os.getenv('STATS_FLUSH_INTERVAL', '30'))  # 統計データの書き込み間隔（秒）
+ACTIVITY_EXACT_THRESHOLD = int(os.getenv('ACTIVITY_EXACT_THRESHOLD', '5000'))  # この人数を超えた日はHyperLogLogで集計
+
+# データ保存先の設定（json: 従来のJSONファイル / sqlite: SQLiteデータベース）
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json').lower()
+SQLITE_DB_PATH = Path(os.getenv('SQLITE_DB_PATH', str(script_dir / "data" / "ai_keisuke.db")))
+REACTION_WORKERS = int(os.getenv('REACTION_WORKERS', '4'))
+REACTION_QUEUE_SIZE = int(os.getenv('REACTION_QUEUE_SIZE', '100'))
+REACTION_PREMIUM_CONCURRENCY = int(os.getenv('REACTION_PREMIUM_CONCURRENCY', '4'))
+REACTION_FREE_CONCURRENCY = int(os.getenv('REACTION_FREE_CONCURRENCY', '3'))
+REACTION_FREE_STARVATION_LIMIT = int(os.getenv('REACTION_FREE_STARVATION_LIMIT', '5'))
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', 'true').lower() == 'true'
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.5'))
+GENERATION_CACHE_SIZE = int(os.getenv('GENERATION_CACHE_SIZE', '1000'))
+GENERATION_CACHE_TTL = float(os.getenv('GENERATION_CACHE_TTL', '86400'))
+GENERATION_CACHE_PATH = os.getenv('GENERATION_CACHE_PATH', '')
+GENERATION_CACHE_PRAISE = os.getenv('GENERATION_CACHE_PRAISE', 'false').lower() == 'true'
+GENERATION_CACHE_FLUSH_INTERVAL = float(os.getenv('GENERATION_CACHE_FLUSH_INTERVAL', '60'))  # 生成キャッシュの書き込み間隔（秒）
+MAP_CHUNK_TOKENS = int(os.getenv('MAP_CHUNK_TOKENS', '6000'))
+MAP_REDUCE_CONCURRENCY = int(os.getenv('MAP_REDUCE_CONCURRENCY', '4'))
+REACTION_BATCH_WINDOW = float(os.getenv('REACTION_BATCH_WINDOW', '0.25'))
+WHISPER_CONCURRENCY = int(os.getenv('WHISPER_CONCURRENCY', '4'))
+WHISPER_PART_RETRIES = int(os.getenv('WHISPER_PART_RETRIES', '2'))
+FFMPEG_TIMEOUT = float(os.getenv('FFMPEG_TIMEOUT', '600'))
+WHISPER_MAX_UPLOAD_MB = float(os.getenv('WHISPER_MAX_UPLOAD_MB', '25'))
+SPLIT_SILENCE_TOLERANCE = float(os.getenv('SPLIT_SILENCE_TOLERANCE', '30'))
+SILENCE_NOISE_DB = float(os.getenv('SILENCE_NOISE_DB', '-35'))
+SILENCE_MIN_DURATION = float(os.getenv('SILENCE_MIN_DURATION', '0.4'))
+AUDIO_NORMALIZE = os.getenv('AUDIO_NORMALIZE', 'true').lower() == 'true'
+AUDIO_NORMALIZE_FORMAT = os.getenv('AUDIO_NORMALIZE_FORMAT', 'opus')
+AUDIO_NORMALIZE_BITRATE = os.getenv('AUDIO_NORMALIZE_BITRATE', '24k')
+AUDIO_NORMALIZE_MIN_MB = float(os.getenv('AUDIO_NORMALIZE_MIN_MB', '5'))
+WHISPER_TARGET_UPLOAD_MB = float(os.getenv('WHISPER_TARGET_UPLOAD_MB', '20'))  # 分割するときの1ファイルの目標サイズ（MB）
+WHISPER_MAX_PART_SECONDS = float(os.getenv('WHISPER_MAX_PART_SECONDS', '0'))  # 1ファイルの長さの上限（秒、0で制限しない）
+HEDGED_REQUESTS = os.getenv('HEDGED_REQUESTS', 'false').lower() == 'true'
+HEDGE_DEFAULT_DELAY = float(os.getenv('HEDGE_DEFAULT_DELAY', '8'))
+HEDGE_BUDGET_RATIO = float(os.getenv('HEDGE_BUDGET_RATIO', '0.1'))
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', '3'))
+OPENAI_RETRY_BASE_DELAY = float(os.getenv('OPENAI_RETRY_BASE_DELAY', '1'))
+OPENAI_RETRY_MAX_DELAY = float(os.getenv('OPENAI_RETRY_MAX_DELAY', '30'))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv('CIRCUIT_RESET_TIMEOUT', '60'))
+
+# レート制限（settings.json の rate_limits）の空きを待つ最大時間（秒）
+RATE_LIMIT_MAX_WAIT = float(os.getenv('RATE_LIMIT_MAX_WAIT', '60'))
+
+logger.info(f"データ保存先: {STORAGE_BACKEND}")
+
 # テストサーバーID（スラッシュコマンドの即座反映用）
 # Botが参加しているサーバーのIDに変更してください
 TEST_GUILD_ID = 1388155815730610187  # Botがこのサーバーに招待されている必要があります
@@ -104,6 +167,7 @@ if settings_path.exists():
         settings = json.load(f)
         FREE_USER_DAILY_LIMIT = settings.get("free_user_daily_limit", 5)
 else:
+    settings = {}
     FREE_USER_DAILY_LIMIT = 5  # デフォルト値
 
 # カスタムログハンドラー（書き込み時のみファイルを開く）
@@ -155,128 +219,765 @@ sync_handler = SyncFriendlyFileHandler(log_file)
 sync_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
 logger.addHandler(sync_handler)
 
+# SQLiteストレージ（WALモード）
+class SQLiteStorage:
+    """ユーザー・サーバー・統計データをSQLiteデータベースに保存する"""
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        # 複数スレッドから使うため接続をロックで保護する
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id TEXT PRIMARY KEY,
+                data TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS servers (
+                server_id TEXT PRIMARY KEY,
+                data TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS activity_days (
+                date TEXT PRIMARY KEY,
+                total_actions INTEGER NOT NULL DEFAULT 0,
+                server_count INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS activity_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                date TEXT NOT NULL,
+                event TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS activity_users (
+                date TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                PRIMARY KEY (date, user_id)
+            );
+        """)
+        self._conn.commit()
+        logger.info(f"SQLiteストレージを初期化しました: {self.db_path}")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _load_json_row(self, table, key_column, key):
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT data FROM {table} WHERE {key_column} = ?", (str(key),)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def load_user(self, user_id):
+        return self._load_json_row("users", "user_id", user_id)
+
+    def save_users(self, records):
+        """複数ユーザーのデータを1トランザクションで保存する"""
+        rows = [(str(user_id), json.dumps(data, ensure_ascii=False)) for user_id, data in records.items()]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO users (user_id, data) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data",
+                rows
+            )
+
+    def load_server(self, server_id):
+        return self._load_json_row("servers", "server_id", server_id)
+
+    def save_server(self, server_id, data):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO servers (server_id, data) VALUES (?, ?) "
+                "ON CONFLICT(server_id) DO UPDATE SET data = excluded.data",
+                (str(server_id), json.dumps(data, ensure_ascii=False))
+            )
+
+    def save_activity_day(self, data):
+        """日別の統計データ（JSONと同じ形式）を保存する"""
+        date = data["date"]
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO activity_days (date, total_actions, server_count) VALUES (?, ?, ?) "
+                "ON CONFLICT(date) DO UPDATE SET total_actions = excluded.total_actions, "
+                "server_count = excluded.server_count",
+                (date, data.get("total_actions", 0), data.get("server_count", 0))
+            )
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO activity_users (date, user_id) VALUES (?, ?)",
+                [(date, str(user_id)) for user_id in data.get("active_users", [])]
+            )
+
+    def load_activity_day(self, date):
+        """日別の統計データをJSONと同じ形式で返す"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT total_actions, server_count FROM activity_days WHERE date = ?", (date,)
+            ).fetchone()
+            if not row:
+                return None
+            users = [r[0] for r in self._conn.execute(
+                "SELECT user_id FROM activity_users WHERE date = ?", (date,)
+            )]
+        return {"date": date, "active_users": users, "total_actions": row[0], "server_count": row[1]}
+
+    def append_activity_events(self, events):
+        """アクティビティイベントを追記する（events: (日付, JSON行) のリスト）"""
+        if not events:
+            return
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO activity_events (date, event) VALUES (?, ?)", events
+            )
+
+    def load_activity_totals(self, date):
+        """日別のアクション数とサーバー数を返す"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT total_actions, server_count FROM activity_days WHERE date = ?", (date,)
+            ).fetchone()
+
+    def load_all_servers(self):
+        """すべてのサーバーデータを返す"""
+        with self._lock:
+            rows = self._conn.execute("SELECT server_id, data FROM servers").fetchall()
+        return {server_id: json.loads(data) for server_id, data in rows}
+
+    def count_active_users(self, start_date, end_date):
+        """期間内のユニークユーザー数を数える（日付は両端を含む）"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(DISTINCT user_id) FROM activity_users WHERE date BETWEEN ? AND ?",
+                (start_date, end_date)
+            ).fetchone()
+        return row[0]
+
+def _read_event_log_users(log_path):
+    """イベントログからユニークユーザーを読み出す"""
+    users = set()
+    if log_path.exists():
+        with open(log_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    users.add(json.loads(line)["user_id"])
+    return sorted(users)
+
+def import_json_to_sqlite(storage):
+    """既存のJSONファイルをSQLiteへ一括インポートする"""
+    data_dir = script_dir / "data"
+    counts = {"users": 0, "servers": 0, "activity_days": 0}
+
+    users = {}
+    for file_path in sorted((data_dir / "user_data").glob("*.json")):
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                users[file_path.stem] = json.load(f)
+        except (json.JSONDecodeError, OSError) as e:
+            logger.error(f"インポートをスキップ: {file_path} ({e})")
+    if users:
+        storage.save_users(users)
+        counts["users"] = len(users)
+
+    for file_path in sorted((data_dir / "server_data").glob("*.json")):
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                storage.save_server(file_path.stem, json.load(f))
+            counts["servers"] += 1
+        except (json.JSONDecodeError, OSError) as e:
+            logger.error(f"インポートをスキップ: {file_path} ({e})")
+
+    for file_path in sorted((data_dir / "activity_logs").glob("*.json")):
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                day_data = json.load(f)
+            day_data.setdefault("date", file_path.stem)
+            if "active_users_hll" in day_data:
+                # HyperLogLogで集計された日はイベントログからユーザーを復元
+                day_data["active_users"] = _read_event_log_users(data_dir / "activity_logs" / "events" / f"{file_path.stem}.log")
+            storage.save_activity_day(day_data)
+            counts["activity_days"] += 1
+        except (json.JSONDecodeError, OSError, KeyError) as e:
+            logger.error(f"インポートをスキップ: {file_path} ({e})")
+
+    logger.info(
+        f"JSONインポート完了: ユーザー {counts['users']}件, サーバー {counts['servers']}件, "
+        f"統計 {counts['activity_days']}日分"
+    )
+    return counts
+
+# SQLiteストレージのインスタンス（STORAGE_BACKEND=sqlite のときのみ使用）
+sqlite_storage = SQLiteStorage(SQLITE_DB_PATH) if STORAGE_BACKEND == "sqlite" else None
+
+# ユニークユーザー数の推定（HyperLogLog）
+class HyperLogLog:
+    """一定メモリ（2^precisionバイト）でユニーク数を推定するスケッチ"""
+    def __init__(self, precision=14, registers=None):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(registers) if registers is not None else bytearray(self.size)
+
+    def add(self, item):
+        digest = hashlib.blake2b(str(item).encode('utf-8'), digest_size=8).digest()
+        value = int.from_bytes(digest, 'big')
+        index = value >> (64 - self.precision)
+        rest = value & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            return True
+        return False
+
+    def merge(self, other):
+        """別のスケッチを合算する（レジスタごとの最大値）"""
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        histogram = Counter(self.registers)
+        total = sum(count * 2.0 ** -rank for rank, count in histogram.items())
+        estimate = alpha * self.size * self.size / total
+        zeros = histogram.get(0, 0)
+        if estimate <= 2.5 * self.size and zeros:
+            # 少数の場合はLinear Countingで補正
+            estimate = self.size * math.log(self.size / zeros)
+        return int(round(estimate))
+
+    def to_base64(self):
+        return base64.b64encode(bytes(self.registers)).decode('ascii')
+
+    @classmethod
+    def from_base64(cls, text):
+        registers = base64.b64decode(text)
+        return cls(precision=int(math.log2(len(registers))), registers=registers)
+
+# 日別アクティブユーザーの集計
+class ActiveUserSketch:
+    """少人数の日は正確なset、閾値を超えたらHyperLogLogでアクティブユーザーを集計する"""
+    def __init__(self, users=(), hll=None, threshold=None):
+        self.threshold = ACTIVITY_EXACT_THRESHOLD if threshold is None else threshold
+        self.hll = hll
+        self.users = set(users) if hll is None else None
+        self._check_threshold()
+
+    def _check_threshold(self):
+        if self.hll is None and len(self.users) > self.threshold:
+            self._convert_to_hll()
+
+    def _convert_to_hll(self):
+        self.hll = HyperLogLog()
+        for user_id in self.users:
+            self.hll.add(user_id)
+        self.users = None
+
+    def add(self, user_id):
+        """ユーザーを追加し、集計が変わったかどうかを返す"""
+        if self.hll is not None:
+            return self.hll.add(user_id)
+        if user_id in self.users:
+            return False
+        self.users.add(user_id)
+        self._check_threshold()
+        return True
+
+    def update(self, other):
+        """別の日の集計を合算する（otherは変更しない）"""
+        if self.hll is None and other.hll is None:
+            self.users |= other.users
+            self._check_threshold()
+            return
+        if self.hll is None:
+            self._convert_to_hll()
+        if other.hll is not None:
+            self.hll.merge(other.hll)
+        else:
+            for user_id in other.users:
+                self.hll.add(user_id)
+
+    def count(self):
+        return len(self.users) if self.hll is None else self.hll.count()
+
+    def to_dict(self):
+        if self.hll is None:
+            return {"active_users": sorted(self.users)}
+        return {"active_users_hll": self.hll.to_base64(), "active_user_count": self.hll.count()}
+
+    @classmethod
+    def from_dict(cls, data):
+        data = data or {}
+        if data.get("active_users_hll"):
+            return cls(hll=HyperLogLog.from_base64(data["active_users_hll"]))
+        return cls(users=data.get("active_users", []))
+
 # 統計管理クラス
 class StatsManager:
     def __init__(self):
         self.stats_dir = script_dir / "data" / "activity_logs"
         self.stats_dir.mkdir(exist_ok=True)
+        self.events_dir = self.stats_dir / "events"
+        self._flush_lock = asyncio.Lock()
+        self._pending_events = []  # 未書き込みのイベント (日付, JSON行)
+        self._pending_days = []  # 日付が変わって確定した日の集計
+        self._rollups = OrderedDict()  # 過去日の集計キャッシュ（確定済みなので変更されない）
+        self._max_rollups = 62
+        today = datetime.now().strftime("%Y-%m-%d")
+        self._start_day(today, self._read_day(today))
         logger.info("統計管理システムを初期化しました")
     
-    async def record_user_activity(self, user_id, bot_instance=None):
-        """ユーザーアクティビティをリアルタイム記録"""
+    def _read_day(self, date):
+        """保存済みの日別集計を読み込む"""
         try:
-            today = datetime.now().strftime("%Y-%m-%d")
-            log_file = self.stats_dir / f"{today}.json"
-            
-            # 今日のログを読み込み
+            if sqlite_storage:
+                return sqlite_storage.load_activity_day(date)
+            log_file = self.stats_dir / f"{date}.json"
             if log_file.exists():
                 with open(log_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-            else:
-                # 新しい日の最初の記録時にサーバー数を記録
-                server_count = len(bot_instance.guilds) if bot_instance else 0
-                data = {
-                    "date": today,
-                    "active_users": [],
-                    "total_actions": 0,
-                    "server_count": server_count
-                }
-                logger.info(f"新しい日の統計開始: サーバー数 {server_count}")
-            
-            # ユーザーを追加（重複なし）
-            if user_id not in data["active_users"]:
-                data["active_users"].append(user_id)
-                logger.debug(f"新規アクティブユーザー記録: {user_id}")
+                    return json.load(f)
+        except Exception as e:
+            logger.error(f"統計データ読み込みエラー ({date}): {e}")
+        return None
+    
+    def _start_day(self, date, data=None, server_count=0):
+        """集計対象の日を切り替える"""
+        data = data or {}
+        self._day = date
+        self._today = ActiveUserSketch.from_dict(data)
+        self._recent_users = set()  # 前回のフラッシュ以降に記録したユーザー
+        self._total_actions = data.get("total_actions", 0)
+        self._server_count = data.get("server_count", server_count)
+        self._dirty = False  # アクション数などが前回の保存から変わった
+        self._users_changed = False  # アクティブユーザーの集計が前回の保存から変わった
+    
+    def _snapshot(self):
+        snapshot = {
+            "date": self._day,
+            "recent_users": sorted(self._recent_users),
+            "total_actions": self._total_actions,
+            "server_count": self._server_count
+        }
+        snapshot.update(self._today.to_dict())
+        return snapshot
+    
+    def _remember_rollup(self, date, sketch):
+        self._rollups[date] = sketch
+        self._rollups.move_to_end(date)
+        while len(self._rollups) > self._max_rollups:
+            self._rollups.popitem(last=False)
+    
+    def _roll_over(self, today, server_count=None):
+        """日付が変わっていれば前日の集計を確定させて新しい日を開始する"""
+        if today == self._day:
+            return
+        if self._dirty:
+            self._pending_days.append(self._snapshot())
+        self._remember_rollup(self._day, self._today)
+        if server_count is None:
+            server_count = self._server_count  # 記録がないまま日付が変わった場合は前日の値を引き継ぐ
+        self._start_day(today, server_count=server_count)
+        logger.info(f"新しい日の統計開始: サーバー数 {server_count}")
+    
+    async def record_user_activity(self, user_id, bot_instance=None):
+        """ユーザーアクティビティを記録（メモリ上で集計し、ディスクへは定期フラッシュで書き込む）"""
+        try:
+            now = datetime.now()
+            today = now.strftime("%Y-%m-%d")
+            self._roll_over(today, len(bot_instance.guilds) if bot_instance else 0)
             
-            data["total_actions"] += 1
+            # 日別の集計に追加（O(1)）
+            if self._today.add(user_id):
+                self._users_changed = True
+            self._recent_users.add(user_id)
+            self._total_actions += 1
+            self._dirty = True
             
-            # ログファイルに保存
-            with open(log_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
+            # イベントログに追記する行を積んでおく
+            event = json.dumps({"ts": now.isoformat(timespec='seconds'), "user_id": user_id}, ensure_ascii=False)
+            self._pending_events.append((today, event))
                 
         except Exception as e:
             logger.error(f"アクティビティ記録エラー: {e}")
     
+    async def flush(self, final=False):
+        """未書き込みのイベントと日別集計をまとめて保存する
+
+        今日の集計はアクティブユーザーが増えた時だけ書き直す（アクション数だけの変化は
+        日付の確定時と終了時（final=True）に保存する）
+        """
+        async with self._flush_lock:
+            days = self._pending_days
+            write_today = self._users_changed or (final and self._dirty)
+            if write_today:
+                days = days + [self._snapshot()]
+            events = self._pending_events
+            if not days and not events:
+                return
+            
+            self._pending_days = []
+            self._pending_events = []
+            if write_today:
+                self._recent_users = set()
+                self._dirty = False
+                self._users_changed = False
+            
+            written = {"event_dates": set(), "days": 0}
+            try:
+                await asyncio.to_thread(self._write, days, events, written)
+            except Exception as e:
+                # 書き込めなかった分だけを次回のフラッシュで再試行（書き込み済みの分を二重に数えない）
+                logger.error(f"統計データ書き込みエラー: {e}")
+                self._pending_events = [event for event in events if event[0] not in written["event_dates"]] + self._pending_events
+                for day in days[written["days"]:]:
+                    if day["date"] == self._day:
+                        self._recent_users.update(day["recent_users"])
+                        self._dirty = True
+                        self._users_changed = True
+                    else:
+                        self._pending_days.append(day)
+    
+    def _write(self, days, events, written):
+        """イベントと日別集計を保存し、書き込めた分をwrittenに記録する"""
+        # イベントログ（追記のみ）
+        if sqlite_storage:
+            # 1トランザクションなので全件書けたか何も書けていないかのどちらか
+            sqlite_storage.append_activity_events(events)
+            written["event_dates"].update(date for date, _ in events)
+        elif events:
+            self.events_dir.mkdir(parents=True, exist_ok=True)
+            events_by_date = {}
+            for date, line in events:
+                events_by_date.setdefault(date, []).append(line)
+            for date, lines in events_by_date.items():
+                with open(self.events_dir / f"{date}.log", 'a', encoding='utf-8') as f:
+                    f.write("\n".join(lines) + "\n")
+                written["event_dates"].add(date)
+        
+        # 日別集計
+        for day in days:
+            if sqlite_storage:
+                # SQLiteには前回以降に記録したユーザーだけを追加
+                sqlite_storage.save_activity_day(dict(day, active_users=day["recent_users"]))
+            else:
+                # 一時ファイルに書いてから置き換える（途中で失敗しても前回の内容が残る）
+                data = {key: value for key, value in day.items() if key != "recent_users"}
+                day_path = self.stats_dir / f"{day['date']}.json"
+                temp_path = day_path.with_suffix(".json.tmp")
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, indent=2, ensure_ascii=False)
+                os.replace(temp_path, day_path)
+            written["days"] += 1
+    
+    def _day_sketch(self, date):
+        """指定日の集計を返す（過去日は一度読み込んだらキャッシュする）"""
+        if date == self._day:
+            return self._today
+        if date in self._rollups:
+            self._rollups.move_to_end(date)
+            return self._rollups[date]
+        sketch = ActiveUserSketch.from_dict(self._read_day(date))
+        if date < self._day:
+            self._remember_rollup(date, sketch)
+        return sketch
+    
+    def preload_rollups(self, days=30):
+        """過去日の集計を事前に読み込む（起動時にスレッドで実行）"""
+        base_date = datetime.strptime(self._day, "%Y-%m-%d")
+        for i in range(1, days):
+            self._day_sketch((base_date - timedelta(days=i)).strftime("%Y-%m-%d"))
+        logger.info(f"統計ロールアップを読み込みました: {len(self._rollups)}日分")
+    
+    def count_active_users(self, days, target_date=None):
+        """指定日から過去days日間のユニークユーザー数（日別の集計を合算）"""
+        if target_date is None:
+            # 日付が変わってから記録がなくても今日を基準にする
+            self._roll_over(datetime.now().strftime("%Y-%m-%d"))
+            base_date = datetime.strptime(self._day, "%Y-%m-%d")
+        else:
+            base_date = datetime.strptime(target_date, "%Y-%m-%d")
+        
+        merged = ActiveUserSketch()
+        for i in range(days):
+            merged.update(self._day_sketch((base_date - timedelta(days=i)).strftime("%Y-%m-%d")))
+        return merged.count()
+    
     def calculate_dau(self, target_date=None):
         """指定日のDAU計算（デフォルトは今日）"""
         try:
-            if target_date is None:
-                target_date = datetime.now().strftime("%Y-%m-%d")
-            
-            log_file = self.stats_dir / f"{target_date}.json"
-            
-            if log_file.exists():
-                with open(log_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    return len(data.get("active_users", []))
-            return 0
-            
+            return self.count_active_users(1, target_date)
         except Exception as e:
             logger.error(f"DAU計算エラー: {e}")
             return 0
     
+    def calculate_wau(self, target_date=None):
+        """指定日から過去7日間のWAU計算"""
+        try:
+            return self.count_active_users(7, target_date)
+        except Exception as e:
+            logger.error(f"WAU計算エラー: {e}")
+            return 0
+    
     def calculate_mau(self, target_date=None):
         """指定日から過去30日間のMAU計算"""
         try:
-            if target_date is None:
-                base_date = datetime.now()
-            else:
-                base_date = datetime.strptime(target_date, "%Y-%m-%d")
-            
-            mau_users = set()
-            
-            for i in range(30):
-                date = (base_date - timedelta(days=i)).strftime("%Y-%m-%d")
-                log_file = self.stats_dir / f"{date}.json"
-                
-                if log_file.exists():
-                    with open(log_file, 'r', encoding='utf-8') as f:
-                        data = json.load(f)
-                        mau_users.update(data.get("active_users", []))
-            
-            return len(mau_users)
-            
+            return self.count_active_users(30, target_date)
         except Exception as e:
             logger.error(f"MAU計算エラー: {e}")
             return 0
     
     def get_stats_summary(self):
-        """統計サマリーを取得"""
+        """統計サマリーを取得（すべてメモリ上の集計から計算）"""
         try:
-            today = datetime.now().strftime("%Y-%m-%d")
-            dau = self.calculate_dau()
-            mau = self.calculate_mau()
-            
-            # 総アクション数・サーバー数（今日）
-            today_log = self.stats_dir / f"{today}.json"
-            total_actions_today = 0
-            server_count_today = 0
-            if today_log.exists():
-                with open(today_log, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    total_actions_today = data.get("total_actions", 0)
-                    server_count_today = data.get("server_count", 0)
-            
+            self._roll_over(datetime.now().strftime("%Y-%m-%d"))
             return {
-                "date": today,
-                "dau": dau,
-                "mau": mau,
-                "total_actions_today": total_actions_today,
-                "server_count": server_count_today
+                "date": self._day,
+                "dau": self.calculate_dau(),
+                "wau": self.calculate_wau(),
+                "mau": self.calculate_mau(),
+                "total_actions_today": self._total_actions,
+                "server_count": self._server_count
             }
             
         except Exception as e:
             logger.error(f"統計サマリー取得エラー: {e}")
-            return {"date": "", "dau": 0, "mau": 0, "total_actions_today": 0, "server_count": 0}
+            return {"date": "", "dau": 0, "wau": 0, "mau": 0, "total_actions_today": 0, "server_count": 0}
 
-# OpenAIクライアントの初期化（60秒タイムアウト設定）
+# OpenAIクライアントの初期化（非同期クライアントを1つだけ作り、接続プールを全機能で共有する）
 client_openai = None
 if OPENAI_API_KEY:
-    client_openai = OpenAI(
+    client_openai = AsyncOpenAI(
         api_key=OPENAI_API_KEY,
-        timeout=180.0  # 180秒タイムアウト（長い音声ファイル対応）
+        timeout=180.0,  # 180秒タイムアウト（長い音声ファイル対応）
+        max_retries=0  # リトライは call_openai で行う
     )
 
+class OpenAIUnavailableError(Exception):
+    """サーキットブレーカーが開いていてモデルを呼び出せない"""
+
+# モデルごとのサーキットブレーカー
+class CircuitBreaker:
+    """連続して失敗したモデルの呼び出しを一定時間止める（時間経過後は試しに通す）"""
+    def __init__(self, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    def is_open(self):
+        if self.opened_at is None:
+            return False
+        return time.monotonic() - self.opened_at < self.reset_timeout
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            if not self.is_open():
+                logger.warning(f"サーキットブレーカーを開きました（連続失敗{self.failures}回）")
+            self.opened_at = time.monotonic()
+
+circuit_breakers = {}  # モデル名 -> CircuitBreaker
+
+def get_circuit_breaker(model):
+    breaker = circuit_breakers.get(model)
+    if breaker is None:
+        breaker = circuit_breakers[model] = CircuitBreaker()
+    return breaker
+
+def is_retryable_error(error):
+    """時間をおけば成功しうるエラーか（接続エラー・タイムアウト・429・5xx）"""
+    if isinstance(error, APIConnectionError):
+        return True
+    if isinstance(error, APIStatusError):
+        # 課金上限による429は待っても回復しない
+        if getattr(error, "code", None) == "insufficient_quota":
+            return False
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+def retry_delay(error, attempt):
+    """ジッター付き指数バックオフの待ち時間（Retry-Afterがあればそれ以上待つ）"""
+    delay = random.uniform(0, min(OPENAI_RETRY_MAX_DELAY, OPENAI_RETRY_BASE_DELAY * (2 ** attempt)))
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            delay = max(delay, float(headers["retry-after-ms"]) / 1000)
+        elif headers.get("retry-after"):
+            delay = max(delay, float(headers["retry-after"]))
+    except (TypeError, ValueError):
+        pass
+    return min(delay, OPENAI_RETRY_MAX_DELAY)
+
+def fallback_model_for(model):
+    """障害時の切り替え先モデル（プレミアム用モデルのみ無料用モデルに切り替える）"""
+    if model == PREMIUM_USER_MODEL and model != FREE_USER_MODEL:
+        return FREE_USER_MODEL
+    return None
+
+# レート制限用のトークンバケット
+class TokenBucket:
+    """1分あたりの上限量で補充されるバケット"""
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def available(self):
+        """経過時間分を補充したうえで、いま使える量を返す"""
+        self._refill()
+        return self.tokens
+
+    def wait_time(self, amount):
+        """amount分を使えるようになるまでの秒数"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) * 60 / self.capacity
+
+    def consume(self, amount):
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+    def give_back(self, amount):
+        """見積もりより少なく済んだ分を戻す（超過分は負の値で差し引く）"""
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+# モデルごとのレート制限
+class ModelRateLimiter:
+    """1分あたりのリクエスト数（RPM）と推定トークン数（TPM）を制限する"""
+    def __init__(self, model, rpm=None, tpm=None):
+        self.model = model
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.waiting = 0
+        self.throttled = 0
+        self.total_wait = 0.0
+
+    async def acquire(self, estimated_tokens=0):
+        """空きができるまで待ってから枠を確保する（最大RATE_LIMIT_MAX_WAIT秒）"""
+        waited = 0.0
+        while True:
+            wait = 0.0
+            if self.requests:
+                wait = max(wait, self.requests.wait_time(1))
+            if self.tokens and estimated_tokens:
+                wait = max(wait, self.tokens.wait_time(estimated_tokens))
+            if wait <= 0 or waited >= RATE_LIMIT_MAX_WAIT:
+                break
+            if waited == 0:
+                self.throttled += 1
+            wait = min(wait, RATE_LIMIT_MAX_WAIT - waited)
+            self.waiting += 1
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                self.waiting -= 1
+            waited += wait
+            self.total_wait += wait
+
+        if self.requests:
+            self.requests.consume(1)
+        if self.tokens and estimated_tokens:
+            self.tokens.consume(estimated_tokens)
+
+    def record_usage(self, estimated_tokens, actual_tokens):
+        """実際の使用トークン数で見積もりとの差を補正する"""
+        if self.tokens and actual_tokens is not None:
+            self.tokens.give_back(estimated_tokens - actual_tokens)
+
+    def snapshot(self):
+        return {
+            "rpm_limit": self.requests.capacity if self.requests else None,
+            "rpm_available": int(self.requests.available()) if self.requests else None,
+            "tpm_limit": self.tokens.capacity if self.tokens else None,
+            "tpm_available": int(self.tokens.available()) if self.tokens else None,
+            "waiting": self.waiting,
+            "throttled": self.throttled,
+            "total_wait": round(self.total_wait, 1),
+        }
+
+class RateLimiter:
+    """settings.json の rate_limits に設定されたモデルごとのレート制限をまとめる"""
+    def __init__(self, limits):
+        self._limiters = {
+            model: ModelRateLimiter(model, config.get("rpm"), config.get("tpm"))
+            for model, config in limits.items()
+        }
+
+    def get(self, model):
+        return self._limiters.get(model)
+
+    def snapshot(self):
+        """モデルごとの現在の状態（/stats で表示）"""
+        return {model: limiter.snapshot() for model, limiter in self._limiters.items()}
+
+def estimate_request_tokens(kwargs):
+    """チャット補完のリクエストが使うトークン数の見積もり（入力＋最大出力）"""
+    messages = kwargs.get("messages")
+    if not messages:
+        return 0
+    prompt_tokens = sum(count_tokens(message.get("content") or "", kwargs.get("model", "")) for message in messages)
+    return prompt_tokens + kwargs.get("max_tokens", 0)
+
+# レート制限のインスタンスを作成（設定がないモデルは制限しない）
+rate_limiter = RateLimiter(settings.get("rate_limits", {}))
+
+async def call_openai(create, usage_sink=None, **kwargs):
+    """OpenAI API呼び出しの共通処理
+
+    一時的なエラーはジッター付き指数バックオフでリトライし、モデルごとのサーキットブレーカーで
+    障害中のモデルへの呼び出しを止める。プレミアム用モデルが使えない場合は無料用モデルに切り替える。
+    ストリーミングの使用量は最後のチャンクで届くため、usage_sink（dict）の"settle"に
+    実際の使用トークン数でレート制限の見積もりを補正する関数を入れて返す。
+    """
+    model = kwargs.get("model")
+    breaker = get_circuit_breaker(model)
+    fallback = fallback_model_for(model)
+
+    if breaker.is_open():
+        if fallback:
+            logger.warning(f"{model} は停止中のため {fallback} で処理します")
+            return await call_openai(create, usage_sink, **{**kwargs, "model": fallback})
+        raise OpenAIUnavailableError(f"{model} は一時的に利用できません")
+
+    limiter = rate_limiter.get(model)
+    # 長い入力のトークン化でイベントループを止めないよう、別スレッドで数える
+    estimated_tokens = await asyncio.to_thread(estimate_request_tokens, kwargs) if limiter else 0
+    attempt = 0
+    while True:
+        if limiter:
+            # 組織のレート制限を超えないよう、空きができるまで少し待つ
+            await limiter.acquire(estimated_tokens)
+        try:
+            response = await create(**kwargs)
+        except Exception as e:
+            if not is_retryable_error(e):
+                raise
+            breaker.record_failure()
+            if attempt >= OPENAI_MAX_RETRIES or breaker.is_open():
+                if fallback:
+                    logger.warning(f"{model} の呼び出しに失敗したため {fallback} で処理します: {e}")
+                    return await call_openai(create, usage_sink, **{**kwargs, "model": fallback})
+                raise
+            delay = retry_delay(e, attempt)
+            attempt += 1
+            logger.warning(f"OpenAI API 一時エラーのため {delay:.1f}秒後にリトライします ({attempt}/{OPENAI_MAX_RETRIES}): {e}")
+            await asyncio.sleep(delay)
+        else:
+            breaker.record_success()
+            usage = getattr(response, "usage", None)
+            if limiter and usage is not None:
+                limiter.record_usage(estimated_tokens, getattr(usage, "total_tokens", None))
+            elif limiter and usage_sink is not None and kwargs.get("stream"):
+                usage_sink["settle"] = lambda actual_tokens: limiter.record_usage(estimated_tokens, actual_tokens)
+            return response
+
 
 # Intentsの設定
 intents = discord.Intents.default()
@@ -284,8 +985,41 @@ intents.message_content = True
 intents.reactions = True
 intents.members = True
 
+# Botクラス（バックグラウンドタスクの起動と終了時の保存処理）
+class AIKeisukeBot(commands.Bot):
+    async def setup_hook(self):
+        """ログイン前の初期化処理"""
+        await asyncio.to_thread(active_channels.load_all)
+        await asyncio.to_thread(stats_manager.preload_rollups)
+        await asyncio.to_thread(generation_cache.load)
+        flush_user_data_task.start()
+        flush_stats_task.start()
+        flush_generation_cache_task.start()
+        reaction_queue.start()
+
+    async def close(self):
+        """終了前に未保存のデータを書き戻す"""
+        flush_user_data_task.cancel()
+        flush_stats_task.cancel()
+        flush_generation_cache_task.cancel()
+        reaction_queue.stop()
+        try:
+            await quota_counter.flush()
+            saved = await user_store.flush()
+            logger.info(f"終了前にユーザーデータを保存しました: {saved}件")
+            await stats_manager.flush(final=True)
+        except Exception as e:
+            logger.error(f"終了時の保存エラー: {e}")
+        # 生成キャッシュは失っても再生成できるため、他の保存とは別に書き込む
+        await generation_cache.flush()
+        await super().close()
+        if client_openai:
+            await client_openai.close()
+        if sqlite_storage:
+            sqlite_storage.close()
+
 # Botの初期化
-bot = commands.Bot(command_prefix='!', intents=intents)
+bot = AIKeisukeBot(command_prefix='!', intents=intents)
 
 # 統計管理インスタンスを作成
 stats_manager = StatsManager()
@@ -293,6 +1027,8 @@ stats_manager = StatsManager()
 
 def load_server_data(server_id):
     """サーバーデータを読み込む"""
+    if sqlite_storage:
+        return sqlite_storage.load_server(server_id)
     file_path = script_dir / "data" / "server_data" / f"{server_id}.json"
     if file_path.exists():
         with open(file_path, 'r', encoding='utf-8') as f:
@@ -301,18 +1037,61 @@ def load_server_data(server_id):
 
 def save_server_data(server_id, data):
     """サーバーデータを保存する"""
+    if sqlite_storage:
+        sqlite_storage.save_server(server_id, data)
+        return
     data_dir = script_dir / "data" / "server_data"
     data_dir.mkdir(parents=True, exist_ok=True)
     file_path = data_dir / f"{server_id}.json"
     with open(file_path, 'w', encoding='utf-8') as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
 
+# 有効チャンネルのインデックス
+class ActiveChannelIndex:
+    """有効チャンネルをサーバーごとにメモリ上で管理する"""
+    def __init__(self):
+        self._channels = {}  # server_id -> 有効なchannel_idのset
+        self._fully_loaded = False
+
+    def load_all(self):
+        """起動時にすべてのサーバーデータを読み込む"""
+        if sqlite_storage:
+            servers = sqlite_storage.load_all_servers()
+        else:
+            servers = {}
+            for file_path in (script_dir / "data" / "server_data").glob("*.json"):
+                servers[file_path.stem] = load_server_data(file_path.stem)
+
+        for server_id, server_data in servers.items():
+            self.set_channels(server_id, (server_data or {}).get('active_channel_ids', []))
+        self._fully_loaded = True
+
+        channel_count = sum(len(channels) for channels in self._channels.values())
+        logger.info(f"有効チャンネルを読み込みました: {len(self._channels)}サーバー, {channel_count}チャンネル")
+
+    def set_channels(self, server_id, channel_ids):
+        """サーバーの有効チャンネル一覧を更新する"""
+        self._channels[str(server_id)] = {str(channel_id) for channel_id in channel_ids}
+
+    def is_active(self, server_id, channel_id):
+        server_id = str(server_id)
+        channels = self._channels.get(server_id)
+        if channels is None:
+            if self._fully_loaded:
+                # 起動時に読み込み済みなので未登録のサーバーは無効
+                return False
+            # 起動前（テスト等）はサーバーごとに1度だけ読み込む
+            server_data = load_server_data(server_id)
+            self.set_channels(server_id, (server_data or {}).get('active_channel_ids', []))
+            channels = self._channels[server_id]
+        return str(channel_id) in channels
+
+# 有効チャンネルインデックスのインスタンスを作成
+active_channels = ActiveChannelIndex()
+
 def is_channel_active(server_id, channel_id):
-    """チャンネルが有効かどうかをチェック"""
-    server_data = load_server_data(server_id)
-    if server_data and 'active_channel_ids' in server_data:
-        return str(channel_id) in server_data['active_channel_ids']
-    return False
+    """チャンネルが有効かどうかをチェック（メモリ上のインデックスを参照）"""
+    return active_channels.is_active(server_id, channel_id)
 
 def migrate_user_data(user_data, user_id, username):
     """古いユーザーデータを新しいフォーマットにマイグレーション"""
@@ -362,6 +1141,12 @@ async def check_content_for_urls(content_text, user, channel):
 
 def load_user_data(user_id):
     """ユーザーデータを読み込む"""
+    if sqlite_storage:
+        try:
+            return sqlite_storage.load_user(user_id)
+        except json.JSONDecodeError as e:
+            logger.error(f"ユーザーデータ読み込みエラー {user_id}: {e}")
+            return None
     file_path = script_dir / "data" / "user_data" / f"{user_id}.json"
     if file_path.exists():
         try:
@@ -375,109 +1160,556 @@ def load_user_data(user_id):
 
 def save_user_data(user_id, data):
     """ユーザーデータを保存する"""
+    if sqlite_storage:
+        sqlite_storage.save_users({user_id: data})
+        return
     data_dir = script_dir / "data" / "user_data"
     data_dir.mkdir(parents=True, exist_ok=True)
     file_path = data_dir / f"{user_id}.json"
     with open(file_path, 'w', encoding='utf-8') as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
 
+# ユーザーデータのライトバックキャッシュ
+class UserDataStore:
+    """ユーザーデータをメモリに保持し、変更分をまとめてディスクに書き戻す"""
+    def __init__(self, max_records=10000):
+        self.max_records = max_records
+        self._records = OrderedDict()
+        self._dirty = set()
+        self._flush_lock = asyncio.Lock()
+
+    async def get(self, user_id):
+        """ユーザーデータを取得（キャッシュにない場合のみディスクから読み込む）"""
+        key = str(user_id)
+        if key in self._records:
+            self._records.move_to_end(key)
+            return self._records[key]
+
+        # ディスク読み込みはイベントループの外で行う
+        data = await asyncio.to_thread(load_user_data, key)
+        if data is None:
+            return None
+
+        # 読み込み中に別の処理が登録した場合はそちらを優先
+        if key in self._records:
+            return self._records[key]
+        self._remember(key, data)
+        return data
+
+    def put(self, user_id, data):
+        """ユーザーデータを更新し、次回のフラッシュで書き戻す"""
+        key = str(user_id)
+        self._remember(key, data)
+        self._dirty.add(key)
+
+    def _remember(self, key, data):
+        self._records[key] = data
+        self._records.move_to_end(key)
+
+        # 上限を超えたら古いものから追い出す（未保存のデータは残す）
+        if len(self._records) > self.max_records:
+            for old_key in list(self._records):
+                if len(self._records) <= self.max_records:
+                    break
+                if old_key not in self._dirty:
+                    del self._records[old_key]
+
+    async def flush(self):
+        """未保存のユーザーデータをまとめて書き戻す"""
+        async with self._flush_lock:
+            if not self._dirty:
+                return 0
+
+            # イベントループ上でスナップショットを取ってから書き込む
+            batch = {key: dict(self._records[key]) for key in self._dirty if key in self._records}
+            self._dirty.clear()
+
+            try:
+                await asyncio.to_thread(self._write_batch, batch)
+            except Exception as e:
+                # 失敗した分は次回のフラッシュで再試行
+                self._dirty.update(batch)
+                logger.error(f"ユーザーデータ書き戻しエラー: {e}")
+                return 0
+
+            logger.debug(f"ユーザーデータを書き戻しました: {len(batch)}件")
+            return len(batch)
+
+    def _write_batch(self, batch):
+        # SQLiteの場合は1トランザクションでまとめて保存
+        if sqlite_storage:
+            sqlite_storage.save_users(batch)
+            return
+        for key, data in batch.items():
+            save_user_data(key, data)
+
+# ユーザーデータストアのインスタンスを作成
+user_store = UserDataStore(max_records=USER_DATA_CACHE_SIZE)
+
+@tasks.loop(seconds=STATS_FLUSH_INTERVAL)
+async def flush_stats_task():
+    """統計データを定期的に書き込む"""
+    await stats_manager.flush()
+
+@tasks.loop(seconds=USER_DATA_FLUSH_INTERVAL)
+async def flush_user_data_task():
+    """利用回数とユーザーデータを定期的に書き戻す"""
+    await quota_counter.flush()
+    await user_store.flush()
+
+# プレミアム会員キャッシュ
+class PremiumMemberCache:
+    """コミュニティサーバーのプレミアムロール保持者をメモリ上で管理する"""
+    def __init__(self):
+        self._members = set()
+        self.ready = False
+
+    @staticmethod
+    def is_community_guild(guild):
+        return guild is not None and str(guild.id) == str(settings.get("community_server_id"))
+
+    @staticmethod
+    def _has_premium_role(member):
+        premium_role_id = int(settings.get("premium_role_id"))
+        return any(role.id == premium_role_id for role in member.roles)
+
+    def rebuild(self, guild):
+        """コミュニティサーバーの全メンバーから作り直す"""
+        self._members = {str(member.id) for member in guild.members if self._has_premium_role(member)}
+        self.ready = True
+        logger.info(f"プレミアム会員キャッシュを作成しました: {len(self._members)}人")
+
+    def update_member(self, member):
+        """メンバーのロール変更を反映する"""
+        if self._has_premium_role(member):
+            self._members.add(str(member.id))
+        else:
+            self._members.discard(str(member.id))
+
+    def remove_member(self, user_id):
+        self._members.discard(str(user_id))
+
+    def __contains__(self, user_id):
+        return str(user_id) in self._members
+
+# プレミアム会員キャッシュのインスタンスを作成
+premium_members = PremiumMemberCache()
+
 def is_premium_user(user_id):
-    """ユーザーがプレミアムかどうかを判定"""
+    """ユーザーがプレミアムかどうかを判定（ロールはキャッシュを参照）"""
     try:
         # サーバーオーナーの特別判定
         community_guild = bot.get_guild(int(settings.get("community_server_id")))
         if not community_guild:
-            logger.warning(f"Community server not found: {settings.get('community_server_id')}")
+            logger.debug(f"Community server not found: {settings.get('community_server_id')}")
             return False
         
         # オーナーチェック（Discord APIベース）
         if int(user_id) == community_guild.owner_id:
-            logger.info(f"User {user_id} is server owner - granting premium access")
             return True
         
         # オーナーチェック（設定ファイルベース）
         owner_user_id = settings.get("owner_user_id")
         if owner_user_id and str(user_id) == str(owner_user_id):
-            logger.info(f"User {user_id} is configured owner - granting premium access")
             return True
         
-        logger.info(f"Debug: Checking user {user_id} in guild {community_guild.name}")
-        
-        member = community_guild.get_member(int(user_id))
-        if not member:
-            logger.warning(f"User {user_id} not found in community server {community_guild.name}")
-            logger.info(f"Debug: Guild has {community_guild.member_count} members")
-            logger.info(f"Debug: This may be due to the user having a role higher than the Bot's role")
-            return False
-        
-        logger.info(f"Debug: Found member {member.name}#{member.discriminator}")
-        logger.info(f"Debug: Member roles: {[f'{role.name}({role.id})' for role in member.roles]}")
-        
-        # プレミアムロールの確認
-        premium_role_id = int(settings.get("premium_role_id"))
-        logger.info(f"Debug: Looking for premium role ID: {premium_role_id}")
-        
-        has_premium_role = any(role.id == premium_role_id for role in member.roles)
+        # キャッシュ未作成の場合（on_ready前など）はここで作成
+        if not premium_members.ready:
+            premium_members.rebuild(community_guild)
         
-        logger.info(f"Premium check for user {user_id} ({member.name}): {has_premium_role}")
-        return has_premium_role
+        return user_id in premium_members
         
     except Exception as e:
         logger.error(f"Error checking premium status for user {user_id}: {e}")
         return False
 
-def can_use_feature(user_data, is_premium):
-    """機能使用可能かチェックし、使用回数を更新"""
-    # 日本時間（JST）で現在の日付を取得
-    jst = timezone(timedelta(hours=9))
-    today = datetime.now(jst).strftime("%Y-%m-%d")
-    
-    # プレミアムユーザーは無制限（ただし使用回数はカウント）
-    if is_premium:
-        last_used_date = user_data.get("last_used_date", "")
-        daily_usage_count = user_data.get("daily_usage_count", 0)
-        
-        # 日付が変わった場合はカウントをリセット
-        if last_used_date != today:
-            user_data["last_used_date"] = today
-            user_data["daily_usage_count"] = 1
-        else:
-            # 同じ日の場合は使用回数を増加
-            user_data["daily_usage_count"] = daily_usage_count + 1
-        
-        return True, None
-    
-    # 無料ユーザーの制限チェック
-    last_used_date = user_data.get("last_used_date", "")
-    daily_usage_count = user_data.get("daily_usage_count", 0)
-    
-    # 日付が変わった場合はカウントをリセット
-    if last_used_date != today:
-        user_data["last_used_date"] = today
-        user_data["daily_usage_count"] = 1
-        return True, None
+# 日本時間（JST）
+JST = timezone(timedelta(hours=9))
+
+# 1日の利用回数カウンター
+class QuotaCounter:
+    """ユーザーごとの1日の利用回数をメモリ上で管理する（日本時間の0時に自動でリセット）"""
+    def __init__(self, daily_limit):
+        self.daily_limit = daily_limit
+        self._counts = {}  # user_id -> (日付, 回数)
+        self._dirty = set()
+
+    @staticmethod
+    def today():
+        return datetime.now(JST).strftime("%Y-%m-%d")
+
+    def seed(self, user_id, user_data):
+        """保存済みのユーザーデータからカウンターを初期化する（初回のみ）"""
+        key = str(user_id)
+        if key not in self._counts and user_data:
+            self._counts[key] = (user_data.get("last_used_date", ""), user_data.get("daily_usage_count", 0))
+
+    def usage(self, user_id):
+        """今日の利用回数を返す"""
+        date, count = self._counts.get(str(user_id), ("", 0))
+        return count if date == self.today() else 0
+
+    def try_consume(self, user_id, is_premium):
+        """利用回数を1回分消費する
+
+        チェックと加算の間にawaitを挟まないため、同じユーザーの同時リアクションでも
+        上限を超えて消費されることはない。
+        """
+        key = str(user_id)
+        today = self.today()
+        count = self.usage(key)
+
+        # プレミアムユーザーは無制限（ただし使用回数はカウント）
+        if not is_premium and count >= self.daily_limit:
+            return False
+
+        self._counts[key] = (today, count + 1)
+        self._dirty.add(key)
+        return True
+
+    def refund(self, user_id):
+        """処理できなかった分の利用回数を戻す"""
+        key = str(user_id)
+        count = self.usage(key)
+        if count > 0:
+            self._counts[key] = (self.today(), count - 1)
+            self._dirty.add(key)
+
+    async def flush(self):
+        """変更のあったカウンターをユーザーデータに反映する（保存はユーザーデータストアが行う）"""
+        dirty = self._dirty
+        self._dirty = set()
+        for key in dirty:
+            user_data = await user_store.get(key)
+            if user_data is None:
+                continue
+            date, count = self._counts[key]
+            user_data["last_used_date"] = date
+            user_data["daily_usage_count"] = count
+            user_store.put(key, user_data)
+
+        # 前日以前のカウンターは保存済みなのでメモリから外す
+        today = self.today()
+        for key in [key for key, (date, _) in self._counts.items() if date != today and key not in self._dirty]:
+            del self._counts[key]
+
+# 利用回数カウンターのインスタンスを作成
+quota_counter = QuotaCounter(FREE_USER_DAILY_LIMIT)
+
+def can_use_feature(user_id, user_data, is_premium):
+    """機能使用可能かチェックし、使用回数を更新
+
+    カウンターはDiscordのユーザーIDで管理する（user_dataのuser_idは古いデータだと入っていない）
+    """
+    if user_id is None or str(user_id) in ("", "None"):
+        raise ValueError("利用回数のチェックにはDiscordのユーザーIDが必要です")
+    user_id = str(user_id)
+    quota_counter.seed(user_id, user_data)
     
-    # 同じ日の場合は制限チェック
-    if daily_usage_count >= FREE_USER_DAILY_LIMIT:
+    if not quota_counter.try_consume(user_id, is_premium):
         return False, f"😅 今日の分の利用回数を使い切っちゃいました！\n無料プランでは1日{FREE_USER_DAILY_LIMIT}回まで利用できます。明日また遊びに来てくださいね！✨\n\n💎 **もっと使いたい場合は有料プランがおすすめです！**\n🤖 このBotのプロフィールを見ると、プレミアム会員の詳細と登録方法が載ってるよ〜"
     
-    # 使用回数を増加
-    user_data["daily_usage_count"] = daily_usage_count + 1
     return True, None
 
-def make_praise_image(praise_text):
-    """褒めメッセージ画像を生成する"""
+# 機能ごとのプロンプト定義（ファイル名、ファイルがない場合の代替文、JSON出力指示）
+PROMPT_SPECS = {
+    "x_post": {
+        "file": "x_post.txt",
+        "fallback": "あなたはDiscordの投稿をX（旧Twitter）用に要約するアシスタントです。140文字以内で簡潔に要約してください。",
+        "json_instruction": "\n\n出力は以下のJSON形式で返してください：\n{\"content\": \"X投稿用のテキスト\"}",
+    },
+    "heart_praise": {
+        "file": "heart_praise.txt",
+        "fallback": "あなたはDiscordメッセージの内容について極めて熱烈に褒めまくるアシスタントです。どんな内容でも強烈に・熱烈に・感動的に褒めてください。ユーザーのモチベーション向上に特化した内容で、800文字以内で褒めてください。",
+        "json_instruction": "",
+    },
+    "question_explain": {
+        "file": "question_explain.txt",
+        "fallback": "あなたはDiscordメッセージの内容について詳しく解説するアシスタントです。投稿内容をわかりやすく、丁寧に解説してください。専門用語があれば説明し、背景情報も補足してください。",
+        "json_instruction": "",
+    },
+    "pencil_memo": {
+        "file": "pencil_memo.txt",
+        "fallback": "あなたはDiscordメッセージの内容をObsidianメモとして整理するアシスタントです。内容に忠実にメモ化してください。追加情報は加えず、原文を尊重してください。",
+        "json_instruction": '\n\n出力はJSON形式で、以下のフォーマットに従ってください：\n{"english_title": "english_title_for_filename", "content": "メモの内容"}',
+    },
+    "article": {
+        "file": "article.txt",
+        "fallback": "あなたは優秀なライターです。与えられた内容を元に、構造化された記事を作成してください。",
+        "json_instruction": '\n\n出力はJSON形式で、以下のフォーマットに従ってください：\n{"content": "マークダウン形式の記事全文"}',
+        # プロンプトに出力形式が書かれている場合は指示を追加しない
+        "json_marker": '{"content":',
+    },
+}
+
+# プロンプトテンプレートのキャッシュ
+class PromptRegistry:
+    """prompt/*.txt をメモリに保持し、更新時刻が変わったときだけ読み直す"""
+    def __init__(self, specs):
+        self.specs = specs
+        self._cache = {}  # 名前 -> (更新時刻, テンプレート)
+
+    def template(self, name):
+        """機能のプロンプトテンプレート（ファイルがなければ代替文）を返す"""
+        spec = self.specs[name]
+        prompt_path = script_dir / "prompt" / spec["file"]
+        try:
+            mtime = prompt_path.stat().st_mtime_ns
+        except OSError:
+            mtime = None
+
+        cached = self._cache.get(name)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        # 初回またはファイルが更新された場合のみ読み込む
+        if mtime is not None:
+            with open(prompt_path, 'r', encoding='utf-8') as f:
+                template = f.read()
+            logger.info(f"プロンプトファイルを読み込みました: {spec['file']}")
+        else:
+            template = spec["fallback"]
+            logger.info(f"フォールバックプロンプトを使用: {name}")
+
+        self._cache[name] = (mtime, template)
+        return template
+
+    def instruction(self, name, template):
+        """テンプレートに付け加えるJSON出力指示（不要なら空文字）"""
+        spec = self.specs[name]
+        marker = spec.get("json_marker")
+        if marker and marker in template:
+            return ""
+        return spec["json_instruction"]
+
+    def get(self, name, custom_prompt=None):
+        """JSON出力指示を付けたプロンプトを返す（カスタムプロンプトがあればそちらを使用）"""
+        template = custom_prompt or self.template(name)
+        return template + self.instruction(name, template)
+
+    def build_messages(self, name, input_text, custom_prompt=None):
+        """API に送るメッセージ（JSON出力指示付きのシステムプロンプトと入力テキスト）を組み立てる"""
+        return [
+            {"role": "system", "content": self.get(name, custom_prompt)},
+            {"role": "user", "content": input_text}
+        ]
+
+# プロンプトレジストリのインスタンスを作成
+prompt_registry = PromptRegistry(PROMPT_SPECS)
+
+# 追加リクエスト（ヘッジ）を送る機能
+HEDGE_FEATURES = {"x_post", "question_explain"}
+
+# 機能ごとの応答時間の記録
+class LatencyTracker:
+    """最近の応答時間（ストリーミングは最初の応答まで）からヘッジを送る待ち時間を決める"""
+    def __init__(self, window=200, min_samples=20, default_delay=HEDGE_DEFAULT_DELAY, budget_ratio=HEDGE_BUDGET_RATIO):
+        self.window = window
+        self.min_samples = min_samples
+        self.default_delay = default_delay
+        self.budget_ratio = budget_ratio
+        self._latencies = {}  # 機能名 -> 応答時間のdeque
+        self._hedged = deque(maxlen=window)  # 最近のリクエストごとの記録（ヘッジを送ったか）
+
+    def record(self, feature, latency):
+        latencies = self._latencies.get(feature)
+        if latencies is None:
+            latencies = self._latencies[feature] = deque(maxlen=self.window)
+        latencies.append(latency)
+
+    def threshold(self, feature):
+        """観測した応答時間のp90（記録が少ないうちは既定値）"""
+        latencies = self._latencies.get(feature)
+        if not latencies or len(latencies) < self.min_samples:
+            return self.default_delay
+        ordered = sorted(latencies)
+        return max(1.0, ordered[int(len(ordered) * 0.9) - 1])
+
+    def start_request(self):
+        """リクエストの記録を追加して返す（同時に走る他のリクエストと区別するためtry_hedgeに渡す）"""
+        request = {"hedged": False}
+        self._hedged.append(request)
+        return request
+
+    def try_hedge(self, request):
+        """追加リクエストの割合が上限以内ならヘッジを送ってよい"""
+        hedged_count = sum(1 for item in self._hedged if item["hedged"])
+        if hedged_count + 1 > self.budget_ratio * len(self._hedged):
+            return False
+        request["hedged"] = True
+        return True
+
+latency_tracker = LatencyTracker()
+
+async def hedged_request(feature, attempt, discard=None):
+    """応答が遅いときに同じリクエストをもう1つ送り、先に返ってきた方を使う
+
+    attempt は1回分のリクエストを行うコルーチン関数。負けた方はキャンセルし、
+    すでに完了していた場合は discard で後始末する。
+    """
+    if not HEDGED_REQUESTS or feature not in HEDGE_FEATURES:
+        return await attempt()
+
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    request = latency_tracker.start_request()
+    delay = latency_tracker.threshold(feature)
+    first = asyncio.create_task(attempt())
+    done, _ = await asyncio.wait({first}, timeout=delay)
+    if done or not latency_tracker.try_hedge(request):
+        result = await first
+        latency_tracker.record(feature, loop.time() - started)
+        return result
+
+    logger.info(f"応答が{delay:.1f}秒を超えたため追加リクエストを送ります: {feature}")
+    pending = {first, asyncio.create_task(attempt())}
+    error = None
     try:
-        logger.info(f"画像生成開始: テキスト='{praise_text}'")
-        
-        # 画像のサイズを指定
-        width = 1080
-        height = 1520
-        
-        # 画像の背景色を指定
-        background_color = (255, 255, 255)
-        
-        # 画像を生成
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winners = [task for task in done if task.exception() is None]
+            if not winners:
+                error = next(iter(done)).exception()
+                continue
+            latency_tracker.record(feature, loop.time() - started)
+            # 同時に完了した負けた方の結果を後始末する
+            for task in winners[1:]:
+                if discard:
+                    await discard(task.result())
+            return winners[0].result()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+# プロンプトキャッシュの利用状況
+class PromptCacheStats:
+    """機能ごとの入力トークン数と、そのうちプロバイダー側でキャッシュされたトークン数を集計する"""
+    def __init__(self):
+        self._totals = {}  # 機能名 -> {"requests", "prompt_tokens", "cached_tokens"}
+
+    def record(self, feature, usage):
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", None) or 0
+        totals = self._totals.setdefault(feature, {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0})
+        totals["requests"] += 1
+        totals["prompt_tokens"] += getattr(usage, "prompt_tokens", 0) or 0
+        totals["cached_tokens"] += cached_tokens
+
+    def summary(self):
+        """機能ごとの集計とキャッシュヒット率（/stats で表示）"""
+        result = {}
+        for feature, totals in self._totals.items():
+            rate = totals["cached_tokens"] / totals["prompt_tokens"] if totals["prompt_tokens"] else 0.0
+            result[feature] = {**totals, "hit_rate": rate}
+        return result
+
+prompt_cache_stats = PromptCacheStats()
+
+# 生成結果のキャッシュ
+class GenerationCache:
+    """機能・モデル・システムプロンプト・入力テキストのハッシュをキーに生成結果を保持する（LRU・有効期限付き）"""
+    def __init__(self, max_size=GENERATION_CACHE_SIZE, ttl=GENERATION_CACHE_TTL, path=GENERATION_CACHE_PATH,
+                 include_praise=GENERATION_CACHE_PRAISE):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = Path(path) if path else None
+        self.include_praise = include_praise
+        self._entries = OrderedDict()  # キー -> (有効期限のUNIX時刻, 生成結果)
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    def enabled_for(self, feature):
+        """キャッシュ対象の機能か（褒めはランダム性を残すため既定では対象外）"""
+        if self.max_size <= 0:
+            return False
+        # まとめて生成する場合は "x_post+heart_praise" のように機能名が連結される
+        return "heart_praise" not in feature.split("+") or self.include_praise
+
+    @staticmethod
+    def make_key(feature, model, messages):
+        payload = json.dumps([feature, model, messages], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.time():
+            if entry is not None:
+                del self._entries[key]
+                self._dirty = True
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, content):
+        self._entries[key] = (time.time() + self.ttl, content)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        self._dirty = True
+
+    def load(self):
+        """ディスクに保存されたキャッシュを読み込む（保存先が未設定なら何もしない）"""
+        if not self.path or not self.path.exists():
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            now = time.time()
+            for key, (expires_at, content) in data.items():
+                if expires_at >= now:
+                    self._entries[key] = (expires_at, content)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            logger.info(f"生成キャッシュを読み込みました: {len(self._entries)}件")
+        except Exception as e:
+            logger.error(f"生成キャッシュ読み込みエラー: {e}")
+
+    def _write(self, snapshot):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    async def flush(self):
+        """変更があればディスクに書き込む"""
+        if not self.path or not self._dirty:
+            return
+        snapshot = {key: list(entry) for key, entry in self._entries.items()}
+        self._dirty = False
+        try:
+            await asyncio.to_thread(self._write, snapshot)
+        except Exception as e:
+            self._dirty = True
+            logger.error(f"生成キャッシュ保存エラー: {e}")
+
+# 生成キャッシュのインスタンスを作成
+generation_cache = GenerationCache()
+
+@tasks.loop(seconds=GENERATION_CACHE_FLUSH_INTERVAL)
+async def flush_generation_cache_task():
+    """生成キャッシュを定期的に書き込む（エラーはflush内で記録する）"""
+    await generation_cache.flush()
+
+def make_praise_image(praise_text):
+    """褒めメッセージ画像を生成する"""
+    try:
+        logger.info(f"画像生成開始: テキスト='{praise_text}'")
+        
+        # 画像のサイズを指定
+        width = 1080
+        height = 1520
+        
+        # 画像の背景色を指定
+        background_color = (255, 255, 255)
+        
+        # 画像を生成
         image = Image.new("RGB", (width, height), background_color)
         logger.info("ベース画像作成完了")
         
@@ -706,8 +1938,229 @@ def shorten_url(long_url):
         logger.error(f"URL短縮予期しないエラー: {e}")
         return long_url
 
+class FFmpegError(Exception):
+    """ffmpeg / ffprobe の実行に失敗した"""
+
+async def run_ffmpeg_command(*args):
+    """ffmpeg系のコマンドをサブプロセスで実行して標準出力・標準エラー出力を返す（音声をPythonのメモリに展開しない）"""
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *args,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+    except FileNotFoundError as e:
+        raise FFmpegError(f"{args[0]} が見つかりません。FFmpegがインストールされているか確認してください") from e
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=FFMPEG_TIMEOUT)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise FFmpegError(f"{args[0]} の処理が{FFMPEG_TIMEOUT:.0f}秒以内に終わりませんでした") from None
+    except asyncio.CancelledError:
+        # 処理が中断された場合もプロセスを残さない
+        process.kill()
+        await process.wait()
+        raise
+    if process.returncode != 0:
+        detail = stderr.decode('utf-8', errors='replace').strip()[-500:]
+        raise FFmpegError(f"{args[0]} がエラー終了しました (code={process.returncode}): {detail}")
+    return stdout, stderr
+
+async def probe_audio_duration(file_path):
+    """ffprobeで音声の長さ（秒）を取得する（ファイル全体はデコードしない）"""
+    output, _ = await run_ffmpeg_command(
+        "ffprobe", "-v", "error",
+        "-show_entries", "format=duration",
+        "-of", "default=noprint_wrappers=1:nokey=1",
+        str(file_path)
+    )
+    try:
+        return float(output.decode().strip())
+    except ValueError:
+        raise FFmpegError(f"音声の長さを取得できませんでした: {file_path.name}") from None
+
+async def detect_silences(file_path):
+    """8kHzモノラルに落とした軽いsilencedetectで無音区間 [(開始秒, 終了秒), ...] を取得する"""
+    _, stderr = await run_ffmpeg_command(
+        "ffmpeg", "-hide_banner", "-nostats",
+        "-i", str(file_path),
+        "-vn", "-sn", "-dn",
+        "-af", f"aresample=8000,aformat=channel_layouts=mono,silencedetect=noise={SILENCE_NOISE_DB}dB:d={SILENCE_MIN_DURATION}",
+        "-f", "null", "-"
+    )
+    silences = []
+    silence_start = None
+    for line in stderr.decode('utf-8', errors='replace').splitlines():
+        start_match = re.search(r"silence_start: (-?[\d.]+)", line)
+        if start_match:
+            silence_start = max(0.0, float(start_match.group(1)))
+            continue
+        end_match = re.search(r"silence_end: ([\d.]+)", line)
+        if end_match and silence_start is not None:
+            silences.append((silence_start, float(end_match.group(1))))
+            silence_start = None
+    return silences
+
+def plan_split_points(duration, target_seconds, max_seconds, silences, tolerance=None):
+    """目標の長さ付近にある無音の中央で区切る位置（秒）を決める（各パートはmax_secondsを超えない）"""
+    if tolerance is None:
+        tolerance = SPLIT_SILENCE_TOLERANCE
+    target_seconds = min(target_seconds, max_seconds)
+    pauses = sorted((start + end) / 2 for start, end in silences)
+    cut_points = []
+    start = 0.0
+    # 残りが目標＋許容範囲（かつ上限）に収まれば最後のパートにする
+    while duration - start > min(target_seconds + tolerance, max_seconds):
+        ideal = start + target_seconds
+        latest = start + max_seconds
+        candidates = [pause for pause in pauses
+                      if abs(pause - ideal) <= tolerance and start < pause <= latest]
+        if candidates:
+            cut = min(candidates, key=lambda pause: abs(pause - ideal))
+        else:
+            # 近くに無音がなければ目標位置でそのまま切る
+            cut = min(ideal, latest)
+        cut_points.append(cut)
+        start = cut
+    return cut_points
+
+def plan_part_sizes(duration, size_mb):
+    """実際のファイルサイズから分割数と1パートの長さの上限（秒）を決める（25MBの上限を超えない）"""
+    # 目標サイズは上限の9割までにする（24kbpsに変換した音声なら20MBで約2時間）
+    target_size_mb = min(WHISPER_TARGET_UPLOAD_MB, WHISPER_MAX_UPLOAD_MB * 0.9)
+    split_count = max(1, math.ceil(size_mb / target_size_mb))
+    max_part_seconds = duration * (WHISPER_MAX_UPLOAD_MB * 0.9) / max(size_mb, 0.001)
+    # 長さの上限を設定した場合はそれも守る
+    if WHISPER_MAX_PART_SECONDS > 0:
+        split_count = max(split_count, math.ceil(duration / WHISPER_MAX_PART_SECONDS))
+        max_part_seconds = min(max_part_seconds, WHISPER_MAX_PART_SECONDS)
+    return split_count, max_part_seconds
+
+# 再エンコードせずにWhisperへ送れる音声コーデックと、ストリームコピー時に使う拡張子
+WHISPER_COPY_FORMATS = {
+    'aac': 'm4a',
+    'mp3': 'mp3',
+    'opus': 'ogg',
+    'vorbis': 'ogg',
+    'flac': 'flac',
+    'pcm_s16le': 'wav',
+}
+
+async def probe_audio_codec(file_path):
+    """ffprobeで最初の音声ストリームのコーデック名を取得する（取得できなければ空文字）"""
+    try:
+        output, _ = await run_ffmpeg_command(
+            "ffprobe", "-v", "error",
+            "-select_streams", "a:0",
+            "-show_entries", "stream=codec_name",
+            "-of", "default=noprint_wrappers=1:nokey=1",
+            str(file_path)
+        )
+    except FFmpegError as e:
+        logger.warning(f"音声コーデックの取得に失敗しました: {e}")
+        return ""
+    return output.decode().strip().lower()
+
+async def extract_audio_track(source_path, output_dir):
+    """動画から音声トラックだけを書き出す（Whisperがそのまま読めるコーデックなら再エンコードしない）"""
+    codec = await probe_audio_codec(source_path)
+    copy_ext = WHISPER_COPY_FORMATS.get(codec)
+    if copy_ext:
+        output_path = output_dir / f"extracted_audio.{copy_ext}"
+        codec_args = ["-c:a", "copy"]
+    else:
+        output_path = output_dir / "extracted_audio.mp3"
+        codec_args = ["-c:a", "libmp3lame"]
+    await run_ffmpeg_command(
+        "ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+        "-i", str(source_path),
+        "-vn", "-map", "0:a:0", *codec_args,
+        str(output_path)
+    )
+    logger.info(f"音声抽出: {codec or '不明'} → {output_path.name}（{'ストリームコピー' if copy_ext else '再エンコード'}）")
+    return output_path
+
+async def normalize_audio(source_path, output_dir):
+    """音声を16kHzモノラルの低ビットレート（Opusまたはmp3）に変換する（会話の文字起こしにはこれで十分）"""
+    if AUDIO_NORMALIZE_FORMAT == 'mp3':
+        output_path = output_dir / "normalized.mp3"
+        codec_args = ["-c:a", "libmp3lame", "-b:a", AUDIO_NORMALIZE_BITRATE]
+    else:
+        output_path = output_dir / "normalized.ogg"
+        codec_args = ["-c:a", "libopus", "-b:a", AUDIO_NORMALIZE_BITRATE, "-application", "voip"]
+    await run_ffmpeg_command(
+        "ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+        "-i", str(source_path),
+        "-vn", "-map", "0:a:0", "-ac", "1", "-ar", "16000", *codec_args,
+        str(output_path)
+    )
+    return output_path
+
+async def segment_audio(source_path, output_dir, cut_points, copy_ext=None):
+    """元ファイルからcut_points（秒）の位置で区切ったファイルを直接書き出し、順番どおりのパスを返す
+
+    copy_extを渡すとストリームコピーでその拡張子のまま切り出し、それ以外はmp3に変換する
+    """
+    ext = copy_ext or "mp3"
+    args = [
+        "ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+        "-i", str(source_path),
+        "-vn", "-map", "0:a:0", "-c:a", "copy" if copy_ext else "libmp3lame"
+    ]
+    if cut_points:
+        # segmentマルチプレクサで1回の読み込みのまま全パートを書き出す
+        args += [
+            "-f", "segment",
+            "-segment_times", ",".join(f"{point:.3f}" for point in cut_points),
+            "-reset_timestamps", "1",
+            str(output_dir / f"part_%03d.{ext}")
+        ]
+    else:
+        args.append(str(output_dir / f"part_000.{ext}"))
+    await run_ffmpeg_command(*args)
+    return sorted(output_dir.glob(f"part_*.{ext}"))
+
+async def transcribe_part(part_file_path, index, total):
+    """分割ファイル1つを文字起こしする（失敗したパートだけをやり直す）"""
+    for attempt in range(WHISPER_PART_RETRIES + 1):
+        logger.info(f"{index + 1}/{total}: {part_file_path.name} 文字起こし中...")
+        try:
+            # パスを渡してリトライ時にファイルを読み直せるようにする
+            transcription = await call_openai(
+                client_openai.audio.transcriptions.create,
+                model="whisper-1",
+                file=part_file_path,
+                language="ja"  # 日本語指定
+            )
+            logger.info(f"パート {index + 1} の文字起こし完了")
+            return transcription.text
+        except Exception as e:
+            if attempt >= WHISPER_PART_RETRIES:
+                raise
+            logger.warning(f"パート {index + 1} の文字起こしに失敗したため再試行します ({attempt + 1}/{WHISPER_PART_RETRIES}): {e}")
+            await asyncio.sleep(2 ** attempt)
+
+async def transcribe_parts(parts):
+    """分割ファイルを最大WHISPER_CONCURRENCY個ずつ並列に文字起こしし、元の順番で返す"""
+    semaphore = asyncio.Semaphore(WHISPER_CONCURRENCY)
+
+    async def run(index, part_file_path):
+        async with semaphore:
+            return await transcribe_part(part_file_path, index, len(parts))
+
+    tasks = [asyncio.create_task(run(i, part)) for i, part in enumerate(parts)]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        # 1つが最終的に失敗した場合は残りを止める
+        for task in tasks:
+            task.cancel()
+
 async def transcribe_audio(message, channel, reaction_user):
     """音声ファイルを文字起こしする"""
+    transcribed = False  # 文字起こし結果を受け取った後のエラーでは利用回数を戻さない
     try:
         
         # 音声・動画ファイルを検索
@@ -756,102 +2209,102 @@ async def transcribe_audio(message, channel, reaction_user):
             temp_path = Path(temp_dir)
             
             # ファイルをダウンロード
-            file_extension = target_attachment.filename.split('.')[-1]
+            file_extension = target_attachment.filename.split('.')[-1].lower()
             original_file_path = temp_path / f"original.{file_extension}"
             await target_attachment.save(original_file_path)
             
             logger.info(f"ファイルダウンロード完了: {target_attachment.filename} ({target_attachment.size} bytes)")
             
+            # 大きいファイルや対応していないコーデックは16kHzモノラルの低ビットレートに変換してから分割を決める
+            # （そのまま送れる小さいファイルは変換しない）
+            audio_file_path = None
+            original_size_mb = target_attachment.size / (1024 * 1024)
+            if AUDIO_NORMALIZE:
+                source_codec = await probe_audio_codec(original_file_path)
+                if original_size_mb > AUDIO_NORMALIZE_MIN_MB or source_codec not in WHISPER_COPY_FORMATS:
+                    try:
+                        logger.info("音声を16kHzモノラルに変換中...")
+                        audio_file_path = await normalize_audio(original_file_path, temp_path)
+                        logger.info(f"音声変換完了: {original_size_mb:.1f}MB → {audio_file_path.stat().st_size / (1024 * 1024):.1f}MB")
+                    except FFmpegError as e:
+                        logger.warning(f"音声の変換に失敗したため元の音声で処理します: {e}")
+            
             # 動画の場合は音声を抽出
-            if is_video:
+            if audio_file_path is None and is_video:
                 try:
                     logger.info("動画から音声を抽出中...")
-                    video = AudioSegment.from_file(original_file_path)
-                    audio_file_path = temp_path / "extracted_audio.mp3"
-                    video.export(audio_file_path, format="mp3")
+                    audio_file_path = await extract_audio_track(original_file_path, temp_path)
                     logger.info("音声抽出完了")
                 except Exception as e:
                     logger.error(f"音声抽出エラー: {e}")
                     await channel.send("❌ 動画から音声の抽出に失敗しました。")
                     return
-            else:
+            elif audio_file_path is None:
                 audio_file_path = original_file_path
             
             logger.info(f"処理対象ファイル: {audio_file_path}")
             
-            # 音声ファイルを読み込み
+            # 音声の長さを確認し、分割処理を決定（ffprobeで取得するのでファイル全体は読み込まない）
             try:
-                audio = AudioSegment.from_file(audio_file_path)
+                audio_length_sec = await probe_audio_duration(audio_file_path)
             except Exception as e:
                 logger.error(f"音声ファイル読み込みエラー: {e}")
                 await channel.send("❌ 音声ファイルの読み込みに失敗しました。対応形式か確認してください。")
                 return
-            
-            # 音声の長さを確認し、分割処理を決定
-            audio_length_ms = len(audio)
-            audio_length_sec = audio_length_ms / 1000
             logger.info(f"音声長: {audio_length_sec:.2f}秒")
             
             # ファイルサイズに基づいて分割数を計算
-            # 25MB制限を考慮して安全に20MBを目標とする
-            target_size_mb = 20
+            # 変換・抽出した場合はその後のサイズを使用、そのまま送る場合は元ファイルサイズを使用
+            actual_size_mb = audio_file_path.stat().st_size / (1024 * 1024)
+            logger.info(f"処理対象の音声サイズ: {actual_size_mb:.1f}MB")
             
-            # 動画の場合は抽出されたMP3のサイズを使用、音声の場合は元ファイルサイズを使用
-            if is_video:
-                actual_size_mb = audio_file_path.stat().st_size / (1024 * 1024)
-                logger.info(f"動画から抽出されたMP3サイズ: {actual_size_mb:.1f}MB")
-            else:
-                actual_size_mb = target_attachment.size / (1024 * 1024)
-                logger.info(f"音声ファイルサイズ: {actual_size_mb:.1f}MB")
-            
-            time_based_split_count = max(1, int(audio_length_ms // (600 * 1000)))  # 10分基準
-            size_based_split_count = max(1, int(actual_size_mb / target_size_mb))  # 実際のサイズ基準
+            split_count, max_part_seconds = plan_part_sizes(audio_length_sec, actual_size_mb)
+            logger.info(f"{split_count}分割で処理します（1パート最大{max_part_seconds:.0f}秒）")
             
-            # より大きい分割数を採用（安全のため）
-            split_count = max(time_based_split_count, size_based_split_count)
-            logger.info(f"時間基準: {time_based_split_count}分割, サイズ基準: {size_based_split_count}分割 → {split_count}分割で処理します")
+            # 音声ファイルを分割（ffmpegが元ファイルから直接切り出すのでメモリ使用量は長さに依存しない）
+            part_duration = audio_length_sec / split_count
+            cut_points = []
+            if split_count > 1:
+                # 単語の途中で切らないよう、目標の長さ付近の無音で区切る（25MBの上限は超えない）
+                try:
+                    silences = await detect_silences(audio_file_path)
+                except FFmpegError as e:
+                    logger.warning(f"無音検出に失敗したため等間隔で分割します: {e}")
+                    silences = []
+                cut_points = plan_split_points(audio_length_sec, part_duration, max_part_seconds, silences)
+                logger.info(f"無音区間: {len(silences)}件, 分割位置: {', '.join(f'{point:.1f}秒' for point in cut_points)}")
             
-            # 音声ファイルを分割
-            parts = []
-            part_duration = audio_length_ms // split_count
+            # Whisperがそのまま読めるコーデックなら再エンコードしない
+            copy_ext = WHISPER_COPY_FORMATS.get(await probe_audio_codec(audio_file_path))
+            if not cut_points and copy_ext and actual_size_mb <= WHISPER_MAX_UPLOAD_MB * 0.95:
+                # 上限内の1ファイルで済む場合は変換せずにそのまま送る
+                logger.info(f"変換せずにそのまま送信します: {audio_file_path.name}")
+                parts = [audio_file_path]
+            else:
+                parts = await segment_audio(audio_file_path, temp_path, cut_points, copy_ext=copy_ext)
             
-            for i in range(split_count):
-                start_time = i * part_duration
-                end_time = min((i + 1) * part_duration, audio_length_ms)
-                part_audio = audio[start_time:end_time]
-                part_file_path = temp_path / f"part_{i}.mp3"
-                part_audio.export(part_file_path, format="mp3")
-                
+            for part_file_path in parts:
                 # 分割ファイルのサイズをチェック
                 part_size_mb = part_file_path.stat().st_size / (1024 * 1024)
-                parts.append(part_file_path)
-                logger.info(f"分割ファイル作成: part_{i}.mp3 ({start_time}ms～{end_time}ms, {part_size_mb:.1f}MB)")
+                logger.info(f"分割ファイル作成: {part_file_path.name} ({part_size_mb:.1f}MB)")
             
-            # Whisperで各分割ファイルを文字起こし
+            # Whisperで各分割ファイルを並列に文字起こし（結果は元の順番に並べる）
             logger.info("Whisperによる文字起こし開始")
-            full_transcription = ""
-            
-            for idx, part_file_path in enumerate(parts):
-                logger.info(f"{idx+1}/{split_count}: {part_file_path.name} 文字起こし中...")
-                
-                try:
-                    with open(part_file_path, "rb") as audio_file:
-                        transcription = client_openai.audio.transcriptions.create(
-                            model="whisper-1",
-                            file=audio_file,
-                            language="ja"  # 日本語指定
-                        )
-                        full_transcription += transcription.text + "\n"
-                        logger.info(f"パート {idx+1} の文字起こし完了")
-                except Exception as api_error:
-                    logger.error(f"Whisper API エラー (パート {idx+1}): {api_error}")
-                    # タイムアウトエラーの場合は特別なメッセージ
-                    if "timeout" in str(api_error).lower() or "timed out" in str(api_error).lower():
-                        await channel.send(f"{reaction_user.mention} ⏰ 申し訳ありません！文字起こし処理がタイムアウトしました。\n音声ファイルが大きいか、OpenAI APIが混雑している可能性があります。\n🔄 少し時間をおいてもう一度試してみてください。")
-                    else:
-                        await channel.send(f"{reaction_user.mention} ❌ 文字起こし処理中にエラーが発生しました。\n🔄 もう一度試してみてください。")
-                    return
+            try:
+                texts = await transcribe_parts(parts)
+                full_transcription = "".join(text + "\n" for text in texts)
+            except Exception as api_error:
+                logger.error(f"Whisper API エラー: {api_error}")
+                # 失敗した場合は利用回数を戻す
+                quota_counter.refund(str(reaction_user.id))
+                # タイムアウトエラーの場合は特別なメッセージ
+                if "timeout" in str(api_error).lower() or "timed out" in str(api_error).lower():
+                    await channel.send(f"{reaction_user.mention} ⏰ 申し訳ありません！文字起こし処理がタイムアウトしました。\n音声ファイルが大きいか、OpenAI APIが混雑している可能性があります。\n🔄 少し時間をおいてもう一度試してみてください。")
+                else:
+                    await channel.send(f"{reaction_user.mention} ❌ 文字起こし処理中にエラーが発生しました。\n🔄 もう一度試してみてください。")
+                return
             
+            transcribed = True
             logger.info(f"文字起こし完了: {len(full_transcription)}文字")
             
             # 文字起こし結果をテキストファイルとして保存
@@ -897,6 +2350,8 @@ async def transcribe_audio(message, channel, reaction_user):
             
     except Exception as e:
         logger.error(f"音声文字起こしエラー: {e}")
+        if not transcribed:
+            quota_counter.refund(str(reaction_user.id))
         await channel.send("❌ 文字起こし処理中にエラーが発生しました。")
 
 @bot.event
@@ -904,6 +2359,16 @@ async def on_ready():
     """Bot起動時の処理"""
     print(f'{bot.user} にログインしました')
     
+    # プレミアム会員キャッシュを作成（再接続時も作り直す）
+    try:
+        community_guild = bot.get_guild(int(settings.get("community_server_id")))
+        if community_guild:
+            premium_members.rebuild(community_guild)
+        else:
+            logger.warning(f"Community server not found: {settings.get('community_server_id')}")
+    except Exception as e:
+        logger.error(f"プレミアム会員キャッシュ作成エラー: {e}")
+    
     # 登録されているコマンドを確認
     print(f"登録されているコマンド数: {len(bot.tree.get_commands())}")
     for cmd in bot.tree.get_commands():
@@ -938,6 +2403,24 @@ async def on_ready():
         import traceback
         logger.error(traceback.format_exc())
 
+@bot.event
+async def on_member_update(before, after):
+    """コミュニティサーバーのロール変更をプレミアム会員キャッシュに反映"""
+    if PremiumMemberCache.is_community_guild(after.guild) and before.roles != after.roles:
+        premium_members.update_member(after)
+
+@bot.event
+async def on_member_join(member):
+    """コミュニティサーバーへの参加をプレミアム会員キャッシュに反映"""
+    if PremiumMemberCache.is_community_guild(member.guild):
+        premium_members.update_member(member)
+
+@bot.event
+async def on_member_remove(member):
+    """コミュニティサーバーからの退出をプレミアム会員キャッシュに反映"""
+    if PremiumMemberCache.is_community_guild(member.guild):
+        premium_members.remove_member(member.id)
+
 @bot.tree.command(name="help", description="利用可能なコマンド一覧を表示します")
 async def help_command(interaction: discord.Interaction):
     """ヘルプコマンド"""
@@ -1006,7 +2489,7 @@ class CustomPromptModal(discord.ui.Modal, title='X投稿用カスタムプロン
             
             # ユーザーデータを読み込み（存在しない場合は新規作成）
             user_id = interaction.user.id
-            user_data = load_user_data(user_id)
+            user_data = await user_store.get(user_id)
             if user_data is None:
                 user_data = {
                     "custom_prompt_x_post": "",
@@ -1018,8 +2501,8 @@ class CustomPromptModal(discord.ui.Modal, title='X投稿用カスタムプロン
             # カスタムプロンプトを更新
             user_data["custom_prompt_x_post"] = prompt
             
-            # ユーザーデータを保存
-            save_user_data(user_id, user_data)
+            # ユーザーデータを保存（ストア経由で書き戻す）
+            user_store.put(user_id, user_data)
             
             # 設定内容に応じてメッセージを変更
             if prompt:
@@ -1043,7 +2526,7 @@ async def set_custom_prompt_x_post_command(interaction: discord.Interaction):
     """カスタムプロンプト設定コマンド"""
     # 既存のユーザーデータを読み込み
     user_id = interaction.user.id
-    user_data = load_user_data(user_id)
+    user_data = await user_store.get(user_id)
     current_prompt = ""
     if user_data and "custom_prompt_x_post" in user_data:
         current_prompt = user_data["custom_prompt_x_post"]
@@ -1072,7 +2555,7 @@ class CustomArticlePromptModal(discord.ui.Modal, title='記事作成用カスタ
             
             # ユーザーデータを読み込み（存在しない場合は新規作成）
             user_id = interaction.user.id
-            user_data = load_user_data(user_id)
+            user_data = await user_store.get(user_id)
             if user_data is None:
                 user_data = {
                     "custom_prompt_x_post": "",
@@ -1086,8 +2569,8 @@ class CustomArticlePromptModal(discord.ui.Modal, title='記事作成用カスタ
             # 記事用カスタムプロンプトを更新
             user_data["custom_prompt_article"] = prompt
             
-            # ユーザーデータを保存
-            save_user_data(user_id, user_data)
+            # ユーザーデータを保存（ストア経由で書き戻す）
+            user_store.put(user_id, user_data)
             
             # 設定内容に応じてメッセージを変更
             if prompt:
@@ -1111,7 +2594,7 @@ async def set_custom_prompt_article_command(interaction: discord.Interaction):
     """記事用カスタムプロンプト設定コマンド"""
     # 既存のユーザーデータを読み込み
     user_id = interaction.user.id
-    user_data = load_user_data(user_id)
+    user_data = await user_store.get(user_id)
     current_prompt = ""
     if user_data and "custom_prompt_article" in user_data:
         current_prompt = user_data["custom_prompt_article"]
@@ -1139,7 +2622,7 @@ class CustomMemoPromptModal(discord.ui.Modal, title='メモ作成用カスタム
             
             # ユーザーデータを読み込み（存在しない場合は新規作成）
             user_id = interaction.user.id
-            user_data = load_user_data(user_id)
+            user_data = await user_store.get(user_id)
             if user_data is None:
                 user_data = {
                     "custom_prompt_x_post": "",
@@ -1153,8 +2636,8 @@ class CustomMemoPromptModal(discord.ui.Modal, title='メモ作成用カスタム
             # メモ用カスタムプロンプトを更新
             user_data["custom_prompt_memo"] = prompt
             
-            # ユーザーデータを保存
-            save_user_data(user_id, user_data)
+            # ユーザーデータを保存（ストア経由で書き戻す）
+            user_store.put(user_id, user_data)
             
             # 設定内容に応じてメッセージを変更
             if prompt:
@@ -1178,7 +2661,7 @@ async def set_custom_prompt_memo_command(interaction: discord.Interaction):
     """メモ用カスタムプロンプト設定コマンド"""
     # 既存のユーザーデータを読み込み
     user_id = interaction.user.id
-    user_data = load_user_data(user_id)
+    user_data = await user_store.get(user_id)
     current_prompt = ""
     if user_data and "custom_prompt_memo" in user_data:
         current_prompt = user_data["custom_prompt_memo"]
@@ -1213,6 +2696,7 @@ async def activate_command(interaction: discord.Interaction):
     if channel_id not in server_data['active_channel_ids']:
         server_data['active_channel_ids'].append(channel_id)
         save_server_data(server_id, server_data)
+        active_channels.set_channels(server_id, server_data['active_channel_ids'])
         
         # 使い方ガイドメッセージを作成
         guide_message = (
@@ -1276,6 +2760,7 @@ async def deactivate_command(interaction: discord.Interaction):
     if channel_id in server_data['active_channel_ids']:
         server_data['active_channel_ids'].remove(channel_id)
         save_server_data(server_id, server_data)
+        active_channels.set_channels(server_id, server_data['active_channel_ids'])
         await interaction.response.send_message(f"✅ このチャンネル（{interaction.channel.name}）でBotを無効化しました。")
     else:
         await interaction.response.send_message(f"ℹ️ このチャンネル（{interaction.channel.name}）は既に無効です。")
@@ -1336,7 +2821,8 @@ async def stats_command(interaction: discord.Interaction):
         return
     
     try:
-        # 統計を計算
+        # 統計を計算（未書き込みの記録を先に保存）
+        await stats_manager.flush()
         stats = stats_manager.get_stats_summary()
         server_count = len(bot.guilds)
         
@@ -1349,10 +2835,29 @@ async def stats_command(interaction: discord.Interaction):
         embed.add_field(name="🏠 現在のサーバー数", value=f"{server_count:,}", inline=True)
         embed.add_field(name="🏠 記録時サーバー数", value=f"{stats['server_count']:,}", inline=True)
         embed.add_field(name="📈 DAU", value=f"{stats['dau']:,}", inline=True)
+        embed.add_field(name="📅 WAU", value=f"{stats['wau']:,}", inline=True)
         embed.add_field(name="📊 MAU", value=f"{stats['mau']:,}", inline=True)
         embed.add_field(name="⚡ 今日のアクション数", value=f"{stats['total_actions_today']:,}", inline=True)
         embed.add_field(name="🕐 更新時刻", value=datetime.now().strftime("%H:%M:%S"), inline=True)
         
+        # OpenAIレート制限の状態（モデルごとの残り枠・待機数）
+        for model, state in rate_limiter.snapshot().items():
+            lines = []
+            if state["rpm_limit"]:
+                lines.append(f"RPM: {state['rpm_available']:,}/{state['rpm_limit']:,}")
+            if state["tpm_limit"]:
+                lines.append(f"TPM: {state['tpm_available']:,}/{state['tpm_limit']:,}")
+            lines.append(f"待機中: {state['waiting']} / 待機発生: {state['throttled']:,}回（計{state['total_wait']}秒）")
+            embed.add_field(name=f"⏱️ {model}", value="\n".join(lines), inline=False)
+        
+        # プロンプトキャッシュの利用状況（機能ごとのキャッシュされた入力トークンの割合）
+        cache_lines = [
+            f"{feature}: {totals['hit_rate']:.0%}（{totals['cached_tokens']:,}/{totals['prompt_tokens']:,}トークン、{totals['requests']:,}回）"
+            for feature, totals in prompt_cache_stats.summary().items()
+        ]
+        if cache_lines:
+            embed.add_field(name="🧠 プロンプトキャッシュ", value="\n".join(cache_lines)[:1024], inline=False)
+        
         await interaction.response.send_message(embed=embed, ephemeral=True)
         
     except Exception as e:
@@ -1393,6 +2898,1204 @@ async def restart_command(interaction: discord.Interaction):
         logger.error(f"再起動コマンドエラー: {e}")
         await interaction.followup.send("❌ 再起動中にエラーが発生しました。", ephemeral=True)
 
+async def collect_input_text(message):
+    """メッセージ本文・Embed・添付テキストファイルから入力テキストを組み立てる"""
+    # まとめて処理中のリアクションは組み立て済みの入力を使う
+    batch = batch_results.get()
+    if batch is not None:
+        return batch["input_text"]
+
+    input_text = message.content
+    
+    # Embedがある場合は内容を抽出
+    embed_content = extract_embed_content(message)
+    if embed_content:
+        if input_text:
+            input_text += f"\n\n【Embed内容】\n{embed_content}"
+        else:
+            input_text = embed_content
+        logger.info("Embed内容を追加")
+    
+    # 添付ファイルがある場合、テキストファイルの内容を読み取り
+    if message.attachments:
+        for attachment in message.attachments:
+            file_content = await read_text_attachment(attachment)
+            if file_content:
+                if input_text:
+                    input_text += f"\n\n【ファイル: {attachment.filename}】\n{file_content}"
+                else:
+                    input_text = f"【ファイル: {attachment.filename}】\n{file_content}"
+                logger.info(f"添付ファイルの内容を追加: {attachment.filename}")
+    
+    return input_text
+
+def extract_partial_json_content(buffer):
+    """生成途中のJSON文字列から "content" の値をできるところまで取り出す"""
+    match = re.search(r'"content"\s*:\s*"', buffer)
+    if not match:
+        return ""
+    raw = buffer[match.end():]
+    # 値が閉じていれば閉じ引用符以降を落とす
+    raw = re.sub(r'"\s*\}?\s*$', '', raw)
+    # 末尾の書きかけのエスケープ（最大6文字）を削りながらデコードする
+    for cut in range(7):
+        try:
+            return json.loads('"' + raw[:len(raw) - cut] + '"')
+        except json.JSONDecodeError:
+            continue
+    return raw
+
+def record_stream_failure(model, error):
+    """ストリームの受信中の失敗をサーキットブレーカーに記録する（キャンセルは失敗として数えない）"""
+    if isinstance(error, Exception):
+        logger.warning(f"{model} のストリーミングが途中で失敗しました: {error}")
+        get_circuit_breaker(model).record_failure()
+
+async def close_stream(opened):
+    """使わなかったストリームを閉じる"""
+    try:
+        await opened[0].close()
+    except Exception as e:
+        logger.debug(f"ストリームのクローズエラー: {e}")
+
+async def stream_chat_completion(channel, header, render=None, feature=None, **kwargs):
+    """チャット補完をストリーミングで受け取り、途中経過を1つのメッセージの編集で表示する
+
+    編集はSTREAM_EDIT_INTERVAL秒に1回までに抑える。最初の文字が届いた時点でメッセージを作成し、
+    (生成された全文, 途中経過のメッセージ) を返す。ストリーミング無効時はメッセージはNone。
+    ストリームを開くまではcall_openaiでリトライするが、受信の途中で失敗した場合は途中経過を
+    表示済みのためリトライせず、サーキットブレーカーに失敗として記録してエラーにする。
+    """
+    if not STREAM_RESPONSES:
+        response = await hedged_request(feature, lambda: call_openai(client_openai.chat.completions.create, **kwargs))
+        prompt_cache_stats.record(feature, getattr(response, "usage", None))
+        return response.choices[0].message.content, None
+
+    async def open_stream():
+        # ストリームを開いて本文の最初の文字が届くまで待つ（最後のチャンクで使用量を受け取る）
+        used = {}
+
+        async def create(**call_kwargs):
+            # 代替モデルに切り替わった場合も、実際に呼び出したモデルの失敗として記録する
+            used["model"] = call_kwargs.get("model")
+            return await client_openai.chat.completions.create(**call_kwargs)
+
+        stream = await call_openai(create, used, stream=True, stream_options={"include_usage": True}, **kwargs)
+        iterator = stream.__aiter__()
+        first_chunks = []
+        finished = False
+        try:
+            # 最初に届くroleだけのチャンクでは応答時間に数えない
+            while True:
+                chunk = await iterator.__anext__()
+                first_chunks.append(chunk)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    break
+        except StopAsyncIteration:
+            finished = True
+        except BaseException as e:
+            await close_stream((stream,))
+            record_stream_failure(used["model"], e)
+            raise
+        return stream, iterator, first_chunks, finished, used
+
+    # 最初の文字が届くのが遅い場合は追加リクエストを送り、先に応答した方を使う
+    _, iterator, first_chunks, finished, used = await hedged_request(feature, open_stream, discard=close_stream)
+    used_model = used["model"]
+    loop = asyncio.get_running_loop()
+    progress_message = None
+    last_edit = 0.0
+    shown = ""
+    parts = []
+
+    async def show(text):
+        nonlocal progress_message, last_edit, shown
+        if not text or text == shown:
+            return
+        # Discordのメッセージ上限（2000文字）に収まるよう末尾を表示する
+        body = text if len(text) <= 1800 else "…" + text[-1800:]
+        content = f"{header}\n{body} ▌"
+        try:
+            if progress_message is None:
+                progress_message = await channel.send(content)
+            else:
+                await progress_message.edit(content=content)
+            shown = text
+        except Exception as e:
+            logger.warning(f"途中経過の表示エラー: {e}")
+        last_edit = loop.time()
+
+    async def handle(chunk):
+        if getattr(chunk, "usage", None):
+            prompt_cache_stats.record(feature, chunk.usage)
+            # レート制限で確保した見積もり（入力＋最大出力）を実際の使用量で補正する
+            if "settle" in used:
+                used["settle"](getattr(chunk.usage, "total_tokens", None))
+        if not chunk.choices:
+            return
+        delta = chunk.choices[0].delta.content
+        if not delta:
+            return
+        parts.append(delta)
+        if progress_message is None or loop.time() - last_edit >= STREAM_EDIT_INTERVAL:
+            full_text = "".join(parts)
+            await show(render(full_text) if render else full_text)
+
+    try:
+        for chunk in first_chunks:
+            await handle(chunk)
+        while not finished:
+            try:
+                chunk = await iterator.__anext__()
+            except StopAsyncIteration:
+                break
+            except Exception as e:
+                record_stream_failure(used_model, e)
+                raise
+            await handle(chunk)
+    except Exception:
+        # 途中で止まった文章（▌付き）をチャンネルに残さない
+        if progress_message is not None:
+            try:
+                await progress_message.delete()
+            except Exception as e:
+                logger.warning(f"途中経過の削除エラー: {e}")
+        raise
+
+    return "".join(parts), progress_message
+
+async def replace_progress_message(progress_message, channel, content):
+    """途中経過のメッセージ（▌付き）をエラーメッセージに差し替える（なければ新しく送信する）"""
+    if progress_message is not None:
+        try:
+            await progress_message.edit(content=content, embed=None)
+            return
+        except Exception as e:
+            logger.warning(f"途中経過の差し替えエラー: {e}")
+    await channel.send(content)
+
+# 生成中のリクエスト（キャッシュキー -> 結果を受け取るFuture）
+inflight_generations = {}
+
+# まとめて処理中のリアクションの入力テキストと生成結果（{"input_text": ..., "outputs": {機能名: 生成結果}}）
+batch_results = contextvars.ContextVar("batch_results", default=None)
+
+async def generate_completion(feature, stream_to=None, header=None, render=None, **kwargs):
+    """機能ごとのテキスト生成（同じ入力の生成結果はキャッシュから返す）
+
+    stream_toにチャンネルを渡すと途中経過を表示しながら生成する。
+    (生成されたテキスト, 途中経過のメッセージ) を返す。
+    """
+    # まとめて生成済みの結果があればそれを使う
+    batch = batch_results.get()
+    if batch is not None and feature in batch["outputs"]:
+        logger.info(f"まとめて生成した結果を使用: {feature}")
+        return batch["outputs"].pop(feature), None
+
+    key = None
+    if generation_cache.enabled_for(feature):
+        key = generation_cache.make_key(feature, kwargs["model"], kwargs["messages"])
+        cached = generation_cache.get(key)
+        if cached is not None:
+            logger.info(f"生成キャッシュを使用: {feature}")
+            return cached, None
+
+        # 同じ内容を生成中なら、その結果を待って使い回す（利用回数はリクエストごとに消費済み）
+        pending = inflight_generations.get(key)
+        if pending is not None:
+            logger.info(f"生成中の同一リクエストの結果を待ちます: {feature}")
+            return await asyncio.shield(pending), None
+        pending = asyncio.get_running_loop().create_future()
+        inflight_generations[key] = pending
+
+    try:
+        if stream_to is not None:
+            content, progress_message = await stream_chat_completion(stream_to, header, render=render, feature=feature, **kwargs)
+        else:
+            response = await hedged_request(feature, lambda: call_openai(client_openai.chat.completions.create, **kwargs))
+            prompt_cache_stats.record(feature, getattr(response, "usage", None))
+            content, progress_message = response.choices[0].message.content, None
+    except BaseException as e:
+        if key:
+            inflight_generations.pop(key, None)
+            # 待っているリクエストにも失敗を伝える（中断された場合も通常のエラーとして扱う）
+            error = e if isinstance(e, Exception) else RuntimeError("生成が中断されました")
+            pending.set_exception(error)
+            pending.exception()  # 待機者がいなくても警告を出さない
+        raise
+
+    if key:
+        inflight_generations.pop(key, None)
+        pending.set_result(content)
+        if content:
+            generation_cache.put(key, content)
+    return content, progress_message
+
+# 機能ごとの入力トークン上限（settings.json の input_token_budgets でモデル別に上書き可能）
+FEATURE_INPUT_BUDGETS = {
+    "x_post": 6000,
+    "heart_praise": 4000,
+    "question_explain": 8000,
+    "pencil_memo": 12000,
+    "article": 12000,
+}
+
+# 長い入力を分割要約するときのプロンプト（機能ごとの用途を差し込む）
+MAP_PROMPT = "以下は長い文章を分割した一部です。後で{purpose}を作るための材料として、重要な情報・固有名詞・数値・結論を漏らさず、元の順序のまま要点を日本語で整理してください。"
+FEATURE_PURPOSES = {
+    "x_post": "X投稿用の要約",
+    "heart_praise": "褒めメッセージ",
+    "question_explain": "解説",
+    "pencil_memo": "メモ",
+    "article": "記事",
+}
+
+_token_encodings = {}
+
+def count_tokens(text, model):
+    """テキストのトークン数を数える（tiktokenがなければUTF-8のバイト数から概算）"""
+    if tiktoken is not None:
+        encoding = _token_encodings.get(model)
+        if encoding is None:
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                encoding = tiktoken.get_encoding("o200k_base")
+            _token_encodings[model] = encoding
+        return len(encoding.encode(text, disallowed_special=()))
+    # 日本語は1文字（3バイト）≒1トークン、英語は4文字≒1トークンなので多めに見積もる
+    return math.ceil(len(text.encode('utf-8')) / 3)
+
+def input_token_budget(feature, model):
+    """機能とモデルに応じた入力トークン上限を返す"""
+    budgets = settings.get("input_token_budgets", {}).get(model, {})
+    return int(budgets.get(feature, FEATURE_INPUT_BUDGETS.get(feature, 8000)))
+
+def split_text_by_tokens(text, max_tokens, model):
+    """行単位でまとめながら、各チャンクがmax_tokens以下になるよう分割する"""
+    chunks = []
+    current = []
+    current_tokens = 0
+    for line in text.split('\n'):
+        line_tokens = count_tokens(line, model) + 1
+        if line_tokens > max_tokens:
+            # 1行が長すぎる場合は文字数で切る
+            step = max(1, len(line) * max_tokens // line_tokens)
+            pieces = [line[i:i + step] for i in range(0, len(line), step)]
+        else:
+            pieces = [line]
+        for piece in pieces:
+            piece_tokens = count_tokens(piece, model) + 1
+            if current and current_tokens + piece_tokens > max_tokens:
+                chunks.append('\n'.join(current))
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        chunks.append('\n'.join(current))
+    return chunks
+
+async def fit_input_to_budget(feature, model, input_text, max_rounds=3):
+    """入力が上限を超える場合、分割して並列に要約し（map）、まとめた要点を最終生成（reduce）の入力にする"""
+    budget = input_token_budget(feature, model)
+    # 入力は最大1MBになるため、トークン化と分割はイベントループを止めないよう別スレッドで行う
+    tokens = await asyncio.to_thread(count_tokens, input_text, model)
+    if tokens <= budget:
+        return input_text
+
+    logger.info(f"入力が長いため分割要約します: {feature} ({tokens}トークン > 上限{budget})")
+    map_prompt = MAP_PROMPT.format(purpose=FEATURE_PURPOSES.get(feature, "出力"))
+    semaphore = asyncio.Semaphore(MAP_REDUCE_CONCURRENCY)
+
+    async def summarize(index, total, chunk):
+        async with semaphore:
+            content, _ = await generate_completion(
+                "input_digest",
+                model=FREE_USER_MODEL,
+                messages=[
+                    {"role": "system", "content": map_prompt},
+                    {"role": "user", "content": chunk}
+                ],
+                max_tokens=1000,
+                temperature=0.2
+            )
+        return f"【パート {index + 1}/{total}】\n{content or ''}"
+
+    text = input_text
+    for _ in range(max_rounds):
+        chunks = await asyncio.to_thread(split_text_by_tokens, text, min(MAP_CHUNK_TOKENS, budget), FREE_USER_MODEL)
+        digests = await asyncio.gather(*(summarize(i, len(chunks), chunk) for i, chunk in enumerate(chunks)))
+        text = '\n\n'.join(digests)
+        tokens = await asyncio.to_thread(count_tokens, text, model)
+        if tokens <= budget:
+            logger.info(f"分割要約完了: {len(chunks)}チャンク → {tokens}トークン")
+            return text
+
+    # それでも収まらない場合は上限に合わせて切り詰める
+    logger.warning(f"分割要約後も上限を超えたため切り詰めます: {feature}")
+    chunks = await asyncio.to_thread(split_text_by_tokens, text, budget, model)
+    return chunks[0]
+
+async def run_x_post(message, channel, user, user_data, is_premium):
+    """X投稿要約を作成する（👍）"""
+    # メッセージ内容・Embed・添付テキストファイルから入力テキストを取得
+    input_text = await collect_input_text(message)
+
+    if input_text:
+        # URL検出・警告
+        await check_content_for_urls(input_text, user, channel)
+
+        # モデルを選択
+        model = PREMIUM_USER_MODEL if is_premium else FREE_USER_MODEL
+
+        # 処理開始メッセージを送信
+        message_link = f"https://discord.com/channels/{message.guild.id}/{message.channel.id}/{message.id}"
+        await channel.send(f"{user.mention} X用の投稿を作ってあげるね〜！ちょっと待っててね\n📎 元メッセージ: {message_link}")
+
+        # X投稿用のカスタムプロンプトがあれば優先（メッセージはプロンプトレジストリで組み立てる）
+        custom_prompt = user_data.get('custom_prompt_x_post') if user_data else None
+        if custom_prompt:
+            logger.info(f"ユーザー {user.name} のカスタムプロンプトを使用")
+
+        # OpenAI APIで要約を生成
+        if client_openai:
+            generated = False  # 生成結果を受け取った後のエラーでは利用回数を戻さない
+            try:
+                # 入力が長すぎる場合は分割要約してトークン上限に収める
+                input_text = await fit_input_to_budget("x_post", model, input_text)
+
+                response_content, _ = await generate_completion(
+                    "x_post",
+                    model=model,
+                    messages=prompt_registry.build_messages("x_post", input_text, custom_prompt),
+                    max_tokens=1000,
+                    temperature=0.9,
+                    response_format={"type": "json_object"}
+                )
+                generated = True
+
+                # JSONレスポンスをパース
+                try:
+                    response_json = json.loads(response_content)
+                    summary = response_json.get("content", response_content)
+                except json.JSONDecodeError:
+                    logger.warning(f"JSON解析エラー、生のレスポンスを使用: {response_content}")
+                    summary = response_content
+
+                # X投稿用のURLを生成
+                x_intent_url = f"https://twitter.com/intent/tweet?text={urllib.parse.quote(summary)}"
+
+                # URLを短縮
+                shortened_url = await asyncio.to_thread(shorten_url, x_intent_url)
+
+                # 結果を送信（Discord制限に合わせて文字数制限）
+                # embed descriptionは4096文字制限、fieldは1024文字制限
+                display_summary = summary[:4000] + "..." if len(summary) > 4000 else summary
+
+                embed = discord.Embed(
+                    title="📝 X投稿用要約",
+                    description=display_summary,
+                    color=0x1DA1F2
+                )
+
+                embed.add_field(
+                    name="X投稿リンク👇",
+                    value=f"[クリックして投稿]({shortened_url})",
+                    inline=False
+                )
+
+                # 完了メッセージと結果を送信
+                await channel.send("🎉 できたよ〜！Xに投稿する場合は下のリンクをクリックしてね！")
+                await channel.send(embed=embed)
+
+            except Exception as e:
+                logger.error(f"OpenAI API エラー: {e}")
+                # 生成できなかった場合だけ利用回数を戻す（送信などの後続処理の失敗では戻さない）
+                if not generated:
+                    quota_counter.refund(str(user.id))
+                await channel.send(f"{user.mention} ❌ 要約の生成中にエラーが発生しました。")
+        else:
+            logger.error("エラー: OpenAI APIキーが設定されていません")
+            await channel.send(f"{user.mention} ❌ エラーが発生しました。管理者にお問い合わせください。")
+    else:
+        await channel.send(f"{user.mention} ⚠️ **X投稿を作成するためにはテキストが必要です**\n\n"
+                         f"以下のいずれかを行ってから👍リアクションしてください：\n"
+                         f"• テキストメッセージを投稿する\n"
+                         f"• テキストファイル（.txt）を添付する\n"
+                         f"• 音声ファイルの場合は🎤で文字起こしをしてからそのファイルに👍する\n\n"
+                         f"音声ファイルのみでは直接X投稿は作成できません。")
+
+async def run_transcribe(message, channel, user, user_data, is_premium):
+    """音声・動画を文字起こしする（🎤）"""
+    # 音声・動画ファイルがあるかチェック
+    if message.attachments:
+        await transcribe_audio(message, channel, user)
+    else:
+        await channel.send(f"{user.mention} ⚠️ **🎤は音声・動画の文字起こし専用です**\n\n"
+                         f"音声ファイル（mp3、wav、m4a等）または動画ファイル（mp4、mov等）が添付されたメッセージにリアクションしてください。\n\n"
+                         f"テキストのみのメッセージには🎤ではなく、以下のリアクションをお使いください：\n"
+                         f"• 👍 X投稿作成\n"
+                         f"• ❓ AI解説\n"
+                         f"• ❤️ 絶賛モード\n"
+                         f"• ✏️ 記事作成")
+
+async def run_praise(message, channel, user, user_data, is_premium):
+    """絶賛メッセージと褒め画像を作成する（❤️）"""
+    # メッセージ内容・Embed・添付テキストファイルから入力テキストを取得
+    input_text = await collect_input_text(message)
+
+    if input_text:
+        # URL検出・警告
+        await check_content_for_urls(input_text, user, channel)
+
+        # 処理開始メッセージを送信
+        message_link = f"https://discord.com/channels/{message.guild.id}/{message.channel.id}/{message.id}"
+        await channel.send(f"{user.mention} わー！褒めさせて〜！ちょっと待っててね✨\n📎 元メッセージ: {message_link}")
+
+        # モデルを選択
+        model = PREMIUM_USER_MODEL if is_premium else FREE_USER_MODEL
+
+        # OpenAI APIで褒めメッセージを生成（JSONモード）
+        if client_openai:
+            generated = False  # 生成結果を受け取った後のエラーでは利用回数を戻さない
+            try:
+                # 入力が長すぎる場合は分割要約してトークン上限に収める
+                input_text = await fit_input_to_budget("heart_praise", model, input_text)
+
+                response_content, _ = await generate_completion(
+                    "heart_praise",
+                    model=model,
+                    messages=prompt_registry.build_messages("heart_praise", input_text),
+                    max_tokens=1500,
+                    temperature=0.9,
+                    response_format={"type": "json_object"}
+                )
+                generated = True
+
+                # JSONレスポンスをパース
+                try:
+                    praise_json = json.loads(response_content)
+                    long_praise = praise_json.get("long_praise", "")
+                    short_praise = praise_json.get("short_praise", "")
+                except json.JSONDecodeError:
+                    logger.warning(f"JSON解析エラー、フォールバックを使用: {response_content}")
+                    long_praise = response_content[:400]
+                    short_praise = response_content[:20]
+
+                # 1. まず400字の激烈褒めをDiscordに投稿
+                if len(long_praise) > 400:
+                    long_praise = long_praise[:400] + "..."
+
+                await channel.send(long_praise)
+
+                # 2. 25字の短文褒めで画像を生成
+                if len(short_praise) > 25:
+                    short_praise = short_praise[:25]
+
+                # 画像生成用テキスト処理（絵文字除去）
+                image_text = re.sub(r'[^\u3040-\u309F\u30A0-\u30FF\u4E00-\u9FAF\u0021-\u007E]', '', short_praise)
+                image_text = image_text.replace("。", "").replace("、", "").replace(" ", "").replace("\n", "")
+
+                # 褒め画像を生成
+                image_path = make_praise_image(image_text)
+
+                # 3. 画像を送信
+                if image_path and os.path.exists(image_path):
+                    try:
+                        await channel.send("🎉 褒め画像をお作りしました！", file=discord.File(image_path))
+                        logger.info("褒め画像送信成功")
+                        # 一時ファイルを削除
+                        try:
+                            os.remove(image_path)
+                            logger.info("一時ファイル削除完了")
+                        except Exception as e:
+                            logger.warning(f"一時ファイル削除失敗: {e}")
+                    except Exception as e:
+                        logger.error(f"画像送信エラー: {e}")
+                        await channel.send("※ 画像の生成に失敗しましたが、褒めメッセージは送れました！")
+                else:
+                    logger.warning("画像パスが無効か、ファイルが存在しません")
+                    await channel.send("※ 画像の生成に失敗しましたが、褒めメッセージは送れました！")
+
+            except Exception as e:
+                logger.error(f"OpenAI API エラー (褒め機能): {e}")
+                # 生成できなかった場合だけ利用回数を戻す（送信などの後続処理の失敗では戻さない）
+                if not generated:
+                    quota_counter.refund(str(user.id))
+                await channel.send(f"{user.mention} ❌ 褒めメッセージの生成中にエラーが発生しました。")
+        else:
+            logger.error("エラー: OpenAI APIキーが設定されていません")
+            await channel.send(f"{user.mention} ❌ エラーが発生しました。管理者にお問い合わせください。")
+    else:
+        await channel.send(f"{user.mention} ⚠️ **❤️褒めメッセージを作成するためにはテキストが必要です**\n\n"
+                         f"以下のいずれかを行ってから❤️リアクションしてください：\n"
+                         f"• テキストメッセージを投稿する\n"
+                         f"• テキストファイル（.txt）を添付する\n"
+                         f"• 音声ファイルの場合は🎤で文字起こしをしてからそのファイルに❤️する\n\n"
+                         f"あなたの投稿内容を元に素敵な褒めメッセージと画像を生成します！")
+
+async def run_explain(message, channel, user, user_data, is_premium):
+    """投稿内容をAIで解説する（❓）"""
+    # メッセージ内容・Embed・添付テキストファイルから入力テキストを取得
+    input_text = await collect_input_text(message)
+
+    if input_text:
+        # URL検出・警告
+        await check_content_for_urls(input_text, user, channel)
+
+        # モデルを選択
+        model = PREMIUM_USER_MODEL if is_premium else FREE_USER_MODEL
+
+        # 処理開始メッセージを送信
+        message_link = f"https://discord.com/channels/{message.guild.id}/{message.channel.id}/{message.id}"
+        await channel.send(f"{user.mention} 🤔 投稿内容について詳しく解説するね〜！ちょっと待っててね\n📎 元メッセージ: {message_link}")
+
+        # OpenAI APIで解説を生成
+        if client_openai:
+            generated = False  # 生成結果を受け取った後のエラーでは利用回数を戻さない
+            progress_message = None  # 生成途中の文章を表示しているメッセージ
+            try:
+                # 入力が長すぎる場合は分割要約してトークン上限に収める
+                input_text = await fit_input_to_budget("question_explain", model, input_text)
+
+                # 生成途中の文章をメッセージの編集で順次表示する（キャッシュがあれば即座に返す）
+                explanation, progress_message = await generate_completion(
+                    "question_explain",
+                    stream_to=channel,
+                    header="🤔 解説を書いているよ…",
+                    model=model,
+                    messages=prompt_registry.build_messages("question_explain", input_text),
+                    max_tokens=2000,
+                    temperature=0.7
+                )
+                generated = True
+
+                # Discord文字数制限対応（2000文字以内に調整）
+                if len(explanation) > 1900:
+                    explanation = explanation[:1900] + "..."
+
+                # 結果を送信
+                embed = discord.Embed(
+                    title="🤔 AI解説",
+                    description=explanation,
+                    color=0xFF6B35
+                )
+
+                # 元の投稿内容も表示（短縮版）
+                original_content = message.content[:200] + "..." if len(message.content) > 200 else message.content
+                embed.add_field(
+                    name="📝 元の投稿",
+                    value=original_content,
+                    inline=False
+                )
+
+                # 途中経過のメッセージを完成版に差し替える
+                if progress_message:
+                    await progress_message.edit(content="💡 解説が完了したよ〜！", embed=embed)
+                else:
+                    await channel.send("💡 解説が完了したよ〜！")
+                    await channel.send(embed=embed)
+
+            except Exception as e:
+                logger.error(f"OpenAI API エラー (解説機能): {e}")
+                # 生成できなかった場合だけ利用回数を戻す（送信などの後続処理の失敗では戻さない）
+                if not generated:
+                    quota_counter.refund(str(user.id))
+                # 途中経過のメッセージが残っていればエラーメッセージに差し替える
+                await replace_progress_message(progress_message, channel, f"{user.mention} ❌ 解説の生成中にエラーが発生しました。")
+        else:
+            logger.error("エラー: OpenAI APIキーが設定されていません")
+            await channel.send(f"{user.mention} ❌ エラーが発生しました。管理者にお問い合わせください。")
+    else:
+        await channel.send(f"{user.mention} ⚠️ メッセージに内容がありません。")
+
+async def run_memo(message, channel, user, user_data, is_premium):
+    """Obsidianメモを作成する（✏️）"""
+    # メッセージ内容・Embed・添付テキストファイルから入力テキストを取得
+    input_text = await collect_input_text(message)
+
+    if input_text:
+        # URL検出・警告
+        await check_content_for_urls(input_text, user, channel)
+
+        # 処理開始メッセージ
+        message_link = f"https://discord.com/channels/{message.guild.id}/{message.channel.id}/{message.id}"
+        await channel.send(f"{user.mention} 📝 メモを作るよ〜！ちょっと待っててね\n📎 元メッセージ: {message_link}")
+
+        # モデルを選択
+        model = PREMIUM_USER_MODEL if is_premium else FREE_USER_MODEL
+
+        # メモ用のカスタムプロンプトがあれば優先（メッセージはプロンプトレジストリで組み立てる）
+        custom_prompt = user_data.get('custom_prompt_memo') if user_data else None
+        if custom_prompt:
+            logger.info(f"ユーザー {user.name} のメモ用カスタムプロンプトを使用")
+
+        # OpenAI APIでメモを生成（JSONモード）
+        if client_openai:
+            generated = False  # 生成結果を受け取った後のエラーでは利用回数を戻さない
+            try:
+                # 入力が長すぎる場合は分割要約してトークン上限に収める
+                input_text = await fit_input_to_budget("pencil_memo", model, input_text)
+
+                response_content, _ = await generate_completion(
+                    "pencil_memo",
+                    model=model,
+                    messages=prompt_registry.build_messages("pencil_memo", input_text, custom_prompt),
+                    max_tokens=2000,
+                    temperature=0.3,
+                    response_format={"type": "json_object"}
+                )
+                generated = True
+
+                # JSONレスポンスをパース
+                try:
+                    memo_json = json.loads(response_content)
+                    english_title = memo_json.get("english_title", "untitled_memo")
+                    content = memo_json.get("content", input_text)
+                except json.JSONDecodeError:
+                    logger.warning(f"JSON解析エラー、フォールバックを使用: {response_content}")
+                    english_title = "untitled_memo"
+                    content = input_text
+
+                # ファイル名を生成（YYYYMMDD_HHMMSS_english_title.md）
+                now = datetime.now()
+                timestamp = now.strftime("%Y%m%d_%H%M%S")
+                # 英語タイトルを安全なファイル名に変換
+                safe_english_title = re.sub(r'[^A-Za-z0-9\-_]', '', english_title)
+                if not safe_english_title:
+                    safe_english_title = "memo"
+                filename = f"{timestamp}_{safe_english_title}.md"
+
+                # attachmentsフォルダにファイルを保存
+                attachments_dir = script_dir / "attachments"
+                attachments_dir.mkdir(exist_ok=True)
+                file_path = attachments_dir / filename
+
+                # ファイル内容：コンテンツをそのまま保存
+                file_content = content
+
+                # UTF-8でファイル保存
+                with open(file_path, 'w', encoding='utf-8') as f:
+                    f.write(file_content)
+
+                logger.info(f"メモファイル作成: {file_path}")
+
+                try:
+                    # 結果を送信
+                    embed = discord.Embed(
+                        title="📝 Obsidianメモを作成しました",
+                        description=f"**ファイル名**: `{filename}`",
+                        color=0x7C3AED
+                    )
+
+                    # 内容のプレビュー（最初の200文字）
+                    preview = content[:200] + "..." if len(content) > 200 else content
+                    embed.add_field(
+                        name="📄 内容プレビュー",
+                        value=preview,
+                        inline=False
+                    )
+
+                    await channel.send(embed=embed)
+
+                    # ファイルをアップロード
+                    with open(file_path, 'rb') as f:
+                        file_data = f.read()
+
+                    file_obj = io.BytesIO(file_data)
+                    file_message = await channel.send("📝 メモファイルを作成しました！", file=discord.File(file_obj, filename=filename))
+
+                    # メモファイルに自動でリアクションを追加
+                    reactions = ['👍', '❓', '❤️', '✏️', '📝']
+                    for reaction in reactions:
+                        try:
+                            await file_message.add_reaction(reaction)
+                            await asyncio.sleep(0.5)  # Discord API レート制限対策
+                        except Exception as e:
+                            logger.warning(f"リアクション追加エラー ({reaction}): {e}")
+
+                    logger.info("メモファイルにリアクションを追加しました")
+
+                    # Discord投稿後、attachmentsフォルダの中身を削除
+                    for attachment_file in attachments_dir.iterdir():
+                        if attachment_file.is_file():
+                            attachment_file.unlink()
+                            logger.info(f"添付ファイル削除: {attachment_file}")
+
+                except Exception as upload_error:
+                    logger.error(f"ファイル投稿エラー: {upload_error}")
+                    # エラーが発生してもファイルは削除する
+                    try:
+                        file_path.unlink()
+                        logger.info(f"エラー後のファイル削除: {file_path}")
+                    except Exception as cleanup_error:
+                        logger.warning(f"ファイル削除エラー: {cleanup_error}")
+                    raise upload_error
+
+            except Exception as e:
+                logger.error(f"OpenAI API エラー (メモ機能): {e}")
+                # 生成できなかった場合だけ利用回数を戻す（送信などの後続処理の失敗では戻さない）
+                if not generated:
+                    quota_counter.refund(str(user.id))
+                await channel.send(f"{user.mention} ❌ メモの生成中にエラーが発生しました。")
+        else:
+            logger.error("エラー: OpenAI APIキーが設定されていません")
+            await channel.send(f"{user.mention} ❌ エラーが発生しました。管理者にお問い合わせください。")
+    else:
+        await channel.send(f"{user.mention} ⚠️ メッセージに内容がありません。")
+
+async def run_article(message, channel, user, user_data, is_premium):
+    """記事を作成する（📝）"""
+    # メッセージ内容・Embed・添付テキストファイルから入力テキストを取得
+    input_text = await collect_input_text(message)
+
+    if input_text:
+        # URL検出・警告
+        await check_content_for_urls(input_text, user, channel)
+
+        # 処理開始メッセージ
+        message_link = f"https://discord.com/channels/{message.guild.id}/{message.channel.id}/{message.id}"
+        await channel.send(f"{user.mention} 📝 記事を作成するよ〜！ちょっと待っててね\n📎 元メッセージ: {message_link}")
+
+        # モデルを選択
+        model = PREMIUM_USER_MODEL if is_premium else FREE_USER_MODEL
+
+        # 記事用のカスタムプロンプトがあれば優先（メッセージはプロンプトレジストリで組み立てる）
+        custom_prompt = user_data.get('custom_prompt_article') if user_data else None
+        if custom_prompt:
+            logger.info(f"ユーザー {user.name} のカスタムプロンプトを使用")
+
+        # OpenAI APIで記事を生成（JSONモード）
+        if client_openai:
+            generated = False  # 生成結果を受け取った後のエラーでは利用回数を戻さない
+            progress_message = None  # 生成途中の文章を表示しているメッセージ
+            try:
+                # 入力が長すぎる場合は分割要約してトークン上限に収める
+                input_text = await fit_input_to_budget("article", model, input_text)
+
+                # 生成途中の記事本文をメッセージの編集で順次表示する（キャッシュがあれば即座に返す）
+                response_content, progress_message = await generate_completion(
+                    "article",
+                    stream_to=channel,
+                    header="📝 記事を書いているよ…",
+                    render=extract_partial_json_content,
+                    model=model,
+                    messages=prompt_registry.build_messages("article", input_text, custom_prompt),
+                    max_tokens=3000,
+                    temperature=0.7,
+                    response_format={"type": "json_object"}
+                )
+                generated = True
+
+                # JSONレスポンスをパース
+                try:
+                    article_json = json.loads(response_content)
+                    content = article_json.get("content", response_content)
+                except json.JSONDecodeError:
+                    logger.warning(f"JSON解析エラー、フォールバックを使用: {response_content}")
+                    content = response_content
+
+                # ファイル名を生成（YYYYMMDD_HHMMSS_article.md）
+                now = datetime.now()
+                timestamp = now.strftime("%Y%m%d_%H%M%S")
+                filename = f"{timestamp}_article.md"
+
+                # attachmentsフォルダにファイルを保存
+                attachments_dir = script_dir / "attachments"
+                attachments_dir.mkdir(exist_ok=True)
+                file_path = attachments_dir / filename
+
+                # UTF-8でファイル保存
+                with open(file_path, 'w', encoding='utf-8') as f:
+                    f.write(content)
+
+                logger.info(f"記事ファイル作成: {file_path}")
+
+                try:
+                    # 記事のタイトルを抽出（最初の#行）
+                    lines = content.split('\n')
+                    title = "記事"
+                    for line in lines:
+                        if line.strip().startswith('# '):
+                            title = line.strip()[2:].strip()
+                            break
+
+                    # 結果を送信
+                    embed = discord.Embed(
+                        title="📝 記事を作成しました",
+                        description=f"**タイトル**: {title}\n**ファイル名**: `{filename}`",
+                        color=0x00bfa5
+                    )
+
+                    # 内容のプレビュー（最初の300文字）
+                    preview = content[:300] + "..." if len(content) > 300 else content
+                    embed.add_field(
+                        name="📄 内容プレビュー",
+                        value=f"```markdown\n{preview}\n```",
+                        inline=False
+                    )
+
+                    # 途中経過のメッセージを完成版に差し替える
+                    if progress_message:
+                        await progress_message.edit(content=None, embed=embed)
+                        progress_message = None  # 完成版に差し替えたので以降のエラーでは触らない
+                    else:
+                        await channel.send(embed=embed)
+
+                    # ファイルをアップロード
+                    with open(file_path, 'rb') as f:
+                        file_data = f.read()
+
+                    file_obj = io.BytesIO(file_data)
+                    file_message = await channel.send("📝 記事ファイルです！", file=discord.File(file_obj, filename=filename))
+
+                    # 記事ファイルに自動でリアクションを追加
+                    reactions = ['👍', '❓', '❤️', '✏️', '📝']
+                    for reaction in reactions:
+                        try:
+                            await file_message.add_reaction(reaction)
+                            await asyncio.sleep(0.5)  # Discord API レート制限対策
+                        except Exception as e:
+                            logger.warning(f"リアクション追加エラー ({reaction}): {e}")
+
+                    logger.info("記事ファイルにリアクションを追加しました")
+
+                    # Discord投稿後、attachmentsフォルダの中身を削除
+                    for attachment_file in attachments_dir.iterdir():
+                        if attachment_file.is_file():
+                            attachment_file.unlink()
+                            logger.info(f"添付ファイル削除: {attachment_file}")
+
+                except Exception as upload_error:
+                    logger.error(f"ファイル投稿エラー: {upload_error}")
+                    # エラーが発生してもファイルは削除する
+                    try:
+                        file_path.unlink()
+                        logger.info(f"エラー後のファイル削除: {file_path}")
+                    except Exception as cleanup_error:
+                        logger.warning(f"ファイル削除エラー: {cleanup_error}")
+                    raise upload_error
+
+            except Exception as e:
+                logger.error(f"OpenAI API エラー (記事機能): {e}")
+                # 生成できなかった場合だけ利用回数を戻す（送信などの後続処理の失敗では戻さない）
+                if not generated:
+                    quota_counter.refund(str(user.id))
+                # 途中経過のメッセージが残っていればエラーメッセージに差し替える
+                await replace_progress_message(progress_message, channel, f"{user.mention} ❌ 記事の生成中にエラーが発生しました。")
+        else:
+            logger.error("エラー: OpenAI APIキーが設定されていません")
+            await channel.send(f"{user.mention} ❌ エラーが発生しました。管理者にお問い合わせください。")
+    else:
+        await channel.send(f"{user.mention} ⚠️ メッセージに内容がありません。")
+
+# リアクション絵文字と機能の対応表
+REACTION_FEATURES = {
+    '👍': run_x_post,
+    '🎤': run_transcribe,
+    '❤️': run_praise,
+    '❓': run_explain,
+    '✏️': run_memo,
+    '📝': run_article,
+}
+
+# リアクションで受け付けた処理1件分
+class ReactionJob:
+    def __init__(self, guild_id, feature, message, channel, user, user_data, is_premium):
+        self.guild_id = guild_id
+        self.feature = feature
+        self.message = message
+        self.channel = channel
+        self.user = user
+        self.user_data = user_data
+        self.is_premium = is_premium
+
+    async def run(self):
+        await self.feature(self.message, self.channel, self.user, self.user_data, self.is_premium)
+
+# リアクション処理のジョブキュー
+class ReactionJobQueue:
+    """上限付きのジョブキューを固定数のワーカーで処理する
+
+    プレミアム会員と無料会員でレーンを分け、プレミアムを優先して取り出す。
+    各レーンには同時実行数の上限があり、同じレーン内ではサーバーごとに順番に取り出す。
+    """
+    LANES = ("premium", "free")
+
+    def __init__(self, max_size=REACTION_QUEUE_SIZE, worker_count=REACTION_WORKERS,
+                 premium_concurrency=REACTION_PREMIUM_CONCURRENCY, free_concurrency=REACTION_FREE_CONCURRENCY,
+                 starvation_limit=REACTION_FREE_STARVATION_LIMIT):
+        self.max_size = max_size  # レーンごとの最大待機件数
+        self.worker_count = worker_count
+        self.caps = {"premium": premium_concurrency, "free": free_concurrency}
+        self.starvation_limit = starvation_limit
+        self._queues = {lane: OrderedDict() for lane in self.LANES}  # server_id -> 待機中ジョブのdeque
+        self._sizes = {lane: 0 for lane in self.LANES}
+        self._running = {lane: 0 for lane in self.LANES}
+        self._premium_streak = 0  # 無料ジョブが待っている間に連続で開始したプレミアムジョブ数
+        self._wakeup = asyncio.Event()
+        self._workers = []
+
+    def __len__(self):
+        return sum(self._sizes.values())
+
+    @staticmethod
+    def lane_of(job):
+        return "premium" if job.is_premium else "free"
+
+    def start(self):
+        """ワーカーを起動する"""
+        if self._workers:
+            return
+        self._workers = [asyncio.create_task(self._worker(i)) for i in range(self.worker_count)]
+        logger.info(f"リアクション処理ワーカーを起動しました: {self.worker_count}個")
+
+    def stop(self):
+        """ワーカーを停止する"""
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
+
+    def _position(self, lane, guild_id, index):
+        """ラウンドロビンで処理したときにレーン内で何番目に実行されるかを返す"""
+        ahead = index
+        before_own = True
+        for other_id, queue in self._queues[lane].items():
+            if other_id == guild_id:
+                before_own = False
+                continue
+            ahead += min(len(queue), index + 1 if before_own else index)
+        return ahead + 1
+
+    def _free_slots(self, lane):
+        idle = self.worker_count - sum(self._running.values())
+        return max(0, min(idle, self.caps[lane] - self._running[lane]))
+
+    def submit(self, job):
+        """ジョブを追加する。満杯ならNone、すぐに処理されるなら0、待ちが発生するなら順番を返す"""
+        lane = self.lane_of(job)
+        if self._sizes[lane] >= self.max_size:
+            logger.warning(f"リアクション処理キューが満杯です ({lane}): {self._sizes[lane]}件")
+            return None
+
+        queues = self._queues[lane]
+        queue = queues.get(job.guild_id)
+        if queue is None:
+            queue = queues[job.guild_id] = deque()
+        queue.append(job)
+        self._sizes[lane] += 1
+
+        position = self._position(lane, job.guild_id, len(queue) - 1)
+        if lane == "free":
+            # 無料ジョブの前には待機中のプレミアムジョブも入る
+            position += self._sizes["premium"]
+        self._wakeup.set()
+        slots = self._free_slots(lane)
+        return 0 if position <= slots else position - slots
+
+    def _select_lane(self):
+        """次に取り出すレーンを決める（取り出せるジョブがなければNone）"""
+        ready = [lane for lane in self.LANES
+                 if self._sizes[lane] and self._running[lane] < self.caps[lane]
+                 and sum(self._running.values()) < self.worker_count]
+        if not ready:
+            return None
+        if len(ready) == 1:
+            if ready[0] == "free":
+                self._premium_streak = 0
+            return ready[0]
+        # 両方待っている場合はプレミアム優先、ただし一定回数ごとに無料ジョブを通す
+        if self._premium_streak >= self.starvation_limit:
+            self._premium_streak = 0
+            return "free"
+        self._premium_streak += 1
+        return "premium"
+
+    def _pop(self, lane):
+        queues = self._queues[lane]
+        guild_id, queue = next(iter(queues.items()))
+        job = queue.popleft()
+        if queue:
+            # 次は別のサーバーのジョブを優先する
+            queues.move_to_end(guild_id)
+        else:
+            del queues[guild_id]
+        self._sizes[lane] -= 1
+        return job
+
+    async def _worker(self, worker_id):
+        while True:
+            lane = self._select_lane()
+            if lane is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            job = self._pop(lane)
+            self._running[lane] += 1
+            try:
+                await job.run()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"リアクション処理エラー (ワーカー{worker_id}): {e}")
+            finally:
+                self._running[lane] -= 1
+                # 上限で止まっていたワーカーを起こす
+                self._wakeup.set()
+
+# リアクション処理キューのインスタンスを作成
+reaction_queue = ReactionJobQueue()
+
+# まとめて生成できる機能（リアクション絵文字 -> 機能名）
+BATCHABLE_FEATURES = {
+    '👍': "x_post",
+    '❤️': "heart_praise",
+    '❓': "question_explain",
+    '✏️': "pencil_memo",
+    '📝': "article",
+}
+
+# ユーザーのカスタムプロンプトの保存先（機能名 -> ユーザーデータのキー）
+CUSTOM_PROMPT_FIELDS = {
+    "x_post": "custom_prompt_x_post",
+    "pencil_memo": "custom_prompt_memo",
+    "article": "custom_prompt_article",
+}
+
+# 機能ごとの最大出力トークン数（まとめて生成するときの合計に使う）
+FEATURE_MAX_TOKENS = {
+    "x_post": 1000,
+    "heart_praise": 1500,
+    "question_explain": 2000,
+    "pencil_memo": 2000,
+    "article": 3000,
+}
+
+def build_batch_prompt(features, user_data):
+    """複数の機能の指示を1つのJSON出力の依頼にまとめる"""
+    sections = [
+        "あなたは複数の依頼を同時に処理するアシスタントです。ユーザーから渡される入力テキストは全ての依頼で共通です。",
+        "以下の各依頼をそれぞれ独立に処理し、依頼名をキーとするJSONオブジェクトで返してください。",
+        f"出力するキー: {', '.join(features)}",
+    ]
+    for feature in features:
+        custom_field = CUSTOM_PROMPT_FIELDS.get(feature)
+        custom_prompt = user_data.get(custom_field) if custom_field and user_data else None
+        prompt = prompt_registry.get(feature, custom_prompt)
+        if PROMPT_SPECS[feature]["json_instruction"]:
+            value_rule = f"キー \"{feature}\" の値には、上記の指示どおりのJSONオブジェクトを入れてください。"
+        elif feature == "heart_praise":
+            value_rule = f"キー \"{feature}\" の値には、上記の指示どおりのJSONオブジェクト（long_praise と short_praise）を入れてください。"
+        else:
+            value_rule = f"キー \"{feature}\" の値には、結果の本文を文字列で入れてください。"
+        sections.append(f"## 依頼: {feature}\n{prompt}\n\n{value_rule}")
+    return "\n\n".join(sections)
+
+async def run_reaction_batch(emojis, message, channel, user, user_data, is_premium):
+    """同じメッセージへの複数のリアクションを1回の生成でまとめて処理する"""
+    # プロンプトの先頭を揃えるため、リアクションの順番によらず機能は決まった順に並べる
+    canonical_order = list(BATCHABLE_FEATURES.values())
+    features = sorted({BATCHABLE_FEATURES[emoji] for emoji in emojis}, key=canonical_order.index)
+    outputs = {}
+    input_text = await collect_input_text(message)
+    model = PREMIUM_USER_MODEL if is_premium else FREE_USER_MODEL
+
+    # 入力がなく各機能の案内を出す場合や、分割要約が必要な長さの場合は個別に処理する
+    input_tokens = await asyncio.to_thread(count_tokens, input_text, model) if input_text else 0
+    if input_text and client_openai and all(
+        input_tokens <= input_token_budget(feature, model) for feature in features
+    ):
+        try:
+            response_content, _ = await generate_completion(
+                "+".join(features),
+                model=model,
+                messages=[
+                    {"role": "system", "content": build_batch_prompt(features, user_data)},
+                    {"role": "user", "content": input_text}
+                ],
+                max_tokens=sum(FEATURE_MAX_TOKENS[feature] for feature in features),
+                temperature=0.7,
+                response_format={"type": "json_object"}
+            )
+            data = json.loads(response_content)
+            for feature in features:
+                value = data.get(feature)
+                if isinstance(value, dict):
+                    outputs[feature] = json.dumps(value, ensure_ascii=False)
+                elif isinstance(value, str) and value:
+                    outputs[feature] = value
+            logger.info(f"リアクションをまとめて生成しました: {', '.join(outputs)}")
+        except Exception as e:
+            # まとめて生成できなかった分は各機能で個別に生成する
+            logger.warning(f"まとめて生成に失敗したため個別に処理します: {e}")
+
+    token = batch_results.set({"input_text": input_text, "outputs": outputs})
+    try:
+        for emoji in emojis:
+            await REACTION_FEATURES[emoji](message, channel, user, user_data, is_premium)
+    finally:
+        batch_results.reset(token)
+
+async def submit_reaction_job(guild_id, emojis, message, channel, user, user_data, is_premium):
+    """リアクション処理をキューに積み、待ちが発生する場合は順番を知らせる"""
+    if len(emojis) == 1:
+        feature = REACTION_FEATURES[emojis[0]]
+    else:
+        feature = functools.partial(run_reaction_batch, emojis)
+    job = ReactionJob(guild_id, feature, message, channel, user, user_data, is_premium)
+    position = reaction_queue.submit(job)
+    if position is None:
+        # キューが満杯の場合は受け付けず、消費した利用回数を戻す
+        for _ in emojis:
+            quota_counter.refund(str(user.id))
+        await channel.send(f"{user.mention} 🙏 ただいま混み合っています。少し時間をおいてからもう一度リアクションしてください。")
+    elif position > 0:
+        await channel.send(f"{user.mention} ⏳ 混み合っているため順番待ちです（{position}番目）。順番が来たら処理するね！")
+
+# 同じメッセージへの連続したリアクションをまとめる
+class ReactionBatcher:
+    """同じユーザーが同じメッセージに短時間で付けたリアクションを1つのジョブにまとめる"""
+    def __init__(self, window=REACTION_BATCH_WINDOW):
+        self.window = window
+        self._pending = {}  # (ユーザーID, メッセージID) -> 受付中のリアクション
+        self._timers = set()
+
+    async def add(self, guild_id, emoji, message, channel, user, user_data, is_premium):
+        if self.window <= 0 or emoji not in BATCHABLE_FEATURES:
+            await submit_reaction_job(guild_id, [emoji], message, channel, user, user_data, is_premium)
+            return
+
+        key = (user.id, message.id)
+        batch = self._pending.get(key)
+        if batch is not None:
+            if emoji in batch["emojis"]:
+                # 同じリアクションの付け直しは1回分として扱う
+                quota_counter.refund(str(user.id))
+            else:
+                batch["emojis"].append(emoji)
+            return
+
+        self._pending[key] = {
+            "args": (guild_id, message, channel, user, user_data, is_premium),
+            "emojis": [emoji],
+        }
+        timer = asyncio.create_task(self._submit_later(key))
+        self._timers.add(timer)
+        timer.add_done_callback(self._timers.discard)
+
+    async def _submit_later(self, key):
+        await asyncio.sleep(self.window)
+        batch = self._pending.pop(key)
+        guild_id, message, channel, user, user_data, is_premium = batch["args"]
+        try:
+            await submit_reaction_job(guild_id, batch["emojis"], message, channel, user, user_data, is_premium)
+        except Exception as e:
+            logger.error(f"リアクション受付エラー: {e}")
+
+# リアクションまとめ処理のインスタンスを作成
+reaction_batcher = ReactionBatcher()
+
 @bot.event
 async def on_raw_reaction_add(payload):
     """リアクション追加時の処理"""
@@ -1401,7 +4104,7 @@ async def on_raw_reaction_add(payload):
         return
     
     # リアクションの種類をチェック
-    if payload.emoji.name in ['👍', '🎤', '❤️', '❓', '✏️', '📝']:
+    if payload.emoji.name in REACTION_FEATURES:
         server_id = str(payload.guild_id)
         channel_id = str(payload.channel_id)
         
@@ -1422,8 +4125,8 @@ async def on_raw_reaction_add(payload):
             logger.info(f"メッセージ: {message.content if message.content else '(空のメッセージ)'}")
             logger.info("-" * 50)
             
-            # 共通ユーザーデータ処理
-            user_data = load_user_data(user.id)
+            # 共通ユーザーデータ処理（メモリ上のストアを使用）
+            user_data = await user_store.get(user.id)
             if user_data is None:
                 # 新規ユーザー
                 user_data = {
@@ -1436,716 +4139,36 @@ async def on_raw_reaction_add(payload):
                     "last_used_date": "",
                     "daily_usage_count": 0
                 }
-                save_user_data(user.id, user_data)
+                user_store.put(user.id, user_data)
                 logger.info(f"新規ユーザー {user.name} ({user.id}) のデータを作成しました")
             else:
                 # 既存ユーザーのマイグレーション
                 user_data, migration_needed = migrate_user_data(user_data, user.id, user.name)
                 if migration_needed:
-                    save_user_data(user.id, user_data)
+                    user_store.put(user.id, user_data)
                     logger.info(f"ユーザー {user.name} ({user.id}) のデータをマイグレーションしました")
             
             # プレミアム状態確認
             is_premium = is_premium_user(user.id)
             
-            # ユーザー情報とstatusを更新
-            user_data["user_id"] = str(user.id)
-            user_data["username"] = user.name
-            user_data["status"] = "premium" if is_premium else "free"
+            # ユーザー情報とstatusを更新（変更があった場合のみ保存対象にする）
+            status = "premium" if is_premium else "free"
+            if (user_data.get("user_id"), user_data.get("username"), user_data.get("status")) != (str(user.id), user.name, status):
+                user_data["user_id"] = str(user.id)
+                user_data["username"] = user.name
+                user_data["status"] = status
+                user_store.put(user.id, user_data)
             
-            # 使用制限チェック
-            can_use, limit_message = can_use_feature(user_data, is_premium)
+            # 使用制限チェック（利用回数はメモリ上のカウンターで管理し、定期的に保存）
+            can_use, limit_message = can_use_feature(user.id, user_data, is_premium)
             if not can_use:
                 await channel.send(f"{user.mention} {limit_message}")
                 return
-            
-            # 使用回数更新
-            save_user_data(user.id, user_data)
-            
-            
-            # 👍 サムズアップ：X投稿要約
-            if payload.emoji.name == '👍':
-                # メッセージ内容または添付ファイル、Embedからテキストを取得
-                input_text = message.content
-                
-                # Embedがある場合は内容を抽出
-                embed_content = extract_embed_content(message)
-                if embed_content:
-                    if input_text:
-                        input_text += f"\n\n【Embed内容】\n{embed_content}"
-                    else:
-                        input_text = embed_content
-                    logger.info("Embed内容を追加")
-                
-                # 添付ファイルがある場合、テキストファイルの内容を読み取り
-                if message.attachments:
-                    for attachment in message.attachments:
-                        file_content = await read_text_attachment(attachment)
-                        if file_content:
-                            if input_text:
-                                input_text += f"\n\n【ファイル: {attachment.filename}】\n{file_content}"
-                            else:
-                                input_text = f"【ファイル: {attachment.filename}】\n{file_content}"
-                            logger.info(f"添付ファイルの内容を追加: {attachment.filename}")
-                
-                if input_text:
-                    # URL検出・警告
-                    await check_content_for_urls(input_text, user, channel)
-                    
-                    # モデルを選択
-                    model = PREMIUM_USER_MODEL if is_premium else FREE_USER_MODEL
-                    
-                    # 処理開始メッセージを送信
-                    message_link = f"https://discord.com/channels/{message.guild.id}/{message.channel.id}/{message.id}"
-                    await channel.send(f"{user.mention} X用の投稿を作ってあげるね〜！ちょっと待っててね\n📎 元メッセージ: {message_link}")
-                    
-                    # X投稿用プロンプトを読み込み（カスタムプロンプトを優先）
-                    x_prompt = None
-                    
-                    # 1. ユーザーのカスタムプロンプトをチェック
-                    if user_data and user_data.get('custom_prompt_x_post'):
-                        x_prompt = user_data['custom_prompt_x_post']
-                        logger.info(f"ユーザー {user.name} のカスタムプロンプトを使用")
-                    
-                    # 2. カスタムプロンプトがない場合はデフォルトプロンプトファイルを使用
-                    if not x_prompt:
-                        prompt_path = script_dir / "prompt" / "x_post.txt"
-                        if prompt_path.exists():
-                            with open(prompt_path, 'r', encoding='utf-8') as f:
-                                x_prompt = f.read()
-                            logger.info("デフォルトプロンプトファイルを使用")
-                        else:
-                            x_prompt = "あなたはDiscordの投稿をX（旧Twitter）用に要約するアシスタントです。140文字以内で簡潔に要約してください。"
-                            logger.info("フォールバックプロンプトを使用")
-                    
-                    # プロンプトにJSON出力指示を追加
-                    x_prompt += "\n\n出力は以下のJSON形式で返してください：\n{\"content\": \"X投稿用のテキスト\"}"
-                    
-                    # OpenAI APIで要約を生成
-                    if client_openai:
-                        try:
-                            response = client_openai.chat.completions.create(
-                                model=model,
-                                messages=[
-                                    {"role": "system", "content": x_prompt},
-                                    {"role": "user", "content": input_text}
-                                ],
-                                max_tokens=1000,
-                                temperature=0.9,
-                                response_format={"type": "json_object"}
-                            )
-                            
-                            # JSONレスポンスをパース
-                            response_content = response.choices[0].message.content
-                            try:
-                                response_json = json.loads(response_content)
-                                summary = response_json.get("content", response_content)
-                            except json.JSONDecodeError:
-                                logger.warning(f"JSON解析エラー、生のレスポンスを使用: {response_content}")
-                                summary = response_content
-                            
-                            # X投稿用のURLを生成
-                            x_intent_url = f"https://twitter.com/intent/tweet?text={urllib.parse.quote(summary)}"
-                            
-                            # URLを短縮
-                            shortened_url = shorten_url(x_intent_url)
-                            
-                            # 結果を送信（Discord制限に合わせて文字数制限）
-                            # embed descriptionは4096文字制限、fieldは1024文字制限
-                            display_summary = summary[:4000] + "..." if len(summary) > 4000 else summary
-                            
-                            embed = discord.Embed(
-                                title="📝 X投稿用要約",
-                                description=display_summary,
-                                color=0x1DA1F2
-                            )
-                            
-                            embed.add_field(
-                                name="X投稿リンク👇",
-                                value=f"[クリックして投稿]({shortened_url})",
-                                inline=False
-                            )
-                            
-                            # 完了メッセージと結果を送信
-                            await channel.send("🎉 できたよ〜！Xに投稿する場合は下のリンクをクリックしてね！")
-                            await channel.send(embed=embed)
-                            
-                        except Exception as e:
-                            logger.error(f"OpenAI API エラー: {e}")
-                            await channel.send(f"{user.mention} ❌ 要約の生成中にエラーが発生しました。")
-                    else:
-                        logger.error("エラー: OpenAI APIキーが設定されていません")
-                        await channel.send(f"{user.mention} ❌ エラーが発生しました。管理者にお問い合わせください。")
-                else:
-                    await channel.send(f"{user.mention} ⚠️ **X投稿を作成するためにはテキストが必要です**\n\n"
-                                     f"以下のいずれかを行ってから👍リアクションしてください：\n"
-                                     f"• テキストメッセージを投稿する\n"
-                                     f"• テキストファイル（.txt）を添付する\n"
-                                     f"• 音声ファイルの場合は🎤で文字起こしをしてからそのファイルに👍する\n\n"
-                                     f"音声ファイルのみでは直接X投稿は作成できません。")
-            
-            # 🎤 マイク：音声・動画文字起こし
-            elif payload.emoji.name == '🎤':
-                # 音声・動画ファイルがあるかチェック
-                if message.attachments:
-                    await transcribe_audio(message, channel, user)
-                else:
-                    await channel.send(f"{user.mention} ⚠️ **🎤は音声・動画の文字起こし専用です**\n\n"
-                                     f"音声ファイル（mp3、wav、m4a等）または動画ファイル（mp4、mov等）が添付されたメッセージにリアクションしてください。\n\n"
-                                     f"テキストのみのメッセージには🎤ではなく、以下のリアクションをお使いください：\n"
-                                     f"• 👍 X投稿作成\n"
-                                     f"• ❓ AI解説\n"
-                                     f"• ❤️ 絶賛モード\n"
-                                     f"• ✏️ 記事作成")
-            
-            # ❤️ ハート：絶賛モード
-            elif payload.emoji.name == '❤️':
-                # メッセージ内容または添付ファイル、Embedからテキストを取得
-                input_text = message.content
-                
-                # Embedがある場合は内容を抽出
-                embed_content = extract_embed_content(message)
-                if embed_content:
-                    if input_text:
-                        input_text += f"\n\n【Embed内容】\n{embed_content}"
-                    else:
-                        input_text = embed_content
-                    logger.info("Embed内容を追加")
-                
-                # 添付ファイルがある場合、テキストファイルの内容を読み取り
-                if message.attachments:
-                    for attachment in message.attachments:
-                        file_content = await read_text_attachment(attachment)
-                        if file_content:
-                            if input_text:
-                                input_text += f"\n\n【ファイル: {attachment.filename}】\n{file_content}"
-                            else:
-                                input_text = f"【ファイル: {attachment.filename}】\n{file_content}"
-                            logger.info(f"添付ファイルの内容を追加: {attachment.filename}")
-                
-                if input_text:
-                    # URL検出・警告
-                    await check_content_for_urls(input_text, user, channel)
-                    
-                    # 処理開始メッセージを送信
-                    message_link = f"https://discord.com/channels/{message.guild.id}/{message.channel.id}/{message.id}"
-                    await channel.send(f"{user.mention} わー！褒めさせて〜！ちょっと待っててね✨\n📎 元メッセージ: {message_link}")
-                    
-                    # モデルを選択
-                    model = PREMIUM_USER_MODEL if is_premium else FREE_USER_MODEL
-                    
-                    # 褒めプロンプトを読み込み
-                    praise_prompt = None
-                    prompt_path = script_dir / "prompt" / "heart_praise.txt"
-                    if prompt_path.exists():
-                        with open(prompt_path, 'r', encoding='utf-8') as f:
-                            praise_prompt = f.read()
-                        logger.info("褒めプロンプトファイルを使用")
-                    else:
-                        praise_prompt = "あなたはDiscordメッセージの内容について極めて熱烈に褒めまくるアシスタントです。どんな内容でも強烈に・熱烈に・感動的に褒めてください。ユーザーのモチベーション向上に特化した内容で、800文字以内で褒めてください。"
-                        logger.info("フォールバック褒めプロンプトを使用")
-                    
-                    # OpenAI APIで褒めメッセージを生成（JSONモード）
-                    if client_openai:
-                        try:
-                            response = client_openai.chat.completions.create(
-                                model=model,
-                                messages=[
-                                    {"role": "system", "content": praise_prompt},
-                                    {"role": "user", "content": input_text}
-                                ],
-                                max_tokens=1500,
-                                temperature=0.9,
-                                response_format={"type": "json_object"}
-                            )
-                            
-                            # JSONレスポンスをパース
-                            response_content = response.choices[0].message.content
-                            try:
-                                praise_json = json.loads(response_content)
-                                long_praise = praise_json.get("long_praise", "")
-                                short_praise = praise_json.get("short_praise", "")
-                            except json.JSONDecodeError:
-                                logger.warning(f"JSON解析エラー、フォールバックを使用: {response_content}")
-                                long_praise = response_content[:400]
-                                short_praise = response_content[:20]
-                            
-                            # 1. まず400字の激烈褒めをDiscordに投稿
-                            if len(long_praise) > 400:
-                                long_praise = long_praise[:400] + "..."
-                            
-                            await channel.send(long_praise)
-                            
-                            # 2. 25字の短文褒めで画像を生成
-                            if len(short_praise) > 25:
-                                short_praise = short_praise[:25]
-                            
-                            # 画像生成用テキスト処理（絵文字除去）
-                            image_text = re.sub(r'[^\u3040-\u309F\u30A0-\u30FF\u4E00-\u9FAF\u0021-\u007E]', '', short_praise)
-                            image_text = image_text.replace("。", "").replace("、", "").replace(" ", "").replace("\n", "")
-                            
-                            # 褒め画像を生成
-                            image_path = make_praise_image(image_text)
-                            
-                            # 3. 画像を送信
-                            if image_path and os.path.exists(image_path):
-                                try:
-                                    await channel.send("🎉 褒め画像をお作りしました！", file=discord.File(image_path))
-                                    logger.info("褒め画像送信成功")
-                                    # 一時ファイルを削除
-                                    try:
-                                        os.remove(image_path)
-                                        logger.info("一時ファイル削除完了")
-                                    except Exception as e:
-                                        logger.warning(f"一時ファイル削除失敗: {e}")
-                                except Exception as e:
-                                    logger.error(f"画像送信エラー: {e}")
-                                    await channel.send("※ 画像の生成に失敗しましたが、褒めメッセージは送れました！")
-                            else:
-                                logger.warning("画像パスが無効か、ファイルが存在しません")
-                                await channel.send("※ 画像の生成に失敗しましたが、褒めメッセージは送れました！")
-                            
-                        except Exception as e:
-                            logger.error(f"OpenAI API エラー (褒め機能): {e}")
-                            await channel.send(f"{user.mention} ❌ 褒めメッセージの生成中にエラーが発生しました。")
-                    else:
-                        logger.error("エラー: OpenAI APIキーが設定されていません")
-                        await channel.send(f"{user.mention} ❌ エラーが発生しました。管理者にお問い合わせください。")
-                else:
-                    await channel.send(f"{user.mention} ⚠️ **❤️褒めメッセージを作成するためにはテキストが必要です**\n\n"
-                                     f"以下のいずれかを行ってから❤️リアクションしてください：\n"
-                                     f"• テキストメッセージを投稿する\n"
-                                     f"• テキストファイル（.txt）を添付する\n"
-                                     f"• 音声ファイルの場合は🎤で文字起こしをしてからそのファイルに❤️する\n\n"
-                                     f"あなたの投稿内容を元に素敵な褒めメッセージと画像を生成します！")
-            
-            # ❓ 疑問符：AI説明
-            elif payload.emoji.name == '❓':
-                # メッセージ内容または添付ファイル、Embedからテキストを取得
-                input_text = message.content
-                
-                # Embedがある場合は内容を抽出
-                embed_content = extract_embed_content(message)
-                if embed_content:
-                    if input_text:
-                        input_text += f"\n\n【Embed内容】\n{embed_content}"
-                    else:
-                        input_text = embed_content
-                    logger.info("Embed内容を追加")
-                
-                # 添付ファイルがある場合、テキストファイルの内容を読み取り
-                if message.attachments:
-                    for attachment in message.attachments:
-                        file_content = await read_text_attachment(attachment)
-                        if file_content:
-                            if input_text:
-                                input_text += f"\n\n【ファイル: {attachment.filename}】\n{file_content}"
-                            else:
-                                input_text = f"【ファイル: {attachment.filename}】\n{file_content}"
-                            logger.info(f"添付ファイルの内容を追加: {attachment.filename}")
-                
-                if input_text:
-                    # URL検出・警告
-                    await check_content_for_urls(input_text, user, channel)
-                    
-                    # モデルを選択
-                    model = PREMIUM_USER_MODEL if is_premium else FREE_USER_MODEL
-                    
-                    # 処理開始メッセージを送信
-                    message_link = f"https://discord.com/channels/{message.guild.id}/{message.channel.id}/{message.id}"
-                    await channel.send(f"{user.mention} 🤔 投稿内容について詳しく解説するね〜！ちょっと待っててね\n📎 元メッセージ: {message_link}")
-                    
-                    # 解説用プロンプトを読み込み
-                    explain_prompt = None
-                    prompt_path = script_dir / "prompt" / "question_explain.txt"
-                    if prompt_path.exists():
-                        with open(prompt_path, 'r', encoding='utf-8') as f:
-                            explain_prompt = f.read()
-                        logger.info("解説プロンプトファイルを使用")
-                    else:
-                        explain_prompt = "あなたはDiscordメッセージの内容について詳しく解説するアシスタントです。投稿内容をわかりやすく、丁寧に解説してください。専門用語があれば説明し、背景情報も補足してください。"
-                        logger.info("フォールバック解説プロンプトを使用")
-                    
-                    # OpenAI APIで解説を生成
-                    if client_openai:
-                        try:
-                            response = client_openai.chat.completions.create(
-                                model=model,
-                                messages=[
-                                    {"role": "system", "content": explain_prompt},
-                                    {"role": "user", "content": input_text}
-                                ],
-                                max_tokens=2000,
-                                temperature=0.7
-                            )
-                            
-                            explanation = response.choices[0].message.content
-                            
-                            # Discord文字数制限対応（2000文字以内に調整）
-                            if len(explanation) > 1900:
-                                explanation = explanation[:1900] + "..."
-                            
-                            # 結果を送信
-                            embed = discord.Embed(
-                                title="🤔 AI解説",
-                                description=explanation,
-                                color=0xFF6B35
-                            )
-                            
-                            # 元の投稿内容も表示（短縮版）
-                            original_content = message.content[:200] + "..." if len(message.content) > 200 else message.content
-                            embed.add_field(
-                                name="📝 元の投稿",
-                                value=original_content,
-                                inline=False
-                            )
-                            
-                            await channel.send("💡 解説が完了したよ〜！")
-                            await channel.send(embed=embed)
-                            
-                        except Exception as e:
-                            logger.error(f"OpenAI API エラー (解説機能): {e}")
-                            await channel.send(f"{user.mention} ❌ 解説の生成中にエラーが発生しました。")
-                    else:
-                        logger.error("エラー: OpenAI APIキーが設定されていません")
-                        await channel.send(f"{user.mention} ❌ エラーが発生しました。管理者にお問い合わせください。")
-                else:
-                    await channel.send(f"{user.mention} ⚠️ メッセージに内容がありません。")
-            
-            # ✏️ 鉛筆：Obsidianメモ作成
-            elif payload.emoji.name == '✏️':
-                # メッセージ内容または添付ファイル、Embedからテキストを取得
-                input_text = message.content
-                
-                # Embedがある場合は内容を抽出
-                embed_content = extract_embed_content(message)
-                if embed_content:
-                    if input_text:
-                        input_text += f"\n\n【Embed内容】\n{embed_content}"
-                    else:
-                        input_text = embed_content
-                    logger.info("Embed内容を追加")
-                
-                # 添付ファイルがある場合、テキストファイルの内容を読み取り
-                if message.attachments:
-                    for attachment in message.attachments:
-                        file_content = await read_text_attachment(attachment)
-                        if file_content:
-                            if input_text:
-                                input_text += f"\n\n【ファイル: {attachment.filename}】\n{file_content}"
-                            else:
-                                input_text = f"【ファイル: {attachment.filename}】\n{file_content}"
-                            logger.info(f"添付ファイルの内容を追加: {attachment.filename}")
-                
-                if input_text:
-                    # URL検出・警告
-                    await check_content_for_urls(input_text, user, channel)
-                    
-                    # 処理開始メッセージ
-                    message_link = f"https://discord.com/channels/{message.guild.id}/{message.channel.id}/{message.id}"
-                    await channel.send(f"{user.mention} 📝 メモを作るよ〜！ちょっと待っててね\n📎 元メッセージ: {message_link}")
-                    
-                    # モデルを選択
-                    model = PREMIUM_USER_MODEL if is_premium else FREE_USER_MODEL
-                    
-                    # メモ用プロンプトを読み込み
-                    memo_prompt = None
-                    
-                    # 1. ユーザーのカスタムプロンプトをチェック
-                    if user_data and user_data.get('custom_prompt_memo'):
-                        memo_prompt = user_data['custom_prompt_memo']
-                        logger.info(f"ユーザー {user.name} のメモ用カスタムプロンプトを使用")
-                    
-                    # 2. カスタムプロンプトがない場合はデフォルトプロンプトファイルを使用
-                    if not memo_prompt:
-                        prompt_path = script_dir / "prompt" / "pencil_memo.txt"
-                        if prompt_path.exists():
-                            with open(prompt_path, 'r', encoding='utf-8') as f:
-                                memo_prompt = f.read()
-                            logger.info("デフォルトメモプロンプトファイルを使用")
-                        else:
-                            memo_prompt = "あなたはDiscordメッセージの内容をObsidianメモとして整理するアシスタントです。内容に忠実にメモ化してください。追加情報は加えず、原文を尊重してください。"
-                            logger.info("フォールバックメモプロンプトを使用")
-                    
-                    # プロンプトにJSON出力指示を追加（カスタムプロンプトでも対応）
-                    json_instruction = '\n\n出力はJSON形式で、以下のフォーマットに従ってください：\n{"english_title": "english_title_for_filename", "content": "メモの内容"}'
-                    memo_prompt += json_instruction
-                    
-                    # OpenAI APIでメモを生成（JSONモード）
-                    if client_openai:
-                        try:
-                            response = client_openai.chat.completions.create(
-                                model=model,
-                                messages=[
-                                    {"role": "system", "content": memo_prompt},
-                                    {"role": "user", "content": input_text}
-                                ],
-                                max_tokens=2000,
-                                temperature=0.3,
-                                response_format={"type": "json_object"}
-                            )
-                            
-                            # JSONレスポンスをパース
-                            response_content = response.choices[0].message.content
-                            try:
-                                memo_json = json.loads(response_content)
-                                english_title = memo_json.get("english_title", "untitled_memo")
-                                content = memo_json.get("content", input_text)
-                            except json.JSONDecodeError:
-                                logger.warning(f"JSON解析エラー、フォールバックを使用: {response_content}")
-                                english_title = "untitled_memo"
-                                content = input_text
-                            
-                            # ファイル名を生成（YYYYMMDD_HHMMSS_english_title.md）
-                            now = datetime.now()
-                            timestamp = now.strftime("%Y%m%d_%H%M%S")
-                            # 英語タイトルを安全なファイル名に変換
-                            safe_english_title = re.sub(r'[^A-Za-z0-9\-_]', '', english_title)
-                            if not safe_english_title:
-                                safe_english_title = "memo"
-                            filename = f"{timestamp}_{safe_english_title}.md"
-                            
-                            # attachmentsフォルダにファイルを保存
-                            attachments_dir = script_dir / "attachments"
-                            attachments_dir.mkdir(exist_ok=True)
-                            file_path = attachments_dir / filename
-                            
-                            # ファイル内容：コンテンツをそのまま保存
-                            file_content = content
-                            
-                            # UTF-8でファイル保存
-                            with open(file_path, 'w', encoding='utf-8') as f:
-                                f.write(file_content)
-                            
-                            logger.info(f"メモファイル作成: {file_path}")
-                            
-                            try:
-                                # 結果を送信
-                                embed = discord.Embed(
-                                    title="📝 Obsidianメモを作成しました",
-                                    description=f"**ファイル名**: `{filename}`",
-                                    color=0x7C3AED
-                                )
-                                
-                                # 内容のプレビュー（最初の200文字）
-                                preview = content[:200] + "..." if len(content) > 200 else content
-                                embed.add_field(
-                                    name="📄 内容プレビュー",
-                                    value=preview,
-                                    inline=False
-                                )
-                                
-                                await channel.send(embed=embed)
-                                
-                                # ファイルをアップロード
-                                with open(file_path, 'rb') as f:
-                                    file_data = f.read()
-                                
-                                file_obj = io.BytesIO(file_data)
-                                file_message = await channel.send("📝 メモファイルを作成しました！", file=discord.File(file_obj, filename=filename))
-                                
-                                # メモファイルに自動でリアクションを追加
-                                reactions = ['👍', '❓', '❤️', '✏️', '📝']
-                                for reaction in reactions:
-                                    try:
-                                        await file_message.add_reaction(reaction)
-                                        await asyncio.sleep(0.5)  # Discord API レート制限対策
-                                    except Exception as e:
-                                        logger.warning(f"リアクション追加エラー ({reaction}): {e}")
-                                
-                                logger.info("メモファイルにリアクションを追加しました")
-                                
-                                # Discord投稿後、attachmentsフォルダの中身を削除
-                                for attachment_file in attachments_dir.iterdir():
-                                    if attachment_file.is_file():
-                                        attachment_file.unlink()
-                                        logger.info(f"添付ファイル削除: {attachment_file}")
-                                
-                            except Exception as upload_error:
-                                logger.error(f"ファイル投稿エラー: {upload_error}")
-                                # エラーが発生してもファイルは削除する
-                                try:
-                                    file_path.unlink()
-                                    logger.info(f"エラー後のファイル削除: {file_path}")
-                                except Exception as cleanup_error:
-                                    logger.warning(f"ファイル削除エラー: {cleanup_error}")
-                                raise upload_error
-                            
-                        except Exception as e:
-                            logger.error(f"OpenAI API エラー (メモ機能): {e}")
-                            await channel.send(f"{user.mention} ❌ メモの生成中にエラーが発生しました。")
-                    else:
-                        logger.error("エラー: OpenAI APIキーが設定されていません")
-                        await channel.send(f"{user.mention} ❌ エラーが発生しました。管理者にお問い合わせください。")
-                else:
-                    await channel.send(f"{user.mention} ⚠️ メッセージに内容がありません。")
-            
-            # 📝 メモ：記事作成
-            elif payload.emoji.name == '📝':
-                # メッセージ内容または添付ファイル、Embedからテキストを取得
-                input_text = message.content
-                
-                # Embedがある場合は内容を抽出
-                embed_content = extract_embed_content(message)
-                if embed_content:
-                    if input_text:
-                        input_text += f"\n\n【Embed内容】\n{embed_content}"
-                    else:
-                        input_text = embed_content
-                    logger.info("Embed内容を追加")
-                
-                # 添付ファイルがある場合、テキストファイルの内容を読み取り
-                if message.attachments:
-                    for attachment in message.attachments:
-                        file_content = await read_text_attachment(attachment)
-                        if file_content:
-                            if input_text:
-                                input_text += f"\n\n【ファイル: {attachment.filename}】\n{file_content}"
-                            else:
-                                input_text = f"【ファイル: {attachment.filename}】\n{file_content}"
-                            logger.info(f"添付ファイルの内容を追加: {attachment.filename}")
-                
-                if input_text:
-                    # URL検出・警告
-                    await check_content_for_urls(input_text, user, channel)
-                    
-                    # 処理開始メッセージ
-                    message_link = f"https://discord.com/channels/{message.guild.id}/{message.channel.id}/{message.id}"
-                    await channel.send(f"{user.mention} 📝 記事を作成するよ〜！ちょっと待っててね\n📎 元メッセージ: {message_link}")
-                    
-                    # モデルを選択
-                    model = PREMIUM_USER_MODEL if is_premium else FREE_USER_MODEL
-                    
-                    # 記事用プロンプトを読み込み
-                    article_prompt = None
-                    
-                    # 1. ユーザーのカスタムプロンプトをチェック
-                    if user_data and user_data.get('custom_prompt_article'):
-                        article_prompt = user_data['custom_prompt_article']
-                        logger.info(f"ユーザー {user.name} のカスタムプロンプトを使用")
-                    
-                    # 2. カスタムプロンプトがない場合はデフォルトプロンプトファイルを使用
-                    if not article_prompt:
-                        prompt_path = script_dir / "prompt" / "article.txt"
-                        if prompt_path.exists():
-                            with open(prompt_path, 'r', encoding='utf-8') as f:
-                                article_prompt = f.read()
-                            logger.info("デフォルトプロンプトファイルを使用")
-                        else:
-                            article_prompt = "あなたは優秀なライターです。与えられた内容を元に、構造化された記事を作成してください。"
-                            logger.info("フォールバックプロンプトを使用")
-                    
-                    # プロンプトにJSON出力指示を追加（既に含まれていない場合）
-                    if '{"content":' not in article_prompt:
-                        article_prompt += '\n\n出力はJSON形式で、以下のフォーマットに従ってください：\n{"content": "マークダウン形式の記事全文"}'
-                    
-                    # OpenAI APIで記事を生成（JSONモード）
-                    if client_openai:
-                        try:
-                            response = client_openai.chat.completions.create(
-                                model=model,
-                                messages=[
-                                    {"role": "system", "content": article_prompt},
-                                    {"role": "user", "content": input_text}
-                                ],
-                                max_tokens=3000,
-                                temperature=0.7,
-                                response_format={"type": "json_object"}
-                            )
-                            
-                            # JSONレスポンスをパース
-                            response_content = response.choices[0].message.content
-                            try:
-                                article_json = json.loads(response_content)
-                                content = article_json.get("content", response_content)
-                            except json.JSONDecodeError:
-                                logger.warning(f"JSON解析エラー、フォールバックを使用: {response_content}")
-                                content = response_content
-                            
-                            # ファイル名を生成（YYYYMMDD_HHMMSS_article.md）
-                            now = datetime.now()
-                            timestamp = now.strftime("%Y%m%d_%H%M%S")
-                            filename = f"{timestamp}_article.md"
-                            
-                            # attachmentsフォルダにファイルを保存
-                            attachments_dir = script_dir / "attachments"
-                            attachments_dir.mkdir(exist_ok=True)
-                            file_path = attachments_dir / filename
-                            
-                            # UTF-8でファイル保存
-                            with open(file_path, 'w', encoding='utf-8') as f:
-                                f.write(content)
-                            
-                            logger.info(f"記事ファイル作成: {file_path}")
-                            
-                            try:
-                                # 記事のタイトルを抽出（最初の#行）
-                                lines = content.split('\n')
-                                title = "記事"
-                                for line in lines:
-                                    if line.strip().startswith('# '):
-                                        title = line.strip()[2:].strip()
-                                        break
-                                
-                                # 結果を送信
-                                embed = discord.Embed(
-                                    title="📝 記事を作成しました",
-                                    description=f"**タイトル**: {title}\n**ファイル名**: `{filename}`",
-                                    color=0x00bfa5
-                                )
-                                
-                                # 内容のプレビュー（最初の300文字）
-                                preview = content[:300] + "..." if len(content) > 300 else content
-                                embed.add_field(
-                                    name="📄 内容プレビュー",
-                                    value=f"```markdown\n{preview}\n```",
-                                    inline=False
-                                )
-                                
-                                await channel.send(embed=embed)
-                                
-                                # ファイルをアップロード
-                                with open(file_path, 'rb') as f:
-                                    file_data = f.read()
-                                
-                                file_obj = io.BytesIO(file_data)
-                                file_message = await channel.send("📝 記事ファイルです！", file=discord.File(file_obj, filename=filename))
-                                
-                                # 記事ファイルに自動でリアクションを追加
-                                reactions = ['👍', '❓', '❤️', '✏️', '📝']
-                                for reaction in reactions:
-                                    try:
-                                        await file_message.add_reaction(reaction)
-                                        await asyncio.sleep(0.5)  # Discord API レート制限対策
-                                    except Exception as e:
-                                        logger.warning(f"リアクション追加エラー ({reaction}): {e}")
-                                
-                                logger.info("記事ファイルにリアクションを追加しました")
-                                
-                                # Discord投稿後、attachmentsフォルダの中身を削除
-                                for attachment_file in attachments_dir.iterdir():
-                                    if attachment_file.is_file():
-                                        attachment_file.unlink()
-                                        logger.info(f"添付ファイル削除: {attachment_file}")
-                                
-                            except Exception as upload_error:
-                                logger.error(f"ファイル投稿エラー: {upload_error}")
-                                # エラーが発生してもファイルは削除する
-                                try:
-                                    file_path.unlink()
-                                    logger.info(f"エラー後のファイル削除: {file_path}")
-                                except Exception as cleanup_error:
-                                    logger.warning(f"ファイル削除エラー: {cleanup_error}")
-                                raise upload_error
-                            
-                        except Exception as e:
-                            logger.error(f"OpenAI API エラー (記事機能): {e}")
-                            await channel.send(f"{user.mention} ❌ 記事の生成中にエラーが発生しました。")
-                    else:
-                        logger.error("エラー: OpenAI APIキーが設定されていません")
-                        await channel.send(f"{user.mention} ❌ エラーが発生しました。管理者にお問い合わせください。")
-                else:
-                    await channel.send(f"{user.mention} ⚠️ メッセージに内容がありません。")
+
+            # 重い処理はジョブとしてキューに積み、ワーカーが順番に処理する
+            # （同じメッセージへの連続したリアクションは短時間待ってまとめる）
+            await reaction_batcher.add(payload.guild_id, payload.emoji.name, message, channel, user, user_data, is_premium)
+
 
 @bot.event
 async def on_message(message):
@@ -2209,7 +4232,10 @@ async def on_message(message):
 
 
 if __name__ == "__main__":
-    if TOKEN is None:
+    if "--import-json" in sys.argv:
+        # 既存のJSONデータをSQLiteへ移行（python main.py --import-json）
+        import_json_to_sqlite(sqlite_storage or SQLiteStorage(SQLITE_DB_PATH))
+    elif TOKEN is None:
         logger.error("エラー: DISCORD_BOT_TOKEN 環境変数が設定されていません")
     else:
         try:
@@ -0,0 +1,84 @@
+"""
+テスト共通のヘルパー（OpenAIの応答・Discordのチャンネル・ffmpegのプロセスなどのモック）
+"""
+import unittest
+from datetime import datetime
+import tempfile
+import shutil
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+from pathlib import Path
+import sys
+
+# テスト対象のmain.pyをインポートするためのパス設定
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+
+class BotTestCase(unittest.IsolatedAsyncioTestCase):
+    """一時ディレクトリを用意する非同期テストの基底クラス"""
+
+    def setUp(self):
+        """テスト前の準備"""
+        self.temp_dir = tempfile.mkdtemp()
+        self.temp_path = Path(self.temp_dir)
+
+    def tearDown(self):
+        """テスト後のクリーンアップ"""
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+
+def chat_response(content, usage=None):
+    """chat.completions.create（非ストリーミング）の応答"""
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=usage)
+
+
+def stream_chunk(content=None, usage=None, role=None):
+    """ストリーミング応答の1チャンク（contentがNoneなら使用量だけのチャンク）"""
+    if content is None and role is None:
+        return SimpleNamespace(choices=[], usage=usage)
+    delta = SimpleNamespace(content=content, role=role)
+    return SimpleNamespace(choices=[SimpleNamespace(delta=delta)], usage=usage)
+
+
+def mock_openai_client(**create_kwargs):
+    """chat.completions.create をAsyncMockにしたOpenAIクライアント"""
+    client = MagicMock()
+    client.chat.completions.create = AsyncMock(**create_kwargs)
+    return client
+
+
+def mock_channel(sent_message=None):
+    """sendが送信済みメッセージ（editできる）を返すチャンネル"""
+    if sent_message is None:
+        sent_message = MagicMock()
+        sent_message.edit = AsyncMock()
+        sent_message.delete = AsyncMock()
+    channel = MagicMock()
+    channel.send = AsyncMock(return_value=sent_message)
+    return channel
+
+
+def fake_process(stdout=b"", stderr=b"", returncode=0):
+    """asyncio.create_subprocess_exec が返すプロセス"""
+    process = MagicMock()
+    process.communicate = AsyncMock(return_value=(stdout, stderr))
+    process.wait = AsyncMock(return_value=returncode)
+    process.returncode = returncode
+    return process
+
+
+def fake_subprocess_exec(calls, respond=None):
+    """実行されたコマンドをcallsに記録し、respond(args)のプロセス（省略時は正常終了）を返すcreate_subprocess_exec"""
+    async def create_subprocess_exec(*args, **kwargs):
+        calls.append(args)
+        return respond(args) if respond else fake_process()
+    return create_subprocess_exec
+
+
+def frozen_datetime(clock):
+    """now()がclock[0]を返すdatetime（clock[0]を書き換えて時刻を進める）"""
+    class FrozenDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return clock[0]
+    return FrozenDatetime
@@ -0,0 +1,180 @@
+"""
+音声の文字起こし（ffmpegでの分割・変換と並列文字起こし）のテスト
+"""
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, patch
+from pathlib import Path
+
+from tests.helpers import BotTestCase, fake_process, fake_subprocess_exec
+
+
+class TestAudio(BotTestCase):
+    """音声の文字起こし（ffmpegでの分割・変換と並列文字起こし）のテストクラス"""
+
+    async def test_transcribe_parts_parallel(self):
+        """分割ファイルの並列文字起こし（順番の保持・同時実行数・パート単位の再試行）"""
+        from main import transcribe_parts
+
+        running = [0]
+        peak = [0]
+        failed_once = set()
+
+        async def fake_transcribe(model, file, language):
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+            try:
+                index = int(file.stem.split("_")[1])
+                # 後ろのパートほど早く終わる
+                await asyncio.sleep(0.01 * (5 - index))
+                if index == 2 and index not in failed_once:
+                    failed_once.add(index)
+                    raise RuntimeError("一時的なエラー")
+                return SimpleNamespace(text=f"テキスト{index}")
+            finally:
+                running[0] -= 1
+
+        mock_client = MagicMock()
+        mock_client.audio.transcriptions.create = AsyncMock(side_effect=fake_transcribe)
+        parts = [Path(f"part_{i}.mp3") for i in range(5)]
+        real_sleep = asyncio.sleep
+
+        async def short_sleep(seconds):
+            await real_sleep(min(seconds, 0.05))
+
+        with patch('main.client_openai', mock_client), patch('main.WHISPER_CONCURRENCY', 2), \
+             patch('main.asyncio.sleep', side_effect=short_sleep):
+            texts = await transcribe_parts(parts)
+
+        self.assertEqual(texts, [f"テキスト{i}" for i in range(5)])
+        self.assertEqual(peak[0], 2)
+        self.assertEqual(mock_client.audio.transcriptions.create.call_count, 6)
+
+    async def test_ffmpeg_segmentation(self):
+        """ffprobeでの長さ取得とffmpegによる分割（サブプロセスに任せてメモリに展開しない）"""
+        from main import probe_audio_duration, segment_audio, FFmpegError
+
+        calls = []
+
+        def respond(args):
+            if args[0] == "ffprobe":
+                return fake_process(stdout=b"1234.5\n")
+            # ffmpegが書き出すはずの分割ファイルを用意する
+            output_dir = Path(args[-1]).parent
+            for i in (2, 0, 1):
+                (output_dir / f"part_{i:03d}.mp3").write_bytes(b"x")
+            return fake_process()
+
+        temp_path = self.temp_path
+        with patch('main.asyncio.create_subprocess_exec', side_effect=fake_subprocess_exec(calls, respond)):
+            duration = await probe_audio_duration(temp_path / "original.mp3")
+            parts = await segment_audio(temp_path / "original.mp3", temp_path, [400.0, 800.0])
+
+        self.assertEqual(duration, 1234.5)
+        self.assertEqual([p.name for p in parts], ["part_000.mp3", "part_001.mp3", "part_002.mp3"])
+        ffmpeg_args = calls[1]
+        self.assertEqual(ffmpeg_args[ffmpeg_args.index("-segment_times") + 1], "400.000,800.000")
+
+        # ffmpegがエラー終了した場合は例外にする
+        with patch('main.asyncio.create_subprocess_exec',
+                   AsyncMock(return_value=fake_process(returncode=1, stderr=b"Invalid data"))):
+            with self.assertRaises(FFmpegError):
+                await segment_audio(temp_path / "original.mp3", temp_path, [])
+
+    async def test_silence_aware_split_points(self):
+        """無音検出の結果から、目標の長さ付近の無音で区切る位置を決める"""
+        from main import detect_silences, plan_split_points
+
+        stderr = (
+            b"[silencedetect @ 0x1] silence_start: 590.2\n"
+            b"[silencedetect @ 0x1] silence_end: 591.0 | silence_duration: 0.8\n"
+            b"[silencedetect @ 0x1] silence_start: 1205.5\n"
+            b"[silencedetect @ 0x1] silence_end: 1206.5 | silence_duration: 1.0\n"
+            b"[silencedetect @ 0x1] silence_start: 1790\n"
+        )
+        with patch('main.asyncio.create_subprocess_exec', AsyncMock(return_value=fake_process(stderr=stderr))):
+            silences = await detect_silences(Path("original.mp3"))
+        # 終わりのない無音区間は使わない
+        self.assertEqual(silences, [(590.2, 591.0), (1205.5, 1206.5)])
+
+        # 目標600秒ごと：近くの無音があればそこで、なければ目標位置で切る
+        cuts = plan_split_points(2400, 600, 1500, silences, tolerance=30)
+        self.assertEqual(cuts[:2], [590.6, 1206.0])
+        self.assertAlmostEqual(cuts[2], 1806.0)
+        self.assertEqual(len(cuts), 3)
+
+        # 無音があっても1パートの上限（25MB相当）は超えない
+        cuts = plan_split_points(1200, 600, 595, [(598.0, 599.0)], tolerance=30)
+        self.assertTrue(all(b - a <= 595 for a, b in zip([0] + cuts, cuts + [1200])))
+
+        # 目標＋許容範囲に収まる長さなら分割しない
+        self.assertEqual(plan_split_points(620, 600, 1500, [], tolerance=30), [])
+
+    async def test_plan_part_sizes(self):
+        """変換後の実際のサイズから分割数を決める（長さの上限は設定した場合のみ）"""
+        from main import plan_part_sizes
+
+        # 24kbpsで3時間（約32MB）の音声は20MBごとに2分割で済む
+        with patch('main.WHISPER_TARGET_UPLOAD_MB', 20), patch('main.WHISPER_MAX_UPLOAD_MB', 25), \
+             patch('main.WHISPER_MAX_PART_SECONDS', 0):
+            split_count, max_part_seconds = plan_part_sizes(10800, 32.4)
+            self.assertEqual(split_count, 2)
+            self.assertAlmostEqual(max_part_seconds, 7500)
+            self.assertEqual(plan_part_sizes(3600, 10.8)[0], 1)
+
+        # 目標サイズは上限の9割までに抑える
+        with patch('main.WHISPER_TARGET_UPLOAD_MB', 30), patch('main.WHISPER_MAX_UPLOAD_MB', 25), \
+             patch('main.WHISPER_MAX_PART_SECONDS', 0):
+            self.assertEqual(plan_part_sizes(10800, 40)[0], 2)
+
+        # 長さの上限を設定した場合はそれも守る
+        with patch('main.WHISPER_TARGET_UPLOAD_MB', 20), patch('main.WHISPER_MAX_UPLOAD_MB', 25), \
+             patch('main.WHISPER_MAX_PART_SECONDS', 600):
+            self.assertEqual(plan_part_sizes(10800, 32.4), (18, 600))
+
+    async def test_audio_stream_copy(self):
+        """Whisperが読めるコーデックは再エンコードせずにストリームコピーする"""
+        from main import extract_audio_track, segment_audio
+
+        codec = [b"aac\n"]
+        calls = []
+
+        def respond(args):
+            return fake_process(stdout=codec[0] if args[0] == "ffprobe" else b"")
+
+        temp_path = self.temp_path
+        with patch('main.asyncio.create_subprocess_exec', side_effect=fake_subprocess_exec(calls, respond)):
+            # AACの動画は m4a にそのままコピーする
+            output = await extract_audio_track(temp_path / "original.mp4", temp_path)
+            self.assertEqual(output.name, "extracted_audio.m4a")
+            self.assertIn("copy", calls[-1])
+
+            # 対応していないコーデックはmp3に変換する
+            codec[0] = b"pcm_mulaw\n"
+            output = await extract_audio_track(temp_path / "original.mp4", temp_path)
+            self.assertEqual(output.name, "extracted_audio.mp3")
+            self.assertIn("libmp3lame", calls[-1])
+
+            # 分割もコピーで元の形式のまま切り出す
+            await segment_audio(temp_path / "original.m4a", temp_path, [600.0], copy_ext="m4a")
+            self.assertIn("copy", calls[-1])
+            self.assertTrue(calls[-1][-1].endswith("part_%03d.m4a"))
+
+    async def test_normalize_audio(self):
+        """文字起こし前に16kHzモノラルの低ビットレートへ変換する"""
+        from main import normalize_audio
+
+        calls = []
+        with patch('main.asyncio.create_subprocess_exec', side_effect=fake_subprocess_exec(calls)):
+            output = await normalize_audio(Path("original.mp4"), self.temp_path)
+            with patch('main.AUDIO_NORMALIZE_FORMAT', 'mp3'):
+                mp3_output = await normalize_audio(Path("original.wav"), self.temp_path)
+
+        self.assertEqual(output.name, "normalized.ogg")
+        self.assertIn("libopus", calls[0])
+        self.assertEqual(mp3_output.name, "normalized.mp3")
+        self.assertIn("libmp3lame", calls[1])
+        for args in calls:
+            self.assertEqual(args[args.index("-ac") + 1], "1")
+            self.assertEqual(args[args.index("-ar") + 1], "16000")
+            self.assertIn("-vn", args)
@@ -84,14 +84,18 @@ class TestCustomPromptFixed(unittest.IsolatedAsyncioTestCase):
         self.assertIsNotNone(modal.prompt_input.default)
 
     @patch('main.script_dir')
+    @patch('main.user_store')
     @patch('main.save_user_data')
     @patch('main.load_user_data')
-    async def test_modal_submit_functionality(self, mock_load_user, mock_save_user, mock_script_dir):
+    async def test_modal_submit_functionality(self, mock_load_user, mock_save_user, mock_user_store, mock_script_dir):
         """モーダル送信機能のテスト"""
-        from main import CustomPromptModal
+        from main import CustomPromptModal, UserDataStore
         
-        # 新規ユーザー
+        # 新規ユーザー（テストごとに新しいストアを使用）
         mock_load_user.return_value = None
+        store = UserDataStore()
+        mock_user_store.get.side_effect = store.get
+        mock_user_store.put.side_effect = store.put
         
         # モーダルのインスタンス作成
         modal = CustomPromptModal()
@@ -100,7 +104,9 @@ class TestCustomPromptFixed(unittest.IsolatedAsyncioTestCase):
         # on_submitメソッドをテスト
         await modal.on_submit(self.mock_interaction)
         
-        # save_user_dataが呼ばれることを確認
+        # フラッシュ時にsave_user_dataが呼ばれることを確認
+        mock_save_user.assert_not_called()
+        await store.flush()
         mock_save_user.assert_called_once()
         
         # 保存されるデータの確認
@@ -191,7 +197,7 @@ class TestCustomPromptFixed(unittest.IsolatedAsyncioTestCase):
         modal.prompt_input.value = "テストプロンプト"
         
         with patch('main.load_user_data', return_value=None), \
-             patch('main.save_user_data', side_effect=Exception("保存エラー")):
+             patch('main.user_store.put', side_effect=Exception("保存エラー")):
             
             # on_submitメソッドをテスト
             await modal.on_submit(self.mock_interaction)
@@ -243,11 +249,11 @@ class TestCustomPromptWorkflow(unittest.IsolatedAsyncioTestCase):
                 
                 self.mock_interaction.response.send_message.reset_mock()
                 
-                with patch('main.save_user_data') as mock_save:
+                with patch('main.user_store.put') as mock_put:
                     await modal.on_submit(self.mock_interaction)
                     
-                    # データが保存されることを確認
-                    mock_save.assert_called_once()
+                    # データがストアに保存されることを確認
+                    mock_put.assert_called_once()
                     
                     # 成功メッセージが送信されることを確認
                     self.mock_interaction.response.send_message.assert_called_once()
@@ -0,0 +1,230 @@
+"""
+プロンプト・生成（ストリーミング・キャッシュ・入力上限）のテスト
+"""
+import asyncio
+import os
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from tests.helpers import BotTestCase, chat_response, stream_chunk, mock_openai_client, mock_channel
+
+
+class TestGeneration(BotTestCase):
+    """プロンプト・生成（ストリーミング・キャッシュ・入力上限）のテストクラス"""
+
+    async def test_prompt_registry_reload(self):
+        """プロンプトキャッシュのテスト（更新時刻が変わった時だけ読み直す）"""
+        from main import PromptRegistry, PROMPT_SPECS
+
+        prompt_dir = self.temp_path / "prompt"
+        prompt_dir.mkdir()
+        prompt_file = prompt_dir / "pencil_memo.txt"
+        prompt_file.write_text("メモ v1", encoding='utf-8')
+
+        with patch('main.script_dir', self.temp_path):
+            registry = PromptRegistry(PROMPT_SPECS)
+            first = registry.get("pencil_memo")
+            self.assertTrue(first.startswith("メモ v1"))
+            self.assertIn('"english_title"', first)
+
+            # 更新がなければファイルを開かない
+            with patch('builtins.open') as mock_open:
+                self.assertEqual(registry.get("pencil_memo"), first)
+                mock_open.assert_not_called()
+
+            prompt_file.write_text("メモ v2", encoding='utf-8')
+            os.utime(prompt_file, ns=(0, prompt_file.stat().st_mtime_ns + 1_000_000))
+            self.assertTrue(registry.get("pencil_memo").startswith("メモ v2"))
+
+            # ファイルがない場合は代替プロンプト、出力形式を含むカスタムには指示を追加しない
+            self.assertEqual(registry.get("question_explain"), PROMPT_SPECS["question_explain"]["fallback"])
+            custom = '記事を書いて {"content": "..."}'
+            self.assertEqual(registry.get("article", custom), custom)
+
+            # まとめて処理する場合（get）と同じ、出力形式の指示を付けたシステムプロンプトと入力の2件
+            self.assertEqual(registry.build_messages("pencil_memo", "入力A"), [
+                {"role": "system", "content": registry.get("pencil_memo")},
+                {"role": "user", "content": "入力A"}
+            ])
+            custom_messages = registry.build_messages("pencil_memo", "入力B", "自分用のメモ指示")
+            self.assertTrue(custom_messages[0]["content"].startswith("自分用のメモ指示"))
+            self.assertIn('"english_title"', custom_messages[0]["content"])
+
+    async def test_stream_chat_completion(self):
+        """ストリーミング生成のテスト（途中経過の編集と全文の返却）"""
+        from main import stream_chat_completion, extract_partial_json_content
+
+        self.assertEqual(extract_partial_json_content('{"content": "# 見出し\\n本'), "# 見出し\n本")
+        self.assertEqual(extract_partial_json_content('{"content": "途中\\u30'), "途中")
+        self.assertEqual(extract_partial_json_content('{"content": "完成"}'), "完成")
+        self.assertEqual(extract_partial_json_content('{"con'), "")
+
+        async def fake_stream():
+            for piece in ['{"content": "', "こん", "にち", "は", '"}']:
+                yield stream_chunk(piece)
+
+        mock_client = mock_openai_client(return_value=fake_stream())
+        progress = MagicMock()
+        progress.edit = AsyncMock()
+        channel = mock_channel(progress)
+
+        with patch('main.client_openai', mock_client), patch('main.STREAM_EDIT_INTERVAL', 0):
+            text, message = await stream_chat_completion(
+                channel, "生成中", render=extract_partial_json_content, model="m", messages=[]
+            )
+
+        self.assertEqual(text, '{"content": "こんにちは"}')
+        self.assertIs(message, progress)
+        self.assertTrue(mock_client.chat.completions.create.call_args.kwargs["stream"])
+        channel.send.assert_called_once()
+        self.assertIn("こん", channel.send.call_args.args[0])
+        self.assertIn("こんにちは", progress.edit.call_args.kwargs["content"])
+
+    async def test_partial_stream_message_cleanup(self):
+        """途中で失敗したときに生成途中のメッセージ（▌付き）を残さないテスト"""
+        from main import stream_chat_completion, replace_progress_message
+
+        async def broken_stream():
+            yield stream_chunk("こん")
+            raise ConnectionError("切断")
+
+        mock_client = mock_openai_client(return_value=broken_stream())
+        channel = mock_channel()
+        progress = channel.send.return_value
+
+        with patch('main.client_openai', mock_client), patch('main.STREAM_EDIT_INTERVAL', 0):
+            with self.assertRaises(ConnectionError):
+                await stream_chat_completion(channel, "生成中", model="stream-cleanup-model", messages=[])
+        progress.delete.assert_called_once()
+
+        # 生成後の処理で失敗した場合は途中経過のメッセージをエラーメッセージに差し替える
+        channel = mock_channel()
+        progress = channel.send.return_value
+        await replace_progress_message(progress, channel, "❌ エラー")
+        progress.edit.assert_called_once_with(content="❌ エラー", embed=None)
+        channel.send.assert_not_called()
+
+        await replace_progress_message(None, channel, "❌ エラー")
+        channel.send.assert_called_once_with("❌ エラー")
+
+    async def test_generation_cache(self):
+        """生成キャッシュのテスト（同一入力の再利用・LRU・有効期限・保存）"""
+        from main import GenerationCache, generate_completion
+
+        cache_path = self.temp_path / "generation_cache.json"
+        cache = GenerationCache(max_size=2, ttl=60, path=str(cache_path))
+        self.assertFalse(cache.enabled_for("heart_praise"))
+        self.assertTrue(cache.enabled_for("question_explain"))
+
+        response = chat_response("解説です")
+        mock_client = mock_openai_client(return_value=response)
+        messages = [{"role": "system", "content": "解説して"}, {"role": "user", "content": "お知らせ"}]
+
+        with patch('main.client_openai', mock_client), patch('main.generation_cache', cache):
+            first, _ = await generate_completion("x_post", model="m", messages=messages)
+            second, _ = await generate_completion("x_post", model="m", messages=messages)
+            # モデルが違えば別のキャッシュ
+            await generate_completion("x_post", model="other", messages=messages)
+        self.assertEqual((first, second), ("解説です", "解説です"))
+        self.assertEqual(mock_client.chat.completions.create.call_count, 2)
+
+        # LRUで古いものから追い出す
+        cache.put(cache.make_key("article", "m", messages), "記事")
+        self.assertIsNone(cache.get(cache.make_key("x_post", "m", messages)))
+
+        # ディスクに保存して読み直せる、期限切れは捨てる
+        await cache.flush()
+        restored = GenerationCache(max_size=2, ttl=60, path=str(cache_path))
+        restored.load()
+        self.assertEqual(restored.get(cache.make_key("article", "m", messages)), "記事")
+        with patch('main.time.time', return_value=10 ** 12):
+            self.assertIsNone(restored.get(cache.make_key("article", "m", messages)))
+
+    async def test_generation_single_flight(self):
+        """同時に来た同一リクエストが1回の生成にまとめられることのテスト"""
+        from main import GenerationCache, generate_completion
+
+        release = asyncio.Event()
+
+        async def slow_create(**kwargs):
+            await release.wait()
+            return chat_response("まとめ")
+
+        mock_client = mock_openai_client(side_effect=slow_create)
+        messages = [{"role": "system", "content": "要約して"}, {"role": "user", "content": "人気の投稿"}]
+
+        with patch('main.client_openai', mock_client), patch('main.generation_cache', GenerationCache(path="")):
+            tasks = [asyncio.create_task(generate_completion("x_post", model="m", messages=messages)) for _ in range(5)]
+            await asyncio.sleep(0)
+            release.set()
+            results = await asyncio.gather(*tasks)
+            self.assertEqual([content for content, _ in results], ["まとめ"] * 5)
+            self.assertEqual(mock_client.chat.completions.create.call_count, 1)
+
+            # 失敗した場合は待っていた全員にエラーが伝わる
+            async def slow_fail(**kwargs):
+                await asyncio.sleep(0.01)
+                raise RuntimeError("API error")
+
+            mock_client.chat.completions.create = AsyncMock(side_effect=slow_fail)
+            failing = [asyncio.create_task(generate_completion("article", model="m", messages=messages)) for _ in range(3)]
+            outcomes = await asyncio.gather(*failing, return_exceptions=True)
+            self.assertTrue(all(isinstance(o, RuntimeError) for o in outcomes))
+            self.assertEqual(mock_client.chat.completions.create.call_count, 1)
+
+    async def test_fit_input_to_budget(self):
+        """長い入力を分割して並列に要約し、上限内に収めることのテスト"""
+        from main import fit_input_to_budget, split_text_by_tokens, count_tokens, GenerationCache
+
+        with patch('main.tiktoken', None):
+            # 短い入力はそのまま
+            self.assertEqual(await fit_input_to_budget("article", "m", "短い投稿"), "短い投稿")
+
+            long_text = "\n".join(f"{i}行目の長い文章です。" * 3 for i in range(200))
+            chunks = split_text_by_tokens(long_text, 500, "m")
+            self.assertGreater(len(chunks), 1)
+            self.assertTrue(all(count_tokens(chunk, "m") <= 500 for chunk in chunks))
+            self.assertEqual("\n".join(chunks), long_text)
+
+            mock_client = mock_openai_client(
+                return_value=chat_response("要点")
+            )
+            with patch('main.client_openai', mock_client), \
+                 patch('main.generation_cache', GenerationCache(path="")), \
+                 patch.dict('main.FEATURE_INPUT_BUDGETS', {"article": 1000}), \
+                 patch('main.MAP_CHUNK_TOKENS', 800):
+                result = await fit_input_to_budget("article", "m", long_text)
+
+            calls = mock_client.chat.completions.create.call_args_list
+            self.assertEqual(len(calls), len(split_text_by_tokens(long_text, 800, "m")))
+            self.assertIn("記事", calls[0].kwargs["messages"][0]["content"])
+            self.assertTrue(result.startswith("【パート 1/"))
+            self.assertLessEqual(count_tokens(result, "m"), 1000)
+
+    async def test_prompt_cache_stats(self):
+        """キャッシュされた入力トークン数を機能ごとに記録するテスト"""
+        from main import PromptCacheStats, stream_chat_completion
+
+        stats = PromptCacheStats()
+        stats.record("x_post", SimpleNamespace(prompt_tokens=2000, prompt_tokens_details=SimpleNamespace(cached_tokens=1536)))
+        stats.record("x_post", SimpleNamespace(prompt_tokens=2000, prompt_tokens_details=None))
+        stats.record("x_post", None)
+        summary = stats.summary()["x_post"]
+        self.assertEqual(summary["requests"], 2)
+        self.assertEqual(summary["cached_tokens"], 1536)
+        self.assertAlmostEqual(summary["hit_rate"], 0.384)
+
+        # ストリーミングでは最後のチャンクの使用量を記録する
+        async def fake_stream():
+            yield stream_chunk("解説")
+            yield stream_chunk(usage=SimpleNamespace(
+                prompt_tokens=1200, prompt_tokens_details=SimpleNamespace(cached_tokens=1024)))
+
+        mock_client = mock_openai_client(return_value=fake_stream())
+        channel = mock_channel()
+        stream_stats = PromptCacheStats()
+        with patch('main.client_openai', mock_client), patch('main.prompt_cache_stats', stream_stats):
+            text, _ = await stream_chat_completion(channel, "生成中", feature="question_explain", model="m", messages=[])
+        self.assertEqual(text, "解説")
+        self.assertEqual(mock_client.chat.completions.create.call_args.kwargs["stream_options"], {"include_usage": True})
+        self.assertEqual(stream_stats.summary()["question_explain"]["cached_tokens"], 1024)
@@ -0,0 +1,204 @@
+"""
+OpenAI呼び出し（リトライ・レート制限・ヘッジ）のテスト
+"""
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from tests.helpers import BotTestCase, mock_openai_client, mock_channel, stream_chunk
+
+
+class TestOpenAICalls(BotTestCase):
+    """OpenAI呼び出し（リトライ・レート制限・ヘッジ）のテストクラス"""
+
+    async def test_call_openai_resilience(self):
+        """OpenAI呼び出しのリトライ・サーキットブレーカー・代替モデル切り替えのテスト"""
+        from openai import APIStatusError
+        import main
+        from main import call_openai, CircuitBreaker, OpenAIUnavailableError
+
+        def status_error(code, headers=None):
+            response = MagicMock()
+            response.status_code = code
+            response.headers = headers or {}
+            return APIStatusError("error", response=response, body=None)
+
+        sleep = AsyncMock()
+        with patch('main.asyncio.sleep', sleep), patch.dict('main.circuit_breakers', clear=True), \
+             patch('main.PREMIUM_USER_MODEL', "premium"), patch('main.FREE_USER_MODEL', "free"), \
+             patch('main.OPENAI_MAX_RETRIES', 2):
+            # 429はRetry-Afterを守ってリトライする
+            create = AsyncMock(side_effect=[status_error(429, {"retry-after": "7"}), "ok"])
+            self.assertEqual(await call_openai(create, model="free"), "ok")
+            self.assertEqual(sleep.call_args.args[0], 7)
+
+            # 400はリトライしない
+            create = AsyncMock(side_effect=status_error(400))
+            with self.assertRaises(APIStatusError):
+                await call_openai(create, model="free")
+            self.assertEqual(create.call_count, 1)
+
+            # プレミアム用モデルが失敗し続けたら無料用モデルに切り替える
+            async def premium_down(**kwargs):
+                if kwargs["model"] == "premium":
+                    raise status_error(503)
+                return kwargs["model"]
+            self.assertEqual(await call_openai(AsyncMock(side_effect=premium_down), model="premium"), "free")
+
+            # ブレーカーが開いたモデルは呼ばずに切り替える／代替がなければエラー
+            main.circuit_breakers["premium"] = CircuitBreaker(failure_threshold=1)
+            main.circuit_breakers["premium"].record_failure()
+            create = AsyncMock(return_value="fallback")
+            self.assertEqual(await call_openai(create, model="premium"), "fallback")
+            self.assertEqual(create.call_args.kwargs["model"], "free")
+            main.circuit_breakers["free"] = CircuitBreaker(failure_threshold=1)
+            main.circuit_breakers["free"].record_failure()
+            with self.assertRaises(OpenAIUnavailableError):
+                await call_openai(create, model="free")
+
+    async def test_rate_limiter(self):
+        """モデルごとのRPM/TPM制限のテスト（空きを待ってから呼び出す）"""
+        from main import RateLimiter, call_openai
+
+        clock = [1000.0]
+
+        async def fake_sleep(seconds):
+            clock[0] += seconds
+
+        with patch('main.time.monotonic', side_effect=lambda: clock[0]), \
+             patch('main.asyncio.sleep', side_effect=fake_sleep), patch('main.tiktoken', None):
+            limiter = RateLimiter({"m": {"rpm": 2, "tpm": 1000}})
+            with patch('main.rate_limiter', limiter):
+                create = AsyncMock(return_value=SimpleNamespace(usage=SimpleNamespace(total_tokens=100)))
+                request = {"model": "m", "messages": [{"role": "user", "content": "a" * 300}], "max_tokens": 300}
+
+                await call_openai(create, **request)
+                await call_openai(create, **request)
+                self.assertEqual(clock[0], 1000.0)
+
+                # 3回目はRPMの空き（30秒）を待つ
+                await call_openai(create, **request)
+                self.assertEqual(clock[0], 1030.0)
+                self.assertEqual(create.call_count, 3)
+
+                state = limiter.snapshot()["m"]
+                self.assertEqual(state["rpm_limit"], 2)
+                self.assertEqual(state["throttled"], 1)
+                self.assertEqual(state["waiting"], 0)
+                # 実際の使用量（100トークン）で見積もり（400トークン）を補正している
+                self.assertGreater(state["tpm_available"], 1000 - 3 * 400)
+
+                # 使える量は参照した時点までの経過時間分を補充して返す
+                clock[0] += 30
+                self.assertEqual(limiter.get("m").requests.available(), 1)
+
+                # 設定のないモデルは制限しない
+                self.assertIsNone(limiter.get("other"))
+
+    async def test_hedged_request(self):
+        """応答が遅いときに追加リクエストを送り、先に返った方を使うテスト"""
+        from main import LatencyTracker, hedged_request
+
+        calls = []
+        cancelled = []
+
+        async def attempt():
+            index = len(calls)
+            calls.append(index)
+            try:
+                # 1回目は遅く、2回目はすぐに返る
+                await asyncio.sleep(1 if index == 0 else 0)
+            except asyncio.CancelledError:
+                cancelled.append(index)
+                raise
+            return f"response {index}"
+
+        tracker = LatencyTracker(default_delay=0.01, budget_ratio=1.0)
+        with patch('main.HEDGED_REQUESTS', True), patch('main.latency_tracker', tracker):
+            self.assertEqual(await hedged_request("x_post", attempt), "response 1")
+            await asyncio.sleep(0)
+            self.assertEqual(cancelled, [0])
+
+            # 対象外の機能はヘッジしない
+            calls.clear()
+            self.assertEqual(await hedged_request("article", attempt), "response 0")
+            self.assertEqual(len(calls), 1)
+
+        # 予算を超える場合は追加リクエストを送らずに待つ
+        calls.clear()
+        tracker = LatencyTracker(default_delay=0.01, budget_ratio=0.0)
+        with patch('main.HEDGED_REQUESTS', True), patch('main.latency_tracker', tracker):
+            result = await asyncio.wait_for(hedged_request("question_explain", attempt), timeout=5)
+        self.assertEqual(result, "response 0")
+        self.assertEqual(len(calls), 1)
+
+        # 記録が溜まるとp90を待ち時間に使う
+        tracker = LatencyTracker(min_samples=10)
+        for latency in range(1, 11):
+            tracker.record("x_post", float(latency))
+        self.assertEqual(tracker.threshold("x_post"), 9.0)
+
+    async def test_stream_failure_recorded_on_breaker(self):
+        """ストリームの途中で失敗した場合はリトライせず、サーキットブレーカーに失敗を記録する"""
+        from main import stream_chat_completion, get_circuit_breaker
+
+        async def broken_stream():
+            yield stream_chunk("途中まで")
+            raise ConnectionError("connection reset")
+
+        mock_client = mock_openai_client(return_value=broken_stream())
+        with patch('main.client_openai', mock_client), patch.dict('main.circuit_breakers', clear=True), \
+             patch('main.STREAM_RESPONSES', True):
+            with self.assertRaises(ConnectionError):
+                await stream_chat_completion(mock_channel(), "生成中", model="m", messages=[])
+            self.assertEqual(get_circuit_breaker("m").failures, 1)
+        self.assertEqual(mock_client.chat.completions.create.call_count, 1)
+
+    async def test_stream_usage_credited_to_rate_limiter(self):
+        """ストリーミングでも最後のチャンクの使用量でTPMの見積もりを補正する"""
+        from main import RateLimiter, stream_chat_completion
+
+        async def fake_stream():
+            yield stream_chunk("本文")
+            yield stream_chunk(usage=SimpleNamespace(total_tokens=100, prompt_tokens=90))
+
+        limiter = RateLimiter({"m": {"tpm": 10000}})
+        with patch('main.client_openai', mock_openai_client(return_value=fake_stream())), \
+             patch('main.rate_limiter', limiter), patch('main.STREAM_RESPONSES', True), \
+             patch('main.tiktoken', None):
+            text, _ = await stream_chat_completion(
+                mock_channel(), "生成中", model="m", messages=[{"role": "user", "content": "a" * 300}], max_tokens=3000
+            )
+            self.assertEqual(text, "本文")
+            # 見積もり（100＋3000トークン）ではなく実際の100トークンだけが差し引かれている
+            self.assertAlmostEqual(limiter.snapshot()["m"]["tpm_available"], 9900, delta=10)
+
+    async def test_hedge_budget_per_request(self):
+        """ヘッジの記録は、同時に走る別のリクエストではなく送ったリクエストに付ける"""
+        from main import LatencyTracker
+
+        tracker = LatencyTracker(budget_ratio=0.5)
+        first = tracker.start_request()
+        second = tracker.start_request()
+        self.assertTrue(tracker.try_hedge(first))
+        self.assertTrue(first["hedged"])
+        self.assertFalse(second["hedged"])
+        # 2件中1件をヘッジ済みなので上限に達している
+        self.assertFalse(tracker.try_hedge(second))
+
+    async def test_stream_latency_until_first_content(self):
+        """ストリーミングの応答時間はroleだけのチャンクではなく本文の最初の文字までを測る"""
+        from main import LatencyTracker, stream_chat_completion
+
+        async def slow_stream():
+            yield stream_chunk("", role="assistant")
+            await asyncio.sleep(0.05)
+            yield stream_chunk("本文")
+
+        tracker = LatencyTracker(default_delay=10)
+        with patch('main.client_openai', mock_openai_client(return_value=slow_stream())), \
+             patch('main.HEDGED_REQUESTS', True), patch('main.STREAM_RESPONSES', True), \
+             patch('main.latency_tracker', tracker):
+            text, _ = await stream_chat_completion(mock_channel(), "生成中", feature="x_post", model="m", messages=[])
+        self.assertEqual(text, "本文")
+        self.assertGreaterEqual(tracker._latencies["x_post"][0], 0.05)
@@ -0,0 +1,128 @@
+"""
+リアクション処理キューとリアクションのまとめ処理のテスト
+"""
+import asyncio
+import json
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, patch
+
+from tests.helpers import BotTestCase, chat_response, mock_openai_client
+
+
+class TestReactionQueue(BotTestCase):
+    """リアクション処理キューとリアクションのまとめ処理のテストクラス"""
+
+    async def test_reaction_job_queue(self):
+        """リアクション処理キューのテスト（サーバー間の順番・待ち順・上限）"""
+        from main import ReactionJob, ReactionJobQueue
+
+        order = []
+        gate = asyncio.Event()
+
+        async def feature(message, channel, user, user_data, is_premium):
+            await gate.wait()
+            order.append(message)
+
+        queue = ReactionJobQueue(max_size=4, worker_count=1)
+        queue.start()
+        try:
+            self.assertEqual(queue.submit(ReactionJob(1, feature, "a1", None, None, {}, False)), 0)
+            await asyncio.sleep(0)  # ワーカーがa1を取り出す
+
+            # 大きなサーバー1の連投があってもサーバー2が間に入る
+            self.assertEqual(queue.submit(ReactionJob(1, feature, "a2", None, None, {}, False)), 1)
+            self.assertEqual(queue.submit(ReactionJob(1, feature, "a3", None, None, {}, False)), 2)
+            self.assertEqual(queue.submit(ReactionJob(2, feature, "b1", None, None, {}, False)), 2)
+            self.assertEqual(queue.submit(ReactionJob(1, feature, "a4", None, None, {}, False)), 4)
+            self.assertIsNone(queue.submit(ReactionJob(2, feature, "b2", None, None, {}, False)))
+
+            gate.set()
+            for _ in range(20):
+                await asyncio.sleep(0)
+            self.assertEqual(order, ["a1", "a2", "b1", "a3", "a4"])
+            self.assertEqual(len(queue), 0)
+        finally:
+            queue.stop()
+
+    async def test_reaction_job_queue_priority(self):
+        """リアクション処理キューのテスト（プレミアム優先・無料の飢餓防止・同時実行上限）"""
+        from main import ReactionJob, ReactionJobQueue
+
+        order = []
+        gate = asyncio.Event()
+
+        async def feature(message, channel, user, user_data, is_premium):
+            order.append(message)
+            await gate.wait()
+
+        queue = ReactionJobQueue(max_size=10, worker_count=1, starvation_limit=2)
+        queue.start()
+        try:
+            queue.submit(ReactionJob(1, feature, "f1", None, None, {}, False))
+            await asyncio.sleep(0)
+            for name, premium in [("f2", False), ("f3", False), ("p1", True), ("p2", True), ("p3", True)]:
+                queue.submit(ReactionJob(1, feature, name, None, None, {}, premium))
+            gate.set()
+            for _ in range(30):
+                await asyncio.sleep(0)
+            self.assertEqual(order, ["f1", "p1", "p2", "f2", "p3", "f3"])
+        finally:
+            queue.stop()
+
+        # 無料レーンが上限に達していてもプレミアムは空きワーカーで処理される
+        order.clear()
+        gate.clear()
+        queue = ReactionJobQueue(max_size=10, worker_count=2, free_concurrency=1)
+        queue.start()
+        try:
+            self.assertEqual(queue.submit(ReactionJob(1, feature, "f1", None, None, {}, False)), 0)
+            await asyncio.sleep(0)
+            self.assertEqual(queue.submit(ReactionJob(1, feature, "f2", None, None, {}, False)), 1)
+            self.assertEqual(queue.submit(ReactionJob(2, feature, "p1", None, None, {}, True)), 0)
+            for _ in range(5):
+                await asyncio.sleep(0)
+            self.assertEqual(order, ["f1", "p1"])
+        finally:
+            gate.set()
+            queue.stop()
+
+    async def test_reaction_batching(self):
+        """同じメッセージへの連続したリアクションを1回の生成にまとめるテスト"""
+        from main import ReactionBatcher, run_reaction_batch, collect_input_text, generate_completion, GenerationCache
+
+        # 受付期間内のリアクションは1つのジョブにまとめる（🎤はまとめない）
+        submit = AsyncMock()
+        user = SimpleNamespace(id=1)
+        message = SimpleNamespace(id=10, content="お知らせ", attachments=[], embeds=[])
+        with patch('main.submit_reaction_job', submit):
+            batcher = ReactionBatcher(window=0.01)
+            for emoji in ['👍', '📝', '🎤']:
+                await batcher.add(5, emoji, message, None, user, {}, False)
+            await asyncio.sleep(0.05)
+        self.assertEqual(submit.call_count, 2)
+        self.assertEqual(submit.call_args_list[0].args[1], ['🎤'])
+        self.assertEqual(submit.call_args_list[1].args[1], ['👍', '📝'])
+
+        # まとめて生成した結果を各機能が受け取る
+        received = {}
+
+        async def fake_feature(name):
+            text = await collect_input_text(message)
+            content, _ = await generate_completion(name, model="m", messages=[{"role": "user", "content": text}])
+            received[name] = content
+
+        combined = json.dumps({"x_post": {"content": "X投稿"}, "article": {"content": "# 記事"}}, ensure_ascii=False)
+        mock_client = mock_openai_client(
+            return_value=chat_response(combined)
+        )
+        features = {'👍': lambda *args: fake_feature("x_post"), '📝': lambda *args: fake_feature("article")}
+        with patch('main.client_openai', mock_client), patch('main.generation_cache', GenerationCache(path="")), \
+             patch.dict('main.REACTION_FEATURES', features):
+            await run_reaction_batch(['👍', '📝'], message, None, user, {}, False)
+
+        self.assertEqual(mock_client.chat.completions.create.call_count, 1)
+        system_prompt = mock_client.chat.completions.create.call_args.kwargs["messages"][0]["content"]
+        self.assertIn("x_post", system_prompt)
+        self.assertIn("article", system_prompt)
+        self.assertEqual(json.loads(received["x_post"]), {"content": "X投稿"})
+        self.assertEqual(json.loads(received["article"]), {"content": "# 記事"})
@@ -0,0 +1,86 @@
+"""
+利用回数の制限のテスト
+"""
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, patch
+
+from tests.helpers import BotTestCase, chat_response, mock_openai_client, mock_channel
+
+
+class TestQuota(BotTestCase):
+    """利用回数の制限のテストクラス"""
+
+    async def test_quota_counter(self):
+        """利用回数カウンターのテスト（上限・日付リセット・書き戻し）"""
+        from main import QuotaCounter, UserDataStore
+
+        counter = QuotaCounter(daily_limit=2)
+        store = UserDataStore()
+        user_data = {"user_id": "67890", "last_used_date": "", "daily_usage_count": 0}
+        store.put("67890", user_data)
+
+        with patch.object(QuotaCounter, 'today', return_value="2025-07-01"):
+            counter.seed("67890", user_data)
+            self.assertTrue(counter.try_consume("67890", is_premium=False))
+            self.assertTrue(counter.try_consume("67890", is_premium=False))
+            self.assertFalse(counter.try_consume("67890", is_premium=False))
+
+            # プレミアムは上限なし、失敗分は返却できる
+            self.assertTrue(counter.try_consume("67890", is_premium=True))
+            counter.refund("67890")
+            self.assertEqual(counter.usage("67890"), 2)
+
+            with patch('main.user_store', store):
+                await counter.flush()
+            self.assertEqual(user_data["last_used_date"], "2025-07-01")
+            self.assertEqual(user_data["daily_usage_count"], 2)
+
+        # 日本時間で日付が変わるとリセットされる
+        with patch.object(QuotaCounter, 'today', return_value="2025-07-02"):
+            self.assertEqual(counter.usage("67890"), 0)
+            self.assertTrue(counter.try_consume("67890", is_premium=False))
+
+    async def test_can_use_feature_keys_by_discord_id(self):
+        """user_idのない古いデータでも、ユーザーごとに別々のカウンターを使う"""
+        from main import QuotaCounter, can_use_feature
+
+        counter = QuotaCounter(daily_limit=1)
+        old_record = {"username": "old", "last_used_date": "", "daily_usage_count": 0}
+        with patch('main.quota_counter', counter), patch.object(QuotaCounter, 'today', return_value="2025-07-01"):
+            self.assertTrue(can_use_feature(111, dict(old_record), False)[0])
+            # 別のユーザーは同じ"None"のカウンターを共有しない
+            self.assertTrue(can_use_feature(222, dict(old_record), False)[0])
+            self.assertFalse(can_use_feature(111, dict(old_record), False)[0])
+            self.assertEqual(counter.usage("111"), 1)
+
+            with self.assertRaises(ValueError):
+                can_use_feature(None, old_record, False)
+
+    async def test_refund_only_when_generation_fails(self):
+        """生成に失敗した時だけ利用回数を戻し、結果の送信後のエラーでは戻さない"""
+        from main import QuotaCounter, GenerationCache, run_x_post
+
+        message = SimpleNamespace(id=10, content="お知らせ", attachments=[], embeds=[],
+                                  guild=SimpleNamespace(id=1), channel=SimpleNamespace(id=2))
+        user = SimpleNamespace(id=111, name="user", mention="@user")
+        counter = QuotaCounter(daily_limit=5)
+
+        async def run(client, channel):
+            with patch('main.client_openai', client), patch('main.quota_counter', counter), \
+                 patch('main.generation_cache', GenerationCache(path="")), \
+                 patch('main.shorten_url', return_value="https://short"), \
+                 patch.object(QuotaCounter, 'today', return_value="2025-07-01"):
+                counter.try_consume("111", is_premium=False)
+                await run_x_post(message, channel, user, {}, False)
+                return counter.usage("111")
+
+        # 生成後に結果の送信（Embed）が失敗しても利用回数は戻さない
+        channel = mock_channel()
+        channel.send.side_effect = [None, None, RuntimeError("Discord error"), None]
+        self.assertEqual(await run(mock_openai_client(return_value=chat_response('{"content": "要約"}')), channel), 1)
+
+        # OpenAIの呼び出しが失敗した場合は戻す
+        channel = mock_channel()
+        failing = mock_openai_client(side_effect=ValueError("bad request"))
+        self.assertEqual(await run(failing, channel), 1)
+        self.assertIn("エラー", channel.send.call_args.args[0])
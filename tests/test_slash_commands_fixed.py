@@ -153,10 +153,13 @@ class TestSlashCommandsFixed(unittest.IsolatedAsyncioTestCase):
              patch('builtins.open', mock_open()) as mock_file, \
              patch('pathlib.Path.exists', return_value=False):
             
-            # ユーザーアクティビティ記録テスト
+            # ユーザーアクティビティ記録テスト（記録時はファイルを開かない）
             await stats_manager.record_user_activity("12345")
+            mock_file.assert_not_called()
+            self.assertEqual(stats_manager.calculate_dau(), 1)
             
-            # ファイルが書き込まれることを確認
+            # フラッシュ時にファイルが書き込まれることを確認
+            await stats_manager.flush()
             mock_file.assert_called()
 
     async def test_premium_check_logic(self):
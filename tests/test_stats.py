@@ -0,0 +1,104 @@
+"""
+統計（アクティブユーザー集計）のテスト
+"""
+import builtins
+import json
+from datetime import datetime
+from unittest.mock import patch
+
+from tests.helpers import BotTestCase, frozen_datetime
+
+
+class TestStats(BotTestCase):
+    """統計（アクティブユーザー集計）のテストクラス"""
+
+    async def test_active_user_sketch_rollup(self):
+        """日別集計（正確なset → HyperLogLog）の合算テスト"""
+        from main import ActiveUserSketch
+
+        # 閾値以下は正確に数える
+        small_day = ActiveUserSketch(users=["1", "2", "3"], threshold=100)
+        self.assertIsNone(small_day.hll)
+        self.assertEqual(small_day.count(), 3)
+
+        # 閾値を超えたらHyperLogLogに切り替わる
+        big_day = ActiveUserSketch(threshold=100)
+        for i in range(5000):
+            big_day.add(str(i))
+        self.assertIsNone(big_day.users)
+        self.assertAlmostEqual(big_day.count(), 5000, delta=150)
+
+        # 保存形式から復元しても同じ推定値になる
+        restored = ActiveUserSketch.from_dict(big_day.to_dict())
+        self.assertEqual(restored.count(), big_day.count())
+
+        # 合算（重複ユーザーは1回だけ数える）
+        merged = ActiveUserSketch(threshold=100)
+        merged.update(small_day)
+        merged.update(restored)
+        self.assertAlmostEqual(merged.count(), 5000, delta=150)
+        self.assertEqual(small_day.count(), 3)
+
+    async def test_stats_roll_over_without_activity(self):
+        """日付が変わってから記録がなくても、今日の集計として昨日の値を返さない"""
+        from main import StatsManager
+
+        clock = [datetime(2025, 7, 1, 23, 59)]
+        with patch('main.script_dir', self.temp_path), patch('main.datetime', frozen_datetime(clock)):
+            (self.temp_path / "data" / "activity_logs").mkdir(parents=True)
+            stats = StatsManager()
+            await stats.record_user_activity("1")
+            await stats.record_user_activity("2")
+            self.assertEqual(stats.get_stats_summary()["dau"], 2)
+
+            # 0時を過ぎて、まだ誰も使っていない
+            clock[0] = datetime(2025, 7, 2, 0, 5)
+            summary = stats.get_stats_summary()
+            self.assertEqual(summary["date"], "2025-07-02")
+            self.assertEqual(summary["dau"], 0)
+            self.assertEqual(summary["total_actions_today"], 0)
+            # 昨日のユーザーは7日・30日の集計にだけ入る
+            self.assertEqual(summary["wau"], 2)
+            self.assertEqual(summary["mau"], 2)
+            self.assertEqual(stats.calculate_dau("2025-07-01"), 2)
+
+            # 確定した前日の集計は次のフラッシュで保存される
+            await stats.flush()
+            self.assertTrue((self.temp_path / "data" / "activity_logs" / "2025-07-01.json").exists())
+
+    async def test_stats_flush_partial_failure(self):
+        """書き込みが途中で失敗しても、書き込み済みのイベントを次回に二重に書かない"""
+        from main import StatsManager
+
+        clock = [datetime(2025, 7, 1, 23, 0)]
+        log_dir = self.temp_path / "data" / "activity_logs"
+        real_open = builtins.open
+
+        def failing_open(path, *args, **kwargs):
+            if str(path).endswith("2025-07-02.log"):
+                raise OSError("disk full")
+            return real_open(path, *args, **kwargs)
+
+        with patch('main.script_dir', self.temp_path), patch('main.datetime', frozen_datetime(clock)):
+            log_dir.mkdir(parents=True)
+            stats = StatsManager()
+            await stats.record_user_activity("1")
+            clock[0] = datetime(2025, 7, 2, 0, 10)
+            await stats.record_user_activity("2")
+
+            # 7/1のイベントは書けたが7/2のイベントで失敗
+            with patch('builtins.open', side_effect=failing_open):
+                await stats.flush()
+            await stats.flush()
+
+            self.assertEqual(len((log_dir / "events" / "2025-07-01.log").read_text().splitlines()), 1)
+            self.assertEqual(len((log_dir / "events" / "2025-07-02.log").read_text().splitlines()), 1)
+            self.assertEqual(json.loads((log_dir / "2025-07-01.json").read_text())["active_users"], ["1"])
+
+            # 同じユーザーの再利用では日別集計を書き直さない（終了時にはアクション数を保存する）
+            (log_dir / "2025-07-02.json").unlink()
+            await stats.record_user_activity("2")
+            await stats.flush()
+            self.assertFalse((log_dir / "2025-07-02.json").exists())
+            await stats.flush(final=True)
+            self.assertEqual(json.loads((log_dir / "2025-07-02.json").read_text())["total_actions"], 2)
@@ -0,0 +1,106 @@
+"""
+ストア（ユーザーデータ・SQLite・有効チャンネル・プレミアム会員）のテスト
+"""
+import json
+from unittest.mock import MagicMock, patch
+
+from tests.helpers import BotTestCase
+
+
+class TestStores(BotTestCase):
+    """ストア（ユーザーデータ・SQLite・有効チャンネル・プレミアム会員）のテストクラス"""
+
+    async def test_user_data_store_write_back(self):
+        """ユーザーデータストアの書き戻しテスト"""
+        from main import UserDataStore, load_user_data
+
+        store = UserDataStore()
+        test_data = {"user_id": "67890", "daily_usage_count": 1}
+
+        with patch('main.script_dir', self.temp_path):
+            # putだけではディスクに書き込まれない
+            store.put("67890", test_data)
+            self.assertIsNone(load_user_data("67890"))
+
+            # キャッシュから同じオブジェクトが返る
+            self.assertIs(await store.get("67890"), test_data)
+
+            # フラッシュでまとめて書き戻される
+            self.assertEqual(await store.flush(), 1)
+            self.assertEqual(load_user_data("67890")["daily_usage_count"], 1)
+            self.assertEqual(await store.flush(), 0)
+
+    async def test_sqlite_import_from_json(self):
+        """JSONデータのSQLiteインポートテスト"""
+        from main import SQLiteStorage, import_json_to_sqlite, save_user_data, save_server_data
+
+        with patch('main.script_dir', self.temp_path):
+            save_user_data("67890", {"user_id": "67890", "status": "free"})
+            save_server_data("12345", {"server_id": "12345", "active_channel_ids": ["98765"]})
+            activity_dir = self.temp_path / "data" / "activity_logs"
+            activity_dir.mkdir(parents=True)
+            with open(activity_dir / "2025-07-01.json", 'w', encoding='utf-8') as f:
+                json.dump({"date": "2025-07-01", "active_users": ["1", "2"], "total_actions": 3, "server_count": 1}, f)
+
+            storage = SQLiteStorage(self.temp_path / "test.db")
+            counts = import_json_to_sqlite(storage)
+
+        self.assertEqual(counts, {"users": 1, "servers": 1, "activity_days": 1})
+        self.assertEqual(storage.load_user("67890")["status"], "free")
+        self.assertEqual(storage.load_server("12345")["active_channel_ids"], ["98765"])
+        self.assertEqual(storage.count_active_users("2025-07-01", "2025-07-01"), 2)
+        self.assertEqual(storage.load_activity_totals("2025-07-01"), (3, 1))
+        storage.close()
+
+    async def test_active_channel_index(self):
+        """有効チャンネルインデックスのテスト"""
+        from main import ActiveChannelIndex, save_server_data
+
+        with patch('main.script_dir', self.temp_path):
+            save_server_data("12345", {"server_id": "12345", "active_channel_ids": ["98765"]})
+
+            index = ActiveChannelIndex()
+            index.load_all()
+
+        # 起動後はファイルを読まずに判定する
+        with patch('main.load_server_data') as mock_load:
+            self.assertTrue(index.is_active("12345", "98765"))
+            self.assertFalse(index.is_active("12345", "11111"))
+            self.assertFalse(index.is_active("99999", "98765"))
+            mock_load.assert_not_called()
+
+        # activate/deactivate相当の更新
+        index.set_channels("12345", ["98765", "11111"])
+        self.assertTrue(index.is_active("12345", "11111"))
+        index.set_channels("12345", [])
+        self.assertFalse(index.is_active("12345", "98765"))
+
+    async def test_premium_member_cache(self):
+        """プレミアム会員キャッシュのテスト"""
+        from main import PremiumMemberCache
+
+        premium_role = MagicMock()
+        premium_role.id = 98765
+
+        def make_member(member_id, roles):
+            member = MagicMock()
+            member.id = member_id
+            member.roles = roles
+            return member
+
+        guild = MagicMock()
+        guild.members = [make_member(1, [premium_role]), make_member(2, [])]
+
+        with patch.dict('main.settings', {"premium_role_id": "98765"}):
+            cache = PremiumMemberCache()
+            cache.rebuild(guild)
+            self.assertIn("1", cache)
+            self.assertNotIn("2", cache)
+
+            # ロール付与・剥奪・退出の反映
+            cache.update_member(make_member(2, [premium_role]))
+            self.assertIn(2, cache)
+            cache.update_member(make_member(1, []))
+            self.assertNotIn(1, cache)
+            cache.remove_member(2)
+            self.assertNotIn(2, cache)